@@ -0,0 +1,50 @@
+"""Build an in-process app wired to the stub piper/ffmpeg for benchmarks."""
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+STUBS = os.path.join(ROOT, "bench", "stubs")
+
+sys.path.insert(0, SRC)
+
+
+def stub_voices(d):
+    """Copy voice configs into d with empty model files so _scan finds them."""
+    os.makedirs(d, exist_ok=True)
+    for j in glob.glob(os.path.join(ROOT, "voices", "*.onnx.json")):
+        shutil.copy(j, d)
+        open(os.path.join(d, os.path.basename(j)[:-5]), "wb").close()
+    return d
+
+
+def bench_cfg(work=None, **over):
+    """Return a config using the stubs, a temp voices dir and auth disabled."""
+    work = work or tempfile.mkdtemp(prefix="tts-bench-")
+    cfg = {
+        "voices_dir": stub_voices(os.path.join(work, "voices")),
+        "sounds_dir": os.path.join(ROOT, "sounds"),
+        "piper_bin": os.path.join(STUBS, "piper"),
+        "ffmpeg_bin": os.path.join(STUBS, "ffmpeg"),
+        "db_file": os.path.join(work, "tts.db"),
+        "secrets_file": os.path.join(work, "secrets.yaml"),
+        "session": {"file": os.path.join(work, "secrets.yaml")},
+        "auth": {"enabled": False},
+        "max_text_chars": 500,
+    }
+    cfg.update(over)
+    return cfg
+
+
+def bench_app(**over):
+    """Create the FastAPI app for in-process load tests."""
+    import api
+
+    cfg = bench_cfg(**over)
+    return api.make_app(
+        cfg, os.path.join(os.path.dirname(cfg["db_file"]), "config.yaml")
+    )
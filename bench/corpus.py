@@ -0,0 +1,56 @@
+"""Deterministic synthetic chat corpus for benchmarks."""
+
+import random
+
+NAMES = ["amy", "bryce", "lessac", "arctic", "obiwan", "narrator"]
+SFX = ["boom", "tada", "raar", "tacobell", "airhorn"]
+WORDS = (
+    "hello there gg wp lol pog clip that chat is this real no way let's go "
+    "nice play what was that streamer hydrate please thanks for the sub "
+    "welcome back everyone first time chatter love the stream when is the "
+    "next one can you say hi to my friend big fan from brazil"
+).split()
+EMOJI = ["😂", "🔥", "💀", "👀", "❤️"]
+URLS = ["https://example.com/clip/abc", "www.twitch.tv/someone"]
+
+
+def message(rng):
+    """Return one chat message with a realistic mix of inline control syntax."""
+    n = rng.randint(2, 18)
+    words = [rng.choice(WORDS) for _ in range(n)]
+
+    r = rng.random()
+    if r < 0.1:
+        words.insert(rng.randint(0, n), f"[SFX: {rng.choice(SFX)}]")
+    if rng.random() < 0.1:
+        words.insert(rng.randint(0, len(words)), rng.choice(EMOJI))
+    if rng.random() < 0.05:
+        words.append(rng.choice(URLS))
+    if rng.random() < 0.05:
+        words.insert(0, rng.choice(["[fast]", "[slow]"]))
+
+    s = " ".join(words)
+    if rng.random() < 0.15:
+        s = f"{rng.choice(NAMES)}: {s}"
+    if rng.random() < 0.05:
+        s = "[fast] " + s
+
+    return s
+
+
+def corpus(n=1000, seed=1234, repeat=0.3):
+    """
+    Build a list of chat messages
+
+    :param n: Number of messages
+    :param seed: RNG seed, fixed so runs are comparable
+    :param repeat: Fraction of messages that repeat an earlier one
+    """
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n):
+        if out and rng.random() < repeat:
+            out.append(rng.choice(out))
+        else:
+            out.append(message(rng))
+    return out
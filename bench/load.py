@@ -0,0 +1,215 @@
+"""Open-loop load generator for /api/tts, /api/tts_batch and push/pull.
+
+Runs in-process against make_app (with the stub piper/ffmpeg) or against a
+live server with --url. Requests are issued on a fixed schedule at the
+target rate and latency is measured from the scheduled start, so a slow
+server cannot hide queueing delay (no coordinated omission).
+
+    python bench/load.py tts --rps 20 --duration 10
+    python bench/load.py all --check          # compare with bench/baselines
+    python bench/load.py all --save           # refresh bench/baselines
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import httpx
+
+from common import ROOT, bench_app
+from corpus import corpus
+
+BASELINES = os.path.join(ROOT, "bench", "baselines")
+SCENARIOS = ("tts", "batch", "pushpull")
+DEFAULT_RPS = {"tts": 5, "batch": 1, "pushpull": 50}
+TOLERANCE = 0.25
+
+
+async def _tts(c, i, texts):
+    r = await c.post("/api/tts", json={"text": texts[i % len(texts)]})
+    r.raise_for_status()
+    return len(r.content)
+
+
+async def _batch(c, i, texts):
+    parts = [
+        {"text": texts[i % len(texts)]},
+        {"sfx": "boom"},
+        {"text": texts[(i + 1) % len(texts)], "voice": "en_US-bryce-medium"},
+    ]
+    r = await c.post("/api/tts_batch", json={"parts": parts})
+    r.raise_for_status()
+    return len(r.content)
+
+
+async def _pushpull(c, i, texts):
+    r = await c.post("/api/push", json={"text": texts[i % len(texts)]})
+    r.raise_for_status()
+    r = await c.get("/api/pull")
+    r.raise_for_status()
+    return len(r.content)
+
+
+RUNNERS = {"tts": _tts, "batch": _batch, "pushpull": _pushpull}
+
+
+def _pct(xs, q):
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+
+async def run(c, scenario, rps, duration, concurrency, texts):
+    """
+    Drive one scenario at a fixed request rate
+
+    :return: Report dict with latency percentiles (ms), throughput and CPU
+    """
+    fn = RUNNERS[scenario]
+    lat, errors, nbytes = [], 0, 0
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(i, due):
+        nonlocal errors, nbytes
+        async with gate:
+            try:
+                nbytes += await fn(c, i, texts)
+            except Exception:
+                errors += 1
+                return
+        lat.append(time.perf_counter() - due)
+
+    ru0 = resource.getrusage(resource.RUSAGE_SELF)
+    rc0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    t0 = time.perf_counter()
+    tasks, i = [], 0
+
+    while True:
+        due = t0 + i / rps
+        if due - t0 >= duration:
+            break
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        tasks.append(asyncio.create_task(one(i, due)))
+        i += 1
+
+    await asyncio.gather(*tasks)
+    wall = time.perf_counter() - t0
+    ru1 = resource.getrusage(resource.RUSAGE_SELF)
+    rc1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu_self = (ru1.ru_utime - ru0.ru_utime) + (ru1.ru_stime - ru0.ru_stime)
+    cpu_kids = (rc1.ru_utime - rc0.ru_utime) + (rc1.ru_stime - rc0.ru_stime)
+    ms = [x * 1000 for x in lat]
+
+    return {
+        "scenario": scenario,
+        "target_rps": rps,
+        "duration_s": duration,
+        "requests": i,
+        "ok": len(lat),
+        "errors": errors,
+        "throughput_rps": round(len(lat) / wall, 2),
+        "p50_ms": round(_pct(ms, 0.50), 1),
+        "p95_ms": round(_pct(ms, 0.95), 1),
+        "p99_ms": round(_pct(ms, 0.99), 1),
+        "bytes": nbytes,
+        "cpu_self_s": round(cpu_self, 3),
+        "cpu_children_s": round(cpu_kids, 3),
+        "cpu_util": round((cpu_self + cpu_kids) / wall, 3),
+    }
+
+
+def compare(rep, base, tol=TOLERANCE):
+    """Return a list of regressions of rep against a baseline report."""
+    bad = []
+    for k in ("p50_ms", "p95_ms", "p99_ms"):
+        if base.get(k) and rep[k] > base[k] * (1 + tol):
+            bad.append(f"{k} {rep[k]} > {base[k]} (+{int(tol * 100)}%)")
+    if base.get("throughput_rps") and rep["throughput_rps"] < base["throughput_rps"] * (
+        1 - tol
+    ):
+        bad.append(f"throughput_rps {rep['throughput_rps']} < {base['throughput_rps']}")
+    if rep["errors"] > base.get("errors", 0):
+        bad.append(f"errors {rep['errors']} > {base.get('errors', 0)}")
+    return bad
+
+
+async def main_async(a):
+    texts = corpus(a.messages, seed=a.seed, repeat=a.repeat)
+    if a.url:
+        c = httpx.AsyncClient(base_url=a.url, timeout=60, headers=a.headers)
+    else:
+        app = bench_app(max_concurrency=a.max_concurrency)
+        c = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60
+        )
+
+    out = []
+    async with c:
+        for sc in SCENARIOS if a.scenario == "all" else (a.scenario,):
+            rps = a.rps or DEFAULT_RPS[sc]
+            dur = a.duration
+            base = _baseline(sc) if a.check else None
+            if base and not a.rps:
+                rps = base["target_rps"]
+                dur = base.get("duration_s", dur)
+            out.append(await run(c, sc, rps, dur, a.concurrency, texts))
+    return out
+
+
+def _baseline(sc):
+    p = os.path.join(BASELINES, f"{sc}.json")
+    if not os.path.exists(p):
+        return None
+    with open(p, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("scenario", choices=SCENARIOS + ("all",))
+    ap.add_argument("--rps", type=float, help="target rate (default per scenario)")
+    ap.add_argument("--duration", type=float, default=10)
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--max-concurrency", type=int, default=2)
+    ap.add_argument("--messages", type=int, default=500)
+    ap.add_argument("--repeat", type=float, default=0.3)
+    ap.add_argument("--seed", type=int, default=1234)
+    ap.add_argument("--url", help="run against a live server instead of in-process")
+    ap.add_argument("--key", help="X-API-Key for --url")
+    ap.add_argument("--save", action="store_true", help="write results as baselines")
+    ap.add_argument(
+        "--check", action="store_true", help="fail on regression vs baselines"
+    )
+    ap.add_argument("--tolerance", type=float, default=TOLERANCE)
+    a = ap.parse_args()
+    a.headers = {"X-API-Key": a.key} if a.key else {}
+
+    reps = asyncio.run(main_async(a))
+    print(json.dumps(reps, indent=2))
+
+    failed = False
+    for rep in reps:
+        if a.save:
+            os.makedirs(BASELINES, exist_ok=True)
+            p = os.path.join(BASELINES, f"{rep['scenario']}.json")
+            with open(p, "w", encoding="utf-8") as f:
+                json.dump(rep, f, indent=2)
+                f.write("\n")
+        elif a.check and _baseline(rep["scenario"]):
+            bad = compare(rep, _baseline(rep["scenario"]), a.tolerance)
+            for b in bad:
+                print(f"REGRESSION {rep['scenario']}: {b}", file=sys.stderr)
+            failed |= bool(bad)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
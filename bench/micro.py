@@ -0,0 +1,167 @@
+"""Micro-benchmarks for the text-side functions run on every message.
+
+Each function is timed with timeit over the same synthetic chat corpus and
+reported as nanoseconds per call (best and median of --repeat runs).
+
+    python bench/micro.py                  # JSON to stdout
+    python bench/micro.py --check          # compare with bench/baselines/micro.json
+    python bench/micro.py --save           # refresh the baseline
+"""
+
+import os
+import sys
+import json
+import random
+import timeit
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import ROOT, bench_cfg
+from corpus import corpus, NAMES
+
+BASELINE = os.path.join(ROOT, "bench", "baselines", "micro.json")
+TOLERANCE = 0.25
+
+
+def blocklist(n=400, seed=7):
+    """
+    Build a synthetic blocklist shaped like public ones
+
+    Terms are made-up words of 3-12 letters with some multi-word phrases,
+    which is what drives the per-term regex cost in SlurCensor.
+    """
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    out = set()
+    while len(out) < n:
+        w = "".join(rng.choice(letters) for _ in range(rng.randint(3, 12)))
+        if rng.random() < 0.15:
+            w += " " + "".join(rng.choice(letters) for _ in range(rng.randint(3, 8)))
+        out.add(w)
+    return sorted(out)
+
+
+def setup(work, n, seed):
+    """Initialize tts/mod/sfx as the server would and return (fns, inputs)."""
+    import tts
+    import mod
+    import api
+
+    terms = blocklist()
+    bl = os.path.join(work, "mod_blocklist.txt")
+    with open(bl, "w", encoding="utf-8") as f:
+        f.write("\n".join(terms) + "\n")
+
+    cfg = bench_cfg(
+        work,
+        aliases={a: "en_US-amy-medium" for a in NAMES},
+        presets={"fast": {"length_scale": 0.85}, "slow": {"length_scale": 1.2}},
+        moderation={"enabled": True, "blocklist_path": bl},
+        auth={"enabled": True, "file": os.path.join(work, "secrets.yaml")},
+    )
+    tts.init(cfg)
+    m = mod.get_moderator()
+
+    rng = random.Random(seed)
+    texts = corpus(n, seed=seed)
+    # a few messages carry (obfuscated) blocked terms so the replace path runs
+    texts = [
+        t + " " + rng.choice(terms).replace("o", "0") if rng.random() < 0.05 else t
+        for t in texts
+    ]
+    clean = [tts._san(t) for t in texts]
+
+    keys = tts._auth["keys"]
+    pool = [keys["admin"], keys["pull"], keys["tts"], "not-a-key", ""]
+    ks = [pool[i % len(pool)] for i in range(len(texts))]
+
+    fns = {
+        "tts._san": (tts._san, texts),
+        "tts._plan": (tts._plan, clean),
+        "mod.Moderator.filter": (m.filter, clean),
+        "api._eff_from_key": (api._eff_from_key, ks),
+    }
+    return fns, {"messages": len(texts), "blocklist_terms": len(terms)}
+
+
+def bench(fn, xs, repeat, min_time):
+    """
+    Time fn over every input in xs
+
+    :param min_time: Minimum seconds per run, loops are scaled to reach it
+    :return: {"ns_per_call", "ns_per_call_median", "calls"}
+    """
+
+    def loop():
+        for x in xs:
+            fn(x)
+
+    t = timeit.Timer(loop)
+    number, _ = t.autorange()
+    number = max(number, int(min_time / max(t.timeit(1), 1e-9)) or 1)
+    runs = [r / (number * len(xs)) * 1e9 for r in t.repeat(repeat, number)]
+
+    return {
+        "ns_per_call": round(min(runs), 1),
+        "ns_per_call_median": round(statistics.median(runs), 1),
+        "calls": number * len(xs) * repeat,
+    }
+
+
+def compare(rep, base, tol=TOLERANCE):
+    """Return a list of functions that got slower than the baseline."""
+    bad = []
+    for k, r in rep["results"].items():
+        b = base.get("results", {}).get(k)
+        if b and r["ns_per_call"] > b["ns_per_call"] * (1 + tol):
+            bad.append(f"{k} {r['ns_per_call']}ns > {b['ns_per_call']}ns")
+    return bad
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-k", help="only run functions whose name contains this")
+    ap.add_argument("--messages", type=int, default=1000)
+    ap.add_argument("--seed", type=int, default=1234)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--min-time", type=float, default=0.2)
+    ap.add_argument("--out", help="also write the JSON report to this file")
+    ap.add_argument("--save", action="store_true", help="write results as baseline")
+    ap.add_argument("--check", action="store_true", help="fail on regression")
+    ap.add_argument("--tolerance", type=float, default=TOLERANCE)
+    a = ap.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="tts-micro-") as work:
+        fns, meta = setup(work, a.messages, a.seed)
+        res = {
+            name: bench(fn, xs, a.repeat, a.min_time)
+            for name, (fn, xs) in fns.items()
+            if not a.k or a.k in name
+        }
+
+    rep = {
+        "python": sys.version.split()[0],
+        "repeat": a.repeat,
+        **meta,
+        "results": res,
+    }
+    out = json.dumps(rep, indent=2)
+    print(out)
+
+    for p in [a.out] + ([BASELINE] if a.save else []):
+        if p:
+            with open(p, "w", encoding="utf-8") as f:
+                f.write(out + "\n")
+
+    if a.check and os.path.exists(BASELINE):
+        with open(BASELINE, encoding="utf-8") as f:
+            bad = compare(rep, json.load(f), a.tolerance)
+        for b in bad:
+            print(f"REGRESSION {b}", file=sys.stderr)
+        sys.exit(1 if bad else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Stand-in for a Redis server speaking the RESP subset the audio cache uses.
+
+Supports PING, GET, SET (with EX/PX), DEL, DBSIZE, FLUSHDB, SELECT and AUTH,
+in memory, with expiry on read. Import serve() for tests or run it:
+
+    python bench/stubs/respd.py --port 6390
+"""
+
+import time
+import argparse
+import threading
+import socketserver
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _arr(self):
+        line = self.rfile.readline()
+        if not line.startswith(b"*"):
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            n = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(n + 2)[:n])
+        return args
+
+    def handle(self):
+        srv = self.server
+        while True:
+            args = self._arr()
+            if not args:
+                return
+            cmd = args[0].upper()
+            srv.calls += 1
+            with srv.lock:
+                out = self._run(srv, cmd, args[1:])
+            self.wfile.write(out)
+
+    def _run(self, srv, cmd, a):
+        d, now = srv.data, time.time()
+        if cmd == b"PING":
+            return b"+PONG\r\n"
+        if cmd in (b"SELECT", b"AUTH"):
+            return b"+OK\r\n"
+        if cmd == b"GET":
+            v = d.get(a[0])
+            if v is None or (v[1] and v[1] < now):
+                d.pop(a[0], None)
+                return b"$-1\r\n"
+            return b"$%d\r\n%s\r\n" % (len(v[0]), v[0])
+        if cmd == b"SET":
+            exp = None
+            if len(a) >= 4 and a[2].upper() == b"PX":
+                exp = now + int(a[3]) / 1000
+            elif len(a) >= 4 and a[2].upper() == b"EX":
+                exp = now + int(a[3])
+            d[a[0]] = (a[1], exp)
+            return b"+OK\r\n"
+        if cmd == b"DEL":
+            return b":%d\r\n" % sum(d.pop(k, None) is not None for k in a)
+        if cmd == b"DBSIZE":
+            return b":%d\r\n" % len(d)
+        if cmd == b"FLUSHDB":
+            d.clear()
+            return b"+OK\r\n"
+        return b"-ERR unknown command\r\n"
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr):
+        super().__init__(addr, _Handler)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.port = self.server_address[1]
+
+
+def serve(host="127.0.0.1", port=0):
+    """Start a server in a daemon thread and return it; port 0 picks a free one."""
+    s = Server((host, port))
+    threading.Thread(target=s.serve_forever, daemon=True).start()
+    return s
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=6379)
+    a = ap.parse_args()
+    Server((a.host, a.port)).serve_forever()
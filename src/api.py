@@ -1,24 +1,40 @@
 import os
-from collections import deque
 from fastapi import FastAPI, APIRouter, HTTPException, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, HTMLResponse
+from fastapi.responses import Response, HTMLResponse, JSONResponse
 import requests
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.concurrency import run_in_threadpool
 
 import secrets_util as sec
 import tts as eng
 import sfx
 import mod
+import shared
 import uuid
 import json
 import time
 import secrets
 import jwt
 import db
+import authcache
+import timing
+import metrics
+import profiler
+import router
+import ratelimit
+import dedupe
+import math
+import hmac
+import hashlib
 
-MAX_SOUNDS = 10
+PUSHES = metrics.counter("push_requests", "Jobs accepted by /api/push")
+
+LIST_LIMIT = 100
+LIST_LIMIT_MAX = 500
+PULL_MAX = 8
+AUDIO_CACHE = "public, max-age=31536000, immutable"
 
 
 ROLE_TREE = {
@@ -51,6 +67,175 @@ def _eff_from_key(k):
     return eff
 
 
+def _page_limit(n):
+    return max(1, min(int(n), LIST_LIMIT_MAX))
+
+
+def _next_cursor(rows, limit):
+    if rows and len(rows) >= _page_limit(limit):
+        return rows[-1]["cursor"]
+    return None
+
+
+class CachedStaticFiles(StaticFiles):
+    def __init__(self, *a, cache_control=None, **k):
+        super().__init__(*a, **k)
+        self.cache_control = cache_control
+
+    def file_response(self, *a, **k):
+        resp = super().file_response(*a, **k)
+        if self.cache_control:
+            resp.headers["Cache-Control"] = self.cache_control
+        return resp
+
+
+def _byte_range(v, n):
+    """
+    Parse a single-range "bytes=" header
+
+    :return: Inclusive (start, end), None to send the full body, False if unsatisfiable
+    """
+    if not v or not v.startswith("bytes=") or "," in v:
+        return None
+    a, _, b = v[6:].strip().partition("-")
+    try:
+        if not a:
+            k = int(b)
+            if k <= 0:
+                return False
+            return max(0, n - k), n - 1
+        s = int(a)
+        e = int(b) if b else n - 1
+    except ValueError:
+        return None
+    if s >= n or e < s:
+        return False
+    return s, min(e, n - 1)
+
+
+def _audio_response(req, b, m, etag):
+    h = {"ETag": etag, "Cache-Control": AUDIO_CACHE, "Accept-Ranges": "bytes"}
+
+    inm = req.headers.get("if-none-match")
+    if inm:
+        tags = [t.strip().removeprefix("W/") for t in inm.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers=h)
+
+    rng = req.headers.get("range")
+    ir = req.headers.get("if-range")
+    if rng and (not ir or ir.strip() == etag):
+        r = _byte_range(rng, len(b))
+        if r is False:
+            h["Content-Range"] = f"bytes */{len(b)}"
+            return Response(status_code=416, headers=h)
+        if r:
+            s, e = r
+            h["Content-Range"] = f"bytes {s}-{e}/{len(b)}"
+            return Response(
+                content=b[s : e + 1], status_code=206, media_type=m, headers=h
+            )
+
+    return Response(content=b, media_type=m, headers=h)
+
+
+def _deliver(d, b, m, h):
+    """Return audio inline, as a JSON pointer to /api/audio, or as a redirect there."""
+    mode = (d.get("delivery") or eng.cfg.get("audio_delivery") or "inline").lower()
+    url = h.get("X-Audio-Url")
+    if mode not in ("url", "redirect") or not url:
+        return Response(content=b, media_type=m, headers=h)
+
+    hh = {k: v for k, v in h.items() if k not in ("ETag", "Content-Disposition")}
+    if mode == "redirect":
+        hh["Location"] = url
+        return Response(status_code=303, headers=hh)
+
+    return JSONResponse(
+        {
+            "url": url,
+            "sha256": h["ETag"].strip('"'),
+            "format": m,
+            "bytes": len(b),
+        },
+        headers=hh,
+    )
+
+
+def _proxy(req, rt, key, **kw):
+    """
+    Forward a request to the backend chosen by the router
+
+    This blocks on the backend; async handlers run it in the threadpool.
+    """
+    try:
+        n, res = rt.forward(req.method, req.url.path, key, dict(req.headers), **kw)
+    except RuntimeError as e:
+        raise HTTPException(503, str(e))
+    h = {k: v for k, v in res.headers.items() if k.lower() not in router.HOP}
+    if n:
+        h["X-Backend"] = n
+    return Response(content=res.content, status_code=res.status_code, headers=h)
+
+
+def _caller(req):
+    """Return who a request is charged to and the role that sets its limits."""
+    k = req.headers.get("x-api-key") or req.headers.get("authorization") or ""
+    if k.lower().startswith("bearer "):
+        k = k[7:]
+    if k:
+        for r, v in (eng._auth.get("keys") or {}).items():
+            if v and hmac.compare_digest(str(k), str(v)):
+                return "key:" + hashlib.sha256(k.encode()).hexdigest()[:16], r
+        try:
+            pl = authcache.verify(k, req.app.state.jwt_secret)
+        except Exception:
+            pl = None
+        if pl and pl.get("jti"):
+            roles = pl.get("roles") or []
+            return "jti:" + pl["jti"], next(
+                (r for r in ROLE_TREE if r in roles), "anon"
+            )
+
+    role = next((r for r in ROLE_TREE if req.session.get(r)), "anon")
+    for n, v in req.session.items():
+        if n.startswith("oauth_") and n.endswith("_login") and v:
+            return f"oauth:{n[6:-6]}:{v}", role
+    return "ip:" + (req.client.host if req.client else "-"), role
+
+
+async def _chars(req):
+    """Count the characters a synthesis or push request asks for."""
+    if req.method == "GET":
+        return len(req.query_params.get("text") or "")
+    try:
+        j = await req.json()
+    except Exception:
+        return 0
+    if not isinstance(j, dict):
+        return 0
+    n = len(j.get("text") or "")
+    for p in j.get("parts") or []:
+        if isinstance(p, dict):
+            n += len(p.get("text") or "")
+    return n
+
+
+def throttle():
+    async def dep(req: Request):
+        rl = ratelimit.get_limiter()
+        if rl is None:
+            return
+        ident, role = _caller(req)
+        wait = rl.check(ident, role, await _chars(req))
+        if wait:
+            raise HTTPException(
+                429, "rate limited", headers={"Retry-After": str(math.ceil(wait))}
+            )
+
+    return Depends(dep)
+
+
 def need(role):
     async def dep(req: Request):
         import tts as eng
@@ -66,7 +251,7 @@ def need(role):
             return
         if k:
             try:
-                pl = jwt.decode(k, req.app.state.jwt_secret, algorithms=["HS256"])
+                pl = authcache.verify(k, req.app.state.jwt_secret)
             except jwt.ExpiredSignatureError:
                 raise HTTPException(401, "token expired")
             except Exception:
@@ -75,8 +260,7 @@ def need(role):
                 jti = pl.get("jti")
                 roles = pl.get("roles") or []
                 if role in roles:
-                    tk = db.get_token(jti)
-                    if tk and tk.get("revoked"):
+                    if authcache.is_revoked(jti):
                         raise HTTPException(401, "revoked")
                     return
         raise HTTPException(401, "unauthorized")
@@ -86,7 +270,6 @@ def need(role):
 
 def make_app(cfg, config_path: str | None = None):
     global app, Q
-    Q = deque(maxlen=256)
 
     # derive base dir from provided config_path when available
     config_dir = None
@@ -117,13 +300,26 @@ def make_app(cfg, config_path: str | None = None):
                 continue
     app = FastAPI(title="tts")
     app.state.config_dir = config_dir
+    metrics.gauge(
+        "push_queue_depth", "Jobs waiting in the push queue", fn=lambda: len(Q)
+    )
     eng.init(cfg, base_dir=config_dir)
+    Q = shared.queue("push", 256)
+    ratelimit.init_ratelimit(cfg)
+    dedupe.init_dedupe(cfg)
     sd = cfg.get(
         "sounds_dir",
         os.path.join(os.path.dirname(__file__), "..", "sounds"),
     )
     if os.path.isdir(sd):
-        app.mount("/sounds", StaticFiles(directory=sd), name="sounds")
+        ma = int(cfg.get("sounds_max_age_s", 86400))
+        app.mount(
+            "/sounds",
+            CachedStaticFiles(
+                directory=sd, cache_control=f"public, max-age={ma}, immutable"
+            ),
+            name="sounds",
+        )
 
     s = cfg.get("session") or {}
     app.state.cfg = cfg
@@ -142,6 +338,18 @@ def make_app(cfg, config_path: str | None = None):
             os.path.join(os.path.dirname(__file__), "private", "data", "tts.db"),
         )
     )
+    authcache.init_authcache(cfg)
+    rt = router.init_router(cfg)
+    if rt:
+        app.router.add_event_handler("startup", rt.start)
+        app.router.add_event_handler("shutdown", rt.stop)
+    else:
+        app.router.add_event_handler("startup", eng.start_warmup)
+        app.router.add_event_handler("shutdown", eng.flush_usage)
+    db.start_sweeper(
+        float(cfg.get("retention_sweep_s", 3600)),
+        float(cfg.get("token_retention_s", 86400)),
+    )
     app.state.jwt_secret = cfg.get("jwt_secret") or sec.ensure_jwt_secret(
         secrets_file, base_dir=config_dir
     )
@@ -185,9 +393,19 @@ def make_app(cfg, config_path: str | None = None):
         sfx.del_sfx_alias(name)
         return {"aliases": sfx.get_sfx_aliases()}
 
-    @r.post("/tts_batch", dependencies=[need("tts")])
+    @r.post("/tts_batch", dependencies=[need("tts"), throttle()])
     async def tts_batch(req: Request):
         j = await req.json()
+        if rt:
+            p = next((p for p in j.get("parts") or [] if "text" in p), None)
+            return await run_in_threadpool(
+                _proxy, req, rt, eng.route_voice(j, p), json=j
+            )
+        if j.get("text") and not j.get("parts"):
+            try:
+                j["parts"] = eng._prepare(j["text"])[0]
+            except RuntimeError:
+                raise HTTPException(400, "empty parts")
         parts = j.get("parts") or []
         fmt = (j.get("format") or "mp3").lower()
         norm = bool(
@@ -196,81 +414,43 @@ def make_app(cfg, config_path: str | None = None):
             else eng.cfg.get("normalize", False)
         )
 
-        ls = j.get("length_scale")
-        ns = j.get("noise_scale")
-        nw = j.get("noise_w")
-        ss = j.get("sentence_silence")
-        spk = j.get("speaker_id")
-
-        segs, rm, sfx_count = [], [], 0
-        try:
-            for p in parts:
-                if "sfx" in p:
-                    if sfx_count > MAX_SOUNDS:
-                        continue
-                    _, ap = sfx._resolve_sfx(p.get("sfx"), cfg)
-                    if not ap:
-                        continue
-                    wav48 = eng._to_48k_mono_wav(ap)
-                    segs.append(wav48)
-                    if wav48 != ap:
-                        rm.append(wav48)
-                    sfx_count += 1
-                else:
-                    txt = (p.get("text") or "").strip()
-                    if not txt:
-                        continue
-                    reqv = (p.get("voice") or "").strip()
-                    vid, _ = eng._resolve_voice_id(reqv)
-                    wav, tmp = eng._render_tts_wav(txt, vid, ls, ns, nw, ss, spk, norm)
-                    rm += tmp
-                    wav48 = eng._to_48k_mono_wav(wav)
-                    segs.append(wav48)
-                    if wav48 != wav:
-                        rm.append(wav48)
-
-            if not segs:
-                raise HTTPException(400, "empty parts")
+        br = j.get("bitrate") or eng._bitrate(fmt)
 
-            b, m = eng._concat_wavs(segs, fmt=fmt, bitrate=j.get("bitrate"))
-            rid = uuid.uuid4().hex[:8]
-            h = {
-                "Content-Disposition": f'inline; filename="batch-{rid}.{"mp3" if m=="audio/mpeg" else "wav"}"',
-                "Cache-Control": "no-store",
-            }
-            return Response(content=b, media_type=m, headers=h)
-        finally:
-            for pth in rm:
+        def render():
+            eng._note_usage({eng._params(j, p)[0] for p in parts if "text" in p})
+            with timing.trace() as tr:
                 try:
-                    os.remove(pth)
-                except:
-                    pass
+                    return eng.render_plan(j, parts, fmt, norm, br) + (tr,)
+                except RuntimeError as e:
+                    if str(e) == "empty audio":
+                        raise HTTPException(400, "empty parts")
+                    raise
+
+        # off the event loop, so concurrent requests can share a batch
+        b, m, st, tr = await run_in_threadpool(render)
+        rid = uuid.uuid4().hex[:8]
+        tr.log(rid)
+        h = {
+            "Content-Disposition": f'inline; filename="batch-{rid}.{eng._ext(m)}"',
+            "Cache-Control": "no-store",
+            "Server-Timing": tr.header(),
+            "X-Cache": st["cache"],
+            "X-Segments-Cached": f"{st['cached']}/{st['segments']}",
+        }
+        return Response(content=b, media_type=m, headers=h)
 
     @r.get("/peek", dependencies=[need("mod")])
     def peek():
-        if not Q:
+        it = Q.peek()
+        if it is None:
             return Response(status_code=204)
-        it = Q.popleft()
-        if not it.get("id"):
-            it["id"] = uuid.uuid4().hex[:8]
-        Q.appendleft(it)
         return dict(it)
 
     @r.delete("/queue/{qid}", dependencies=[need("mod")])
     def queue_delete(qid: str):
         if not qid:
             raise HTTPException(400, "bad id")
-        n = 0
-        tmp = []
-        while Q:
-            it = Q.popleft()
-            if str(it.get("id")) == str(qid):
-                n += 1
-            else:
-                tmp.append(it)
-        for it in tmp:
-            Q.append(it)
-        return {"deleted": n}
+        return {"deleted": Q.drop(qid)}
 
     @r.post("/panel/login")
     async def panel_login(req: Request):
@@ -511,6 +691,15 @@ def make_app(cfg, config_path: str | None = None):
     def healthz():
         return eng.health()
 
+    @r.get("/readyz")
+    def readyz():
+        if rt:
+            st = rt.snapshot()
+            st["ready"] = any(n["up"] for n in st["nodes"])
+        else:
+            st = eng.ready()
+        return JSONResponse(st, status_code=200 if st["ready"] else 503)
+
     @r.get("/voices", dependencies=[need("tts")])
     def voices():
         return eng.voices()
@@ -519,6 +708,31 @@ def make_app(cfg, config_path: str | None = None):
     def reload_voices():
         return {"reloaded": eng.reload()}
 
+    @r.get("/admin/profile", dependencies=[need("admin")])
+    def admin_profile(seconds: float = 10, hz: int = 100, format: str = "collapsed"):
+        try:
+            out = profiler.profile(seconds, hz, format)
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+        except RuntimeError as e:
+            raise HTTPException(409, str(e))
+        if format == "pstats":
+            return Response(
+                content=out,
+                media_type="application/octet-stream",
+                headers={"Content-Disposition": 'attachment; filename="tts.pstats"'},
+            )
+        return Response(content=out, media_type="text/plain; charset=utf-8")
+
+    @r.get("/admin/memprofile", dependencies=[need("admin")])
+    def admin_memprofile(seconds: float = 10, top: int = 25, frames: int = 1):
+        try:
+            return profiler.memory(seconds, top, frames)
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+        except RuntimeError as e:
+            raise HTTPException(409, str(e))
+
     @r.get("/aliases", dependencies=[need("admin")])
     def get_aliases():
         return eng.get_aliases()
@@ -538,14 +752,17 @@ def make_app(cfg, config_path: str | None = None):
         eng.del_alias((name or "").strip().lower())
         return eng.get_aliases()
 
-    @r.post("/tts", dependencies=[need("tts")])
+    @r.post("/tts", dependencies=[need("tts"), throttle()])
     async def tts_post(req: Request):
         j = await req.json()
-        b, m, h = eng.tts(j)
-        return Response(content=b, media_type=m, headers=h)
+        if rt:
+            return await run_in_threadpool(_proxy, req, rt, eng.route_voice(j), json=j)
+        b, m, h = await run_in_threadpool(eng.tts, j)
+        return _deliver(j, b, m, h)
 
-    @r.get("/tts", dependencies=[need("tts")])
+    @r.get("/tts", dependencies=[need("tts"), throttle()])
     def tts_get(
+        req: Request,
         text: str,
         voice: str | None = None,
         format: str | None = None,
@@ -557,16 +774,46 @@ def make_app(cfg, config_path: str | None = None):
         bitrate: str | None = None,
         speaker_id: int | None = None,
         preset: str | None = None,
+        delivery: str | None = None,
     ):
-        q = {k: v for k, v in locals().items()}
+        q = {k: v for k, v in locals().items() if k != "req"}
+        if rt:
+            return _proxy(req, rt, eng.route_voice(q), params=req.query_params)
         b, m, h = eng.tts(q)
-        return Response(content=b, media_type=m, headers=h)
+        return _deliver(q, b, m, h)
+
+    @r.api_route("/audio/{name}", methods=["GET", "HEAD"])
+    def audio(req: Request, name: str):
+        if rt:
+            return _proxy(req, rt, None)
+        hit = eng.get_audio(name)
+        if not hit:
+            raise HTTPException(404, "audio not found")
+        b, m = hit
+        return _audio_response(req, b, m, '"' + name.split(".", 1)[0] + '"')
+
+    @r.get("/router", dependencies=[need("admin")])
+    def router_get():
+        if not rt:
+            raise HTTPException(404, "not a router")
+        return rt.snapshot()
+
+    @r.post("/router/nodes", dependencies=[need("admin")])
+    async def router_nodes(req: Request):
+        if not rt:
+            raise HTTPException(404, "not a router")
+        j = await req.json()
+        nodes = j.get("nodes")
+        if not isinstance(nodes, list) or not all(isinstance(n, str) for n in nodes):
+            raise HTTPException(400, "nodes must be a list of urls")
+        rt.set_nodes(nodes)
+        return rt.snapshot()
 
     @r.get("/metrics")
-    def metrics():
+    def metrics_json():
         return eng.metrics()
 
-    @r.post("/push", dependencies=[need("push")])
+    @r.post("/push", dependencies=[need("push"), throttle()])
     async def push(req: Request):
         try:
             j = await req.json()
@@ -583,14 +830,27 @@ def make_app(cfg, config_path: str | None = None):
         import uuid
 
         j["id"] = j.get("id") or uuid.uuid4().hex[:8]
+        dd = dedupe.get_deduper()
+        first = dd.check(eng._san(t), j["id"]) if dd else None
+        if first:
+            return {"ok": True, "deduped": True, "id": first, "queued": len(Q)}
         Q.append(j)
+        PUSHES.inc()
         return {"ok": True, "id": j["id"], "queued": len(Q)}
 
     @r.get("/pull", dependencies=[need("pull")])
-    def pull():
-        if not Q:
+    def pull(n: int | None = None):
+        if n is not None:
+            # several jobs at once, so an overlay can render ahead of playback
+            js = Q.take_many(max(1, min(n, PULL_MAX)))
+            if not js:
+                return Response(status_code=204)
+            for it in js:
+                it["id"] = it.get("id") or uuid.uuid4().hex[:8]
+            return {"jobs": js, "queued": len(Q)}
+        it = Q.take()
+        if it is None:
             return Response(status_code=204)
-        it = Q.popleft()
         if not it.get("id"):
             it["id"] = uuid.uuid4().hex[:8]
         return it
@@ -606,13 +866,12 @@ def make_app(cfg, config_path: str | None = None):
             html = f.read()
         if not embed:
             return HTMLResponse(html)
-        em = db.get_embed(embed)
+        em, tk = authcache.get_embed(embed)
         if not em:
             raise HTTPException(404, "embed not found")
-        tk = db.get_token(em.get("jti"))
         if not tk:
             raise HTTPException(404, "token not found")
-        if tk.get("revoked"):
+        if tk.get("revoked") or authcache.is_revoked(tk.get("jti")):
             raise HTTPException(401, "revoked")
         if tk.get("expires", 0) < int(time.time()):
             raise HTTPException(401, "expired")
@@ -675,11 +934,15 @@ def make_app(cfg, config_path: str | None = None):
         if not em:
             raise HTTPException(404, "embed not found")
         db.delete_embed(embed_id)
+        authcache.drop_embed(embed_id)
         return {"ok": True}
 
     @r.get("/overlay/tokens", dependencies=[need("admin")])
-    def overlay_list_tokens():
-        toks = db.list_tokens()
+    def overlay_list_tokens(limit: int = LIST_LIMIT, cursor: str | None = None):
+        try:
+            toks = db.list_tokens(_page_limit(limit), cursor)
+        except ValueError:
+            raise HTTPException(400, "bad cursor")
         out = []
         for t in toks:
             out.append(
@@ -691,14 +954,16 @@ def make_app(cfg, config_path: str | None = None):
                     "note": t["note"],
                 }
             )
-        return {"tokens": out}
+        return {"tokens": out, "next": _next_cursor(toks, limit)}
 
     @r.get("/overlay/embeds", dependencies=[need("admin")])
-    def overlay_list_embeds():
-        embeds = db.list_embeds()
+    def overlay_list_embeds(limit: int = LIST_LIMIT, cursor: str | None = None):
+        try:
+            embeds = db.list_embeds(_page_limit(limit), cursor)
+        except ValueError:
+            raise HTTPException(400, "bad cursor")
         out = []
         for e in embeds:
-            tk = db.get_token(e.get("jti")) or {}
             out.append(
                 {
                     "embed_id": e.get("embed_id"),
@@ -706,11 +971,11 @@ def make_app(cfg, config_path: str | None = None):
                     "origin": e.get("origin"),
                     "created_at": e.get("created_at"),
                     "note": e.get("note"),
-                    "expires": tk.get("expires"),
-                    "revoked": tk.get("revoked", False),
+                    "expires": e.get("expires"),
+                    "revoked": e.get("revoked", False),
                 }
             )
-        return {"embeds": out}
+        return {"embeds": out, "next": _next_cursor(embeds, limit)}
 
     @r.delete("/overlay/token/{jti}", dependencies=[need("admin")])
     def overlay_revoke_token(jti: str):
@@ -762,6 +1027,12 @@ def make_app(cfg, config_path: str | None = None):
         return {"in": tx, "out": tx2, "flags": flags}
 
     app.include_router(r)
+
+    @app.get("/metrics")
+    def prometheus_metrics():
+        return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+    app.add_middleware(metrics.HTTPMetricsMiddleware)
     if os.path.isdir("public"):
         app.mount("/", StaticFiles(directory="public", html=True), name="ui")
     return app
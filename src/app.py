@@ -1,20 +1,96 @@
 import os
+import sys
+import time
+import signal
+import socket
 import argparse
+import shutil
+import tempfile
 
 import uvicorn
 
+import encoders
 from api import make_app
 from log import configure, logger
 from config import load_cfg
+from limiter import cpu_count
 from util import DEFAULT_HOST, DEFAULT_PORT
 
 DEFAULT_CFG = os.path.join(os.path.dirname(__file__), "private", "config.yaml")
 
+
+def _bind(host, port):
+    """Open the listening socket every worker accepts on."""
+    s = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((host, port))
+    s.listen(2048)
+    s.set_inheritable(True)
+    return s
+
+
+def serve_workers(app, host, port, n, log_level="info"):
+    """
+    Serve a preloaded app from n forked worker processes
+
+    The parent only supervises: it restarts workers that exit and forwards
+    SIGINT/SIGTERM to them on shutdown.
+    """
+    sock = _bind(host, port)
+    # the parent encodes nothing; each worker warms its own encoders
+    pool = encoders.get_pool()
+    if pool:
+        pool.close()
+    kids = {}
+    stopping = []
+
+    def spawn(i):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            c = uvicorn.Config(app, log_level=log_level)
+            uvicorn.Server(c).run(sockets=[sock])
+            sys.exit(0)
+        kids[pid] = (i, time.monotonic())
+        logger.info(f"[workers] worker {i} pid {pid}")
+
+    def stop(sig, _):
+        stopping.append(sig)
+        for pid in kids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for i in range(n):
+        spawn(i)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    logger.info(f"[workers] {n} workers on http://{host}:{port}")
+
+    while kids:
+        try:
+            pid, st = os.wait()
+        except ChildProcessError:
+            break
+        i, t0 = kids.pop(pid, (None, 0))
+        if i is None or stopping:
+            continue
+        logger.warning(f"[workers] worker {i} exited ({st}); restarting")
+        if time.monotonic() - t0 < 1:
+            time.sleep(1)
+        spawn(i)
+
+    sock.close()
+
+
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--cfg", default=os.getenv("CFG", DEFAULT_CFG))
     ap.add_argument("--host", default=DEFAULT_HOST)
     ap.add_argument("--port", type=int, default=DEFAULT_PORT)
+    ap.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "1")))
     ap.add_argument("--debug", action="store_true")
     a = ap.parse_args()
 
@@ -28,6 +104,25 @@ if __name__ == "__main__":
         logger.exception(f"failed to load config: {e}")
         raise
 
-    app = make_app(cfg, a.cfg)
+    level = "debug" if a.debug else "info"
+
+    if a.workers > 1:
+        # aliases, the push queue and caches must be seen by every worker,
+        # and each worker gets its share of the CPUs for synthesis
+        tmp = None
+        if not cfg.get("shared_store"):
+            tmp = tempfile.mkdtemp(prefix="tts-shared-")
+            cfg["shared_store"] = os.path.join(tmp, "shared.db")
+        if not cfg.get("concurrency_ceiling"):
+            cfg["concurrency_ceiling"] = max(1, cpu_count() // a.workers)
 
-    uvicorn.run(app, host=a.host, port=a.port, log_level="debug" if a.debug else "info")
+        app = make_app(cfg, a.cfg)
+        main = os.getpid()
+        try:
+            serve_workers(app, a.host, a.port, a.workers, level)
+        finally:
+            if tmp and os.getpid() == main:
+                shutil.rmtree(tmp, ignore_errors=True)
+    else:
+        app = make_app(cfg, a.cfg)
+        uvicorn.run(app, host=a.host, port=a.port, log_level=level)
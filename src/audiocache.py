@@ -0,0 +1,309 @@
+import os
+import time
+import socket
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import metrics
+from log import logger
+
+TIER_REQS = metrics.counter(
+    "tts_cache_tier_requests",
+    "Audio cache lookups by tier and result",
+    ("tier", "result"),
+)
+
+
+def _pack(v):
+    """Serialize a tuple of bytes/str/None, the shape of cached audio entries."""
+    out = [struct.pack(">I", len(v))]
+    for x in v:
+        if x is None:
+            out.append(b"n" + struct.pack(">I", 0))
+            continue
+        t, b = (b"b", x) if isinstance(x, bytes) else (b"s", str(x).encode())
+        out += [t, struct.pack(">I", len(b)), b]
+    return b"".join(out)
+
+
+def _unpack(b):
+    (n,), i, out = struct.unpack_from(">I", b), 4, []
+    for _ in range(n):
+        t = b[i : i + 1]
+        (ln,) = struct.unpack_from(">I", b, i + 1)
+        x = b[i + 5 : i + 5 + ln]
+        i += 5 + ln
+        out.append(None if t == b"n" else x if t == b"b" else x.decode())
+    return tuple(out)
+
+
+def _name(ns, key):
+    return f"{ns}:" + hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+class DiskCache:
+    def __init__(self, d, ns, max_bytes, ttl):
+        """
+        Initialize a file-per-entry cache in d
+
+        Entries expire ttl seconds after they were written; past max_bytes
+        the least recently used files are removed. Several processes may
+        share d, each keeping its own approximate size index.
+        """
+        self.dir = os.path.join(d, ns)
+        self.ns = ns
+        self.max_bytes = int(max_bytes)
+        self.ttl = ttl
+        self._idx = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.dir, exist_ok=True)
+
+        fs = []
+        for f in os.listdir(self.dir):
+            try:
+                st = os.stat(os.path.join(self.dir, f))
+            except OSError:
+                continue
+            fs.append((st.st_mtime, f, st.st_size))
+        for _, f, n in sorted(fs):
+            self._idx[f] = n
+            self._size += n
+
+    def _path(self, key):
+        return os.path.join(self.dir, _name(self.ns, key).split(":", 1)[1])
+
+    def get(self, key, default=None):
+        p = self._path(key)
+        try:
+            if os.stat(p).st_mtime + self.ttl < time.time():
+                self._drop(os.path.basename(p))
+                return default
+            with open(p, "rb") as f:
+                v = _unpack(f.read())
+        except (OSError, struct.error):
+            return default
+        with self._lock:
+            if os.path.basename(p) in self._idx:
+                self._idx.move_to_end(os.path.basename(p))
+        return v
+
+    def __setitem__(self, key, v):
+        p = self._path(key)
+        b = _pack(v)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(b)
+            os.replace(tmp, p)
+        except OSError as e:
+            logger.warning(f"[audiocache] disk write failed: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+
+        f = os.path.basename(p)
+        old = []
+        with self._lock:
+            self._size += len(b) - self._idx.pop(f, 0)
+            self._idx[f] = len(b)
+            while self._size > self.max_bytes and len(self._idx) > 1:
+                g, n = self._idx.popitem(last=False)
+                self._size -= n
+                old.append(g)
+        for g in old:
+            try:
+                os.remove(os.path.join(self.dir, g))
+            except OSError:
+                pass
+
+    def _drop(self, f):
+        with self._lock:
+            self._size -= self._idx.pop(f, 0)
+        try:
+            os.remove(os.path.join(self.dir, f))
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(self._idx)
+
+
+class RespError(Exception):
+    pass
+
+
+class RespCache:
+    def __init__(self, url, ns, ttl, timeout=0.5, retry_s=5.0):
+        """
+        Initialize a cache on a Redis-compatible server
+
+        Only GET, SET with PX, SELECT and AUTH are used, so any server
+        speaking that RESP subset works. Connection errors count as misses
+        and the server is skipped for retry_s before trying again.
+
+        :param url: redis://[:password@]host[:port][/db]
+        """
+        u = urlparse(url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.password = u.password
+        self.db = int((u.path or "/0").strip("/") or 0)
+        self.ns = ns
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry_s = retry_s
+        self._down_until = 0.0
+        self._local = threading.local()
+
+    def _conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is not None and c[2] == os.getpid():
+            return c
+        s = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        c = self._local.conn = (s, s.makefile("rb"), os.getpid())
+        if self.password:
+            self._call(c, "AUTH", self.password)
+        if self.db:
+            self._call(c, "SELECT", self.db)
+        return c
+
+    def _call(self, c, *args):
+        out = [b"*%d\r\n" % len(args)]
+        for a in args:
+            a = a if isinstance(a, bytes) else str(a).encode()
+            out += [b"$%d\r\n" % len(a), a, b"\r\n"]
+        c[0].sendall(b"".join(out))
+        return self._read(c[1])
+
+    def _read(self, f):
+        line = f.readline()
+        if not line.endswith(b"\r\n"):
+            raise OSError("connection closed")
+        t, rest = line[:1], line[1:-2]
+        if t == b"+":
+            return rest.decode()
+        if t == b"-":
+            raise RespError(rest.decode())
+        if t == b":":
+            return int(rest)
+        if t == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            b = f.read(n + 2)
+            if len(b) != n + 2:
+                raise OSError("connection closed")
+            return b[:n]
+        if t == b"*":
+            n = int(rest)
+            return None if n < 0 else [self._read(f) for _ in range(n)]
+        raise RespError(f"bad reply {line[:20]!r}")
+
+    def cmd(self, *args):
+        """
+        Run one command
+
+        :return: The reply, or None if the server is unavailable
+        """
+        if time.monotonic() < self._down_until:
+            return None
+        try:
+            return self._call(self._conn(), *args)
+        except (OSError, RespError) as e:
+            c = getattr(self._local, "conn", None)
+            self._local.conn = None
+            if c:
+                c[0].close()
+            self._down_until = time.monotonic() + self.retry_s
+            logger.warning(f"[audiocache] {self.host}:{self.port} unavailable: {e}")
+            return None
+
+    def get(self, key, default=None):
+        b = self.cmd("GET", _name(self.ns, key))
+        if not b:
+            return default
+        try:
+            return _unpack(b)
+        except struct.error:
+            return default
+
+    def __setitem__(self, key, v):
+        self.cmd("SET", _name(self.ns, key), _pack(v), "PX", int(self.ttl * 1000))
+
+
+class TieredCache:
+    def __init__(self, tiers, names):
+        """
+        Initialize a cache that looks through tiers in order
+
+        A hit in a lower tier is copied into the tiers above it, and writes
+        go to every tier. Size and TTL are reported from the first tier.
+
+        :param tiers: Caches with get(key, default) and item assignment
+        :param names: Tier names for metrics
+        """
+        self.tiers = tiers
+        self.names = names
+        self.maxsize = getattr(tiers[0], "maxsize", 0)
+        self.ttl = getattr(tiers[0], "ttl", 0)
+
+    def get(self, key, default=None):
+        for i, t in enumerate(self.tiers):
+            v = t.get(key)
+            if v is not None:
+                TIER_REQS.inc(self.names[i], "hit")
+                for u in self.tiers[:i]:
+                    u[key] = v
+                return v
+            TIER_REQS.inc(self.names[i], "miss")
+        return default
+
+    def __getitem__(self, key):
+        v = self.get(key)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def __setitem__(self, key, v):
+        for t in self.tiers:
+            t[key] = v
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.tiers[0])
+
+
+def tiered(first, cfg, ns, ttl):
+    """
+    Put the configured disk and network tiers below a first-level cache
+
+    :param first: The in-process (or shared store) cache
+    :param ns: Namespace keeping render and audio entries apart
+    :return: first itself when cache_tiers is empty
+    """
+    tiers, names = [first], ["memory"]
+    for t in cfg.get("cache_tiers") or []:
+        if t == "disk":
+            d = cfg.get("cache_disk_dir") or os.path.join(
+                tempfile.gettempdir(), "tts-cache"
+            )
+            mb = float(cfg.get("cache_disk_max_mb", 512))
+            tiers.append(DiskCache(d, ns, mb * 2**20, ttl))
+        elif t == "resp":
+            url = cfg.get("cache_resp_url", "redis://127.0.0.1:6379/0")
+            tiers.append(RespCache(url, f"tts:{ns}", ttl))
+        else:
+            logger.warning(f"[audiocache] unknown tier {t!r}")
+            continue
+        names.append(t)
+    return first if len(tiers) == 1 else TieredCache(tiers, names)
@@ -0,0 +1,143 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import jwt
+
+import db
+
+DEFAULT_SIZE = 1024
+DEFAULT_SYNC_S = 2.0
+
+
+class LRU:
+    def __init__(self, maxsize=DEFAULT_SIZE):
+        """
+        Initialize a bounded, thread-safe LRU map
+
+        :param maxsize: Maximum number of entries kept
+        """
+        self.maxsize = max(1, int(maxsize))
+        self._d = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, k):
+        """Return the value for a key and mark it recently used."""
+        with self._lock:
+            v = self._d.get(k)
+            if v is not None:
+                self._d.move_to_end(k)
+            return v
+
+    def put(self, k, v):
+        """Store a value, evicting the least recently used entry when full."""
+        with self._lock:
+            self._d[k] = v
+            self._d.move_to_end(k)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+    def pop(self, k):
+        """Remove a key if present."""
+        with self._lock:
+            self._d.pop(k, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._d.clear()
+
+    def __len__(self):
+        return len(self._d)
+
+
+_claims = LRU()
+_embeds = LRU()
+_sync_s = DEFAULT_SYNC_S
+_last_sync = 0.0
+
+
+def init_authcache(cfg):
+    """Initialize the claim and embed caches from config."""
+    global _claims, _embeds, _sync_s, _last_sync
+    n = int(cfg.get("token_cache_size", DEFAULT_SIZE))
+    _claims = LRU(n)
+    _embeds = LRU(n)
+    _sync_s = float(cfg.get("revocation_sync_s", DEFAULT_SYNC_S))
+    _last_sync = time.monotonic()
+
+
+def _hash(token, secret):
+    """Hash a token together with the secret it was verified against."""
+    return hashlib.sha256(f"{secret}\0{token}".encode("utf-8")).hexdigest()
+
+
+def verify(token, secret):
+    """
+    Decode an HS256 JWT, reusing cached claims until the token expires
+
+    :param token: Encoded JWT
+    :param secret: Signing secret
+    :return: Claims dict
+    """
+    h = _hash(token, secret)
+    pl = _claims.get(h)
+
+    if pl is None:
+        pl = jwt.decode(token, secret, algorithms=["HS256"])
+        _claims.put(h, pl)
+        return pl
+
+    exp = pl.get("exp")
+    if exp is not None and int(exp) <= time.time():
+        _claims.pop(h)
+        raise jwt.ExpiredSignatureError("Signature has expired")
+
+    return pl
+
+
+def _maybe_sync():
+    """Pick up revocations written by other worker processes."""
+    global _last_sync
+    now = time.monotonic()
+    if now - _last_sync < _sync_s:
+        return
+
+    _last_sync = now
+    if db.sync_revoked():
+        _embeds.clear()
+
+
+def is_revoked(jti):
+    """Check whether a token jti has been revoked."""
+    _maybe_sync()
+    return db.is_revoked(jti)
+
+
+def get_embed(embed_id):
+    """
+    Look up an embed and its token, caching the pair in memory
+
+    :param embed_id: Embed id
+    :return: Tuple of (embed, token) dicts, or (None, None) / (embed, None)
+    """
+    _maybe_sync()
+    hit = _embeds.get(embed_id)
+    if hit is not None:
+        return hit
+
+    em = db.get_embed(embed_id)
+    if not em:
+        return None, None
+
+    tk = db.get_token(em.get("jti"))
+    if tk:
+        _embeds.put(embed_id, (em, tk))
+
+    return em, tk
+
+
+def drop_embed(embed_id):
+    """Forget a cached embed."""
+    _embeds.pop(embed_id)
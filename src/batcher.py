@@ -0,0 +1,111 @@
+import time
+import threading
+
+import metrics
+
+BATCH_SIZE = metrics.histogram(
+    "tts_batch_size",
+    "Requests per synthesis batch",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32),
+)
+BATCH_WAIT = metrics.histogram(
+    "tts_batch_wait_seconds", "Time a request waited for its batch to start"
+)
+
+
+class _Item:
+    __slots__ = ("payload", "t", "ev", "lead", "done", "result", "exc")
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.t = time.perf_counter()
+        self.ev = threading.Event()
+        self.lead = False
+        self.done = False
+        self.result = None
+        self.exc = None
+
+
+class MicroBatcher:
+    def __init__(self, run, window_ms=10, max_batch=8):
+        """
+        Initialize a batcher that groups concurrent requests by key
+
+        The first request for a key waits up to window_ms for others with the
+        same key, then runs them all with one call. Callers block until their
+        own result is ready.
+
+        :param run: Callable (key, payloads) -> results in the same order
+        :param window_ms: How long the first request of a batch waits
+        :param max_batch: Batch size that starts a batch without waiting
+        """
+        self.run = run
+        self.window = max(0.0, float(window_ms)) / 1000
+        self.max_batch = max(1, int(max_batch))
+        self._pending = {}
+        self._cv = threading.Condition()
+
+    def submit(self, key, payload):
+        """
+        Run payload as part of a batch for key
+
+        :return: The result for payload
+        :raise: Whatever run raised for the batch
+        """
+        it = _Item(payload)
+        with self._cv:
+            q = self._pending.setdefault(key, [])
+            q.append(it)
+            if len(q) == 1:
+                it.lead = True
+            elif len(q) >= self.max_batch:
+                self._cv.notify_all()
+
+        while not it.done:
+            if it.lead:
+                it.lead = False
+                self._lead(key, it)
+            else:
+                it.ev.wait()
+                it.ev.clear()
+
+        if it.exc is not None:
+            raise it.exc
+        return it.result
+
+    def _lead(self, key, it):
+        end = it.t + self.window
+        with self._cv:
+            while len(self._pending[key]) < self.max_batch:
+                left = end - time.perf_counter()
+                if left <= 0:
+                    break
+                self._cv.wait(left)
+
+            q = self._pending[key]
+            batch, rest = q[: self.max_batch], q[self.max_batch :]
+            if rest:
+                self._pending[key] = rest
+                rest[0].lead = True
+                rest[0].ev.set()
+            else:
+                del self._pending[key]
+
+        now = time.perf_counter()
+        BATCH_SIZE.observe(len(batch))
+        for b in batch:
+            BATCH_WAIT.observe(now - b.t)
+
+        try:
+            res = self.run(key, [b.payload for b in batch])
+            if len(res) != len(batch):
+                raise RuntimeError("batch result count mismatch")
+            for b, r in zip(batch, res):
+                b.result = r
+        except Exception as e:
+            for b in batch:
+                b.exc = e
+        finally:
+            for b in batch:
+                b.done = True
+                b.ev.set()
@@ -1,51 +1,239 @@
 import os
+import re
+import glob
+import time
 import sqlite3
 import json
+import threading
+import weakref
+from contextlib import contextmanager
 
-SCHEMAS_DIR = os.path.join(os.path.dirname(__file__), "schemas")
+from log import logger
 
-_conn = None
+SCHEMAS_DIR = os.path.join(os.path.dirname(__file__), "schemas")
+BUSY_TIMEOUT_MS = 5000
+PREFIX_END = chr(0x10FFFF)
+
+_migration_re = re.compile(r"^migrate_(\d+)_.*\.sql$")
+
+_path = None
+_gen = 0
+_sql = {}
+_local = threading.local()
+_wlock = threading.RLock()
+_conns = {}
+_inherited = []
+_ver_conn = None
+_ver_lock = threading.Lock()
+_revoked = set()
+_data_ver = None
+_sweeper = None
+_sweeper_stop = threading.Event()
 
 
 def _schema(name):
-    """Read SQL schema file."""
-    with open(os.path.join(SCHEMAS_DIR, name), "r") as f:
-        return f.read()
+    """Return SQL schema text, read from disk at most once."""
+    s = _sql.get(name)
+    if s is None:
+        with open(os.path.join(SCHEMAS_DIR, name), "r") as f:
+            s = _sql[name] = f.read()
+    return s
+
+
+def _load_schemas():
+    """Read every SQL file in the schemas directory."""
+    for p in glob.glob(os.path.join(SCHEMAS_DIR, "*.sql")):
+        with open(p, "r") as f:
+            _sql[os.path.basename(p)] = f.read()
+
+
+def _connect():
+    """Open a connection with the pragmas every connection should use."""
+    c = sqlite3.connect(_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    c.row_factory = sqlite3.Row
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return c
+
+
+def _db():
+    """Return the calling thread's connection, opening it on first use."""
+    h = getattr(_local, "conn", None)
+    if h is not None and h.gen == _gen:
+        return h.c
+
+    if _path is None:
+        raise RuntimeError("db not initialized")
+
+    h = _Conn(_connect(), _gen)
+    # short-lived threads (executors, warmup) would otherwise leave their
+    # connection open; the thread's local holder dies with the thread
+    _conns[h.c] = weakref.finalize(h, _drop, h.c)
+    _local.conn = h
+    return h.c
+
+
+class _Conn:
+    __slots__ = ("c", "gen", "__weakref__")
+
+    def __init__(self, c, gen):
+        """Hold one thread's connection and the init generation it belongs to."""
+        self.c = c
+        self.gen = gen
+
+
+def _drop(c):
+    """Close a connection whose thread has exited."""
+    if _conns.pop(c, None) is not None:
+        try:
+            c.close()
+        except Exception:
+            pass
+
+
+def _write(name, params=()):
+    """Run a write statement, committing unless inside batch()."""
+    c = _db()
+    if getattr(_local, "batch", 0):
+        return c.execute(_schema(name), params)
+
+    with _wlock:
+        r = c.execute(_schema(name), params)
+        c.commit()
+    return r
+
+
+@contextmanager
+def batch():
+    """
+    Group writes on this thread into a single transaction
+
+    Writes made inside the block are committed once on exit, or rolled back
+    if the block raises.
+    """
+    c = _db()
+    depth = getattr(_local, "batch", 0)
+    if depth:
+        _local.batch = depth + 1
+        try:
+            yield c
+        finally:
+            _local.batch = depth
+        return
+
+    with _wlock:
+        _local.batch = 1
+        try:
+            yield c
+            c.commit()
+        except BaseException:
+            c.rollback()
+            raise
+        finally:
+            _local.batch = 0
+
+
+def _migrate(c):
+    """Apply schemas/migrate_NNN_*.sql files newer than the database's user_version."""
+    cur = c.execute("PRAGMA user_version").fetchone()[0]
+    todo = []
+
+    for name in _sql:
+        m = _migration_re.match(name)
+        if m and int(m.group(1)) > cur:
+            todo.append((int(m.group(1)), name))
+
+    for n, name in sorted(todo):
+        c.executescript(_schema(name))
+        c.execute(f"PRAGMA user_version={n}")
+        c.commit()
+
+
+def close():
+    """Close every connection opened by this module."""
+    global _ver_conn
+    for c, f in list(_conns.items()):
+        f.detach()
+        try:
+            c.close()
+        except Exception:
+            pass
+    _conns.clear()
+    if _ver_conn is not None:
+        _ver_conn.close()
+        _ver_conn = None
+
+
+def _after_fork():
+    """Give a forked worker its own connections and locks."""
+    global _local, _wlock, _conns, _ver_conn, _ver_lock, _gen
+    # the parent's connections are kept referenced, never closed, in the child
+    for c, f in _conns.items():
+        f.detach()
+        _inherited.append(c)
+    if _ver_conn is not None:
+        _inherited.append(_ver_conn)
+    _local = threading.local()
+    _wlock = threading.RLock()
+    _ver_lock = threading.Lock()
+    _conns = {}
+    _gen += 1
+    _ver_conn = _connect() if _path else None
+
+
+os.register_at_fork(after_in_child=_after_fork)
 
 
 def init_db(path):
     """Initialize database."""
-    global _conn
+    global _path, _gen, _ver_conn, _revoked, _data_ver
 
     d = os.path.dirname(path) or "."
     os.makedirs(d, exist_ok=True)
 
-    _conn = sqlite3.connect(path, check_same_thread=False)
-    _conn.row_factory = sqlite3.Row
+    close()
+    _load_schemas()
+    _path = path
+    _gen += 1
+
+    c = _db()
+    c.execute("PRAGMA journal_mode=WAL")
+    with _wlock:
+        c.execute(_schema("tokens_db.sql"))
+        c.execute(_schema("embeds_db.sql"))
+        c.commit()
+        _migrate(c)
 
-    c = _conn.cursor()
-    c.execute(_schema("tokens_db.sql"))
-    c.execute(_schema("embeds_db.sql"))
-    _conn.commit()
+    _ver_conn = _connect()
+    _revoked = _load_revoked()
+    _data_ver = _data_version()
 
 
 def insert_token(jti, roles, expires, created_by, created_at, note=""):
     """Insert a token."""
-    if _conn is None:
-        raise RuntimeError("db not initialized")
-
-    c = _conn.cursor()
-    c.execute(
-        _schema("insert_token.sql"),
+    _write(
+        "insert_token.sql",
         (jti, json.dumps(roles), int(expires), created_by, int(created_at), note),
     )
-    _conn.commit()
+
+
+def insert_tokens(rows):
+    """
+    Insert many tokens in one transaction
+
+    :param rows: Iterable of (jti, roles, expires, created_by, created_at, note)
+    """
+    vals = [
+        (jti, json.dumps(roles), int(expires), created_by, int(created_at), note)
+        for jti, roles, expires, created_by, created_at, note in rows
+    ]
+    with batch() as c:
+        c.executemany(_schema("insert_token.sql"), vals)
 
 
 def get_token(jti):
     """Get a token by jti."""
-    c = _conn.cursor()
-    r = c.execute(_schema("get_token.sql"), (jti,)).fetchone()
+    r = _db().execute(_schema("get_token.sql"), (jti,)).fetchone()
 
     if not r:
         return None
@@ -61,53 +249,118 @@ def get_token(jti):
     }
 
 
-def list_tokens():
-    """List all tokens."""
-    c = _conn.cursor()
-    rows = c.execute(_schema("list_tokens.sql")).fetchall()
+def _cursor(r):
+    """Encode a row's (created_at, rowid) as a pagination cursor."""
+    return f"{r['created_at']}:{r['rowid']}"
+
+
+def _page(name, limit, before):
+    """Run a keyset-paginated list query."""
+    if not before:
+        return _db().execute(_schema(name + ".sql"), (limit,)).fetchall()
+
+    try:
+        ca, rid = (int(x) for x in str(before).split(":", 1))
+    except ValueError:
+        raise ValueError("bad cursor")
+
+    return _db().execute(_schema(name + "_before.sql"), (ca, rid, limit)).fetchall()
+
+
+def list_tokens(limit=-1, before=None):
+    """
+    List tokens, newest first
+
+    :param limit: Maximum rows to return, -1 for all
+    :param before: Cursor from a previous page
+    :return: List of token dicts, each with a "cursor" for the next page
+    """
+    rows = _page("list_tokens", limit, before)
     out = []
 
     for r in rows:
-        out.append({
-            "jti": r["jti"],
-            "roles": json.loads(r["roles"]),
-            "expires": r["expires"],
-            "created_by": r["created_by"],
-            "created_at": r["created_at"],
-            "revoked": bool(r["revoked"]),
-            "note": r["note"],
-        })
+        out.append(
+            {
+                "cursor": _cursor(r),
+                "jti": r["jti"],
+                "roles": json.loads(r["roles"]),
+                "expires": r["expires"],
+                "created_by": r["created_by"],
+                "created_at": r["created_at"],
+                "revoked": bool(r["revoked"]),
+                "note": r["note"],
+            }
+        )
 
     return out
 
 
 def revoke_token(jti):
     """Revoke a token."""
-    c = _conn.cursor()
-    r = c.execute(_schema("revoke_token.sql"), (jti,))
-    _conn.commit()
+    r = _write("revoke_token.sql", (jti,))
+
+    if r.rowcount > 0:
+        _revoked.add(jti)
+
     return r.rowcount > 0
 
 
 def revoke_token_prefix(prefix):
     """Revoke tokens by prefix."""
-    c = _conn.cursor()
-    r = c.execute(_schema("revoke_token_prefix.sql"), (prefix + "%",))
-    _conn.commit()
+    rng = (prefix, prefix + PREFIX_END)
+    with batch() as c:
+        jtis = [r["jti"] for r in c.execute(_schema("find_token_prefix.sql"), rng)]
+        r = c.execute(_schema("revoke_token_prefix.sql"), rng)
+
+    _revoked.update(jtis)
+
     return r.rowcount > 0
 
 
+def _load_revoked():
+    """Load the set of revoked token jtis."""
+    return {r["jti"] for r in _db().execute(_schema("list_revoked.sql"))}
+
+
+def _data_version():
+    """Return the SQLite data version, which changes on commits from other connections."""
+    with _ver_lock:
+        return _ver_conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+def is_revoked(jti):
+    """Check a jti against the in-memory revocation set."""
+    return jti in _revoked
+
+
+def sync_revoked():
+    """
+    Reload the revocation set if another connection wrote to the database
+
+    :return: True if the set was reloaded
+    """
+    global _revoked, _data_ver
+    if _ver_conn is None:
+        return False
+
+    v = _data_version()
+    if v == _data_ver:
+        return False
+
+    _revoked = _load_revoked()
+    _data_ver = v
+
+    return True
+
+
 def insert_embed(embed_id, jti, created_at, note="", origin=None):
     """Insert an embed."""
-    c = _conn.cursor()
-    c.execute(_schema("insert_embed.sql"), (embed_id, jti, int(created_at), note, origin))
-    _conn.commit()
+    _write("insert_embed.sql", (embed_id, jti, int(created_at), note, origin))
 
 
 def get_embed(embed_id):
     """Get an embed by id."""
-    c = _conn.cursor()
-    r = c.execute(_schema("get_embed.sql"), (embed_id,)).fetchone()
+    r = _db().execute(_schema("get_embed.sql"), (embed_id,)).fetchone()
 
     if not r:
         return None
@@ -123,25 +376,106 @@ def get_embed(embed_id):
 
 def delete_embed(embed_id):
     """Delete an embed."""
-    c = _conn.cursor()
-    r = c.execute(_schema("delete_embed.sql"), (embed_id,))
-    _conn.commit()
+    r = _write("delete_embed.sql", (embed_id,))
     return r.rowcount > 0
 
 
-def list_embeds():
-    """List all embeds."""
-    c = _conn.cursor()
-    rows = c.execute(_schema("list_embeds.sql")).fetchall()
+def list_embeds(limit=-1, before=None):
+    """
+    List embeds joined with their token, newest first
+
+    :param limit: Maximum rows to return, -1 for all
+    :param before: Cursor from a previous page
+    :return: List of embed dicts with token "expires" and "revoked"
+    """
+    rows = _page("list_embeds", limit, before)
     out = []
 
     for r in rows:
-        out.append({
-            "embed_id": r["embed_id"],
-            "jti": r["jti"],
-            "created_at": r["created_at"],
-            "note": r["note"],
-            "origin": r["origin"],
-        })
+        out.append(
+            {
+                "cursor": _cursor(r),
+                "embed_id": r["embed_id"],
+                "jti": r["jti"],
+                "created_at": r["created_at"],
+                "note": r["note"],
+                "origin": r["origin"],
+                "expires": r["expires"],
+                "revoked": bool(r["revoked"]),
+            }
+        )
 
     return out
+
+
+def sweep_expired(cutoff):
+    """
+    Delete tokens that expired before cutoff, and their embeds
+
+    Revoked tokens are kept until they expire so the revocation set stays
+    authoritative for every token that could still verify.
+
+    :param cutoff: Unix time; tokens with expires < cutoff are removed
+    :return: Tuple of (tokens removed, embeds removed)
+    """
+    global _revoked
+    with batch() as c:
+        ne = c.execute(_schema("delete_expired_embeds.sql"), (int(cutoff),)).rowcount
+        nt = c.execute(_schema("delete_expired_tokens.sql"), (int(cutoff),)).rowcount
+
+    if nt or ne:
+        _revoked = _load_revoked()
+        c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    c.execute("PRAGMA optimize")
+
+    return nt, ne
+
+
+def add_voice_usage(counts, now):
+    """
+    Add request counts per voice
+
+    :param counts: {voice id: requests since the last call}
+    :param now: Unix time of the last request
+    """
+    rows = [(v, int(n), int(now)) for v, n in counts.items()]
+    with batch() as c:
+        c.executemany(_schema("add_voice_usage.sql"), rows)
+
+
+def top_voices(k):
+    """Return up to k voice ids, most requested first."""
+    return [r["voice"] for r in _db().execute(_schema("top_voices.sql"), (int(k),))]
+
+
+def start_sweeper(interval_s, retention_s):
+    """
+    Start a daemon thread that periodically removes expired tokens
+
+    :param interval_s: Seconds between sweeps
+    :param retention_s: Seconds to keep tokens after they expire
+    """
+    global _sweeper
+    stop_sweeper()
+    _sweeper_stop.clear()
+
+    def loop():
+        while not _sweeper_stop.wait(interval_s):
+            try:
+                nt, ne = sweep_expired(time.time() - retention_s)
+                if nt or ne:
+                    logger.info(f"[db] swept {nt} tokens, {ne} embeds")
+            except Exception as e:
+                logger.warning(f"[db] sweep failed: {e}")
+
+    _sweeper = threading.Thread(target=loop, name="db-sweeper", daemon=True)
+    _sweeper.start()
+
+
+def stop_sweeper():
+    """Stop the retention sweeper thread if running."""
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper_stop.set()
+        _sweeper.join(timeout=1)
+        _sweeper = None
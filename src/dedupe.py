@@ -0,0 +1,157 @@
+import re
+import time
+import threading
+from collections import deque
+
+import mod
+import metrics
+from log import logger
+
+SHINGLE = 3
+BAND = 4
+MIN_CHARS = 8
+
+DEDUPED = metrics.counter(
+    "push_deduped", "Pushed messages collapsed into an earlier job", ("match",)
+)
+
+_junk_re = re.compile(r"[^\w\s]+")
+_repeat_re = re.compile(r"(.)\1{2,}")
+
+
+def canon(s):
+    """Reduce a message to the form repeats are compared in."""
+    s = mod._normalize(s).lower()
+    s = _junk_re.sub(" ", s)
+    s = _repeat_re.sub(r"\1\1", s)
+    return " ".join(s.split())
+
+
+def sketch(s, k=32):
+    """
+    Return a one-permutation MinHash of s's character shingles
+
+    Each shingle is hashed once into one of k bins and every bin keeps its
+    smallest value; bins no shingle fell into are None.
+    """
+    out = [None] * k
+    for i in range(max(1, len(s) - SHINGLE + 1)):
+        h = hash(s[i : i + SHINGLE]) & 0xFFFFFFFFFFFF
+        b, v = h % k, h // k
+        if out[b] is None or v < out[b]:
+            out[b] = v
+    return tuple(out)
+
+
+def similarity(a, b):
+    """Estimate the Jaccard similarity of two texts from their sketches."""
+    same = full = 0
+    for x, y in zip(a, b):
+        if x is not None or y is not None:
+            full += 1
+            same += x == y
+    return same / full if full else 0.0
+
+
+class Deduper:
+    def __init__(self, window_s=30, threshold=0.8, k=32, max_items=512):
+        """
+        Initialize a detector of repeated messages within a time window
+
+        Exact repeats (after canon) are found by lookup; near repeats by
+        comparing MinHash sketches, but only with the messages that agree
+        on at least one band of BAND bins, so a check stays cheap however
+        full the window is.
+
+        :param window_s: How long a message suppresses its repeats
+        :param threshold: Estimated Jaccard similarity that counts as a repeat
+        :param k: Sketch size, a multiple of BAND; larger is more accurate
+        :param max_items: Messages kept in the window at most
+        """
+        self.window = window_s
+        self.threshold = threshold
+        self.k = k
+        self.max_items = max_items
+        self._items = deque()
+        self._exact = {}
+        self._post = {}
+        self._n = 0
+        self._lock = threading.Lock()
+
+    def _bands(self, sk):
+        bs = [(i, sk[i : i + BAND]) for i in range(0, len(sk), BAND)]
+        return [b for b in bs if b[1].count(None) < BAND]
+
+    def _expire(self, now):
+        while self._items and (
+            self._items[0][0] < now - self.window or len(self._items) >= self.max_items
+        ):
+            _, n, c, sk, qid = self._items.popleft()
+            if self._exact.get(c) == qid:
+                del self._exact[c]
+            for b in self._bands(sk) if sk else ():
+                p = self._post[b]
+                p.pop(n, None)
+                if not p:
+                    del self._post[b]
+
+    def _near(self, sk):
+        seen = set()
+        for b in self._bands(sk):
+            for n, (sk2, qid) in self._post.get(b, {}).items():
+                if n in seen:
+                    continue
+                seen.add(n)
+                if similarity(sk, sk2) >= self.threshold:
+                    return qid
+        return None
+
+    def check(self, text, qid):
+        """
+        Match a message against the window, remembering it if it is new
+
+        :return: Id of the earlier job it repeats, or None
+        """
+        c = canon(text)
+        sk = sketch(c, self.k) if len(c) >= MIN_CHARS else None
+        now = time.monotonic()
+
+        with self._lock:
+            self._expire(now)
+            hit = self._exact.get(c)
+            if hit:
+                DEDUPED.inc("exact")
+                return hit
+            hit = self._near(sk) if sk else None
+            if hit:
+                DEDUPED.inc("near")
+                return hit
+            self._n += 1
+            self._items.append((now, self._n, c, sk, qid))
+            self._exact[c] = qid
+            for b in self._bands(sk) if sk else ():
+                self._post.setdefault(b, {})[self._n] = (sk, qid)
+        return None
+
+
+_deduper = None
+
+
+def init_dedupe(cfg):
+    """Create the push deduper when push_dedupe is enabled."""
+    global _deduper
+    _deduper = None
+    if not cfg.get("push_dedupe"):
+        return None
+
+    _deduper = Deduper(
+        float(cfg.get("push_dedupe_window_s", 30)),
+        float(cfg.get("push_dedupe_threshold", 0.8)),
+    )
+    logger.info(f"[dedupe] window={_deduper.window}s threshold={_deduper.threshold}")
+    return _deduper
+
+
+def get_deduper():
+    """Get the push deduper, None when disabled."""
+    return _deduper
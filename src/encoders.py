@@ -0,0 +1,221 @@
+import os
+import time
+import atexit
+import threading
+import subprocess
+from collections import OrderedDict, deque
+
+import metrics
+from log import logger
+
+# format -> (encoder args, muxer)
+CODECS = {
+    "mp3": (["-codec:a", "libmp3lame"], "mp3"),
+    "opus": (["-codec:a", "libopus", "-application", "voip", "-ar", "48000"], "opus"),
+    "ogg": (["-codec:a", "libvorbis"], "ogg"),
+}
+
+SPAWNS = metrics.counter("subprocess_spawns", "External processes started", ("bin",))
+SPAWN_FAILS = metrics.counter(
+    "subprocess_failures", "External processes that exited non-zero", ("bin",)
+)
+SPAWN_TIME = metrics.histogram(
+    "subprocess_duration_seconds", "External process wall time", ("bin",)
+)
+CHECKOUTS = metrics.counter(
+    "encoder_pool_checkouts",
+    "Encoder processes taken from the pool, warm or spawned on demand",
+    ("format", "result"),
+)
+
+
+class EncoderPool:
+    def __init__(self, ffmpeg, size=2, max_keys=8, timeout=30):
+        """
+        Initialize a pool of pre-spawned ffmpeg encoders
+
+        Each process is started ahead of time for one (format, bitrate, rate,
+        channels) and blocks on stdin, so a request only pays for writing PCM
+        and reading the encoded bytes, not for ffmpeg start-up.
+
+        :param ffmpeg: Path to ffmpeg
+        :param size: Warm processes kept per key
+        :param max_keys: Keys kept warm, least recently used keys are dropped
+        :param timeout: Seconds allowed for one encode
+        """
+        self.ffmpeg = ffmpeg
+        self.size = max(0, int(size))
+        self.max_keys = max(1, int(max_keys))
+        self.timeout = timeout
+        self._idle = OrderedDict()
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _args(self, key):
+        fmt, br, sr, ch = key
+        codec, mux = CODECS[fmt]
+        return (
+            [self.ffmpeg, "-hide_banner", "-loglevel", "error"]
+            + ["-f", "s16le", "-ar", str(sr), "-ac", str(ch), "-i", "pipe:0"]
+            + codec
+            + ["-b:a", str(br), "-f", mux, "pipe:1"]
+        )
+
+    def _spawn(self, key):
+        SPAWNS.inc("ffmpeg")
+        return subprocess.Popen(
+            self._args(key),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def _take(self, key):
+        with self._lock:
+            q = self._idle.get(key)
+            if q is not None:
+                self._idle.move_to_end(key)
+            while q:
+                p = q.popleft()
+                if p.poll() is None:
+                    return p, True
+        return self._spawn(key), False
+
+    def _fill(self, key):
+        try:
+            while True:
+                with self._lock:
+                    if self._closed:
+                        return
+                    q = self._idle.setdefault(key, deque())
+                    self._idle.move_to_end(key)
+                    if len(q) >= self.size:
+                        break
+                p = self._spawn(key)
+                with self._lock:
+                    keep = not self._closed and self._idle.get(key) is q
+                    if keep:
+                        q.append(p)
+                if not keep:
+                    _kill(p)
+                    return
+        except Exception as e:
+            logger.warning(f"[encoders] spawn failed: {e}")
+
+        old = []
+        with self._lock:
+            while len(self._idle) > self.max_keys:
+                old += self._idle.popitem(last=False)[1]
+        for p in old:
+            _kill(p)
+
+    def warm(self, fmt, br, sr, ch=1):
+        """Start filling the pool for a key in the background."""
+        if fmt in CODECS and self.size:
+            key = (fmt, str(br), int(sr), int(ch))
+            with self._lock:
+                self._keys[key] = True
+                self._keys.move_to_end(key)
+                while len(self._keys) > self.max_keys:
+                    self._keys.popitem(last=False)
+            if self._closed:
+                return
+            threading.Thread(target=self._fill, args=(key,), daemon=True).start()
+
+    def encode(self, pcm, sr, ch, fmt, br):
+        """
+        Encode 16-bit little-endian PCM
+
+        :return: Encoded bytes
+        :raise RuntimeError: If the format is unknown or ffmpeg fails
+        """
+        if fmt not in CODECS:
+            raise RuntimeError("bad format")
+        key = (fmt, str(br), int(sr), int(ch))
+
+        p, hot = self._take(key)
+        CHECKOUTS.inc(fmt, "warm" if hot else "cold")
+        self.warm(fmt, br, sr, ch)
+
+        t0 = time.perf_counter()
+        try:
+            out, err = p.communicate(pcm, timeout=self.timeout)
+        except Exception:
+            _kill(p)
+            SPAWN_FAILS.inc("ffmpeg")
+            raise RuntimeError("encode failed")
+        finally:
+            SPAWN_TIME.observe(time.perf_counter() - t0, "ffmpeg")
+
+        if p.returncode != 0 or not out:
+            SPAWN_FAILS.inc("ffmpeg")
+            logger.warning(f"[encoders] {fmt} failed: {err[-200:]!r}")
+            raise RuntimeError("encode failed")
+
+        return out
+
+    def idle(self):
+        """Return the number of warm processes per format."""
+        with self._lock:
+            out = {}
+            for (fmt, *_), q in self._idle.items():
+                out[fmt] = out.get(fmt, 0) + len(q)
+            return out
+
+    def _after_fork(self):
+        # pipes to the parent's processes must not be shared, start our own
+        for p in [p for q in self._idle.values() for p in q]:
+            for f in (p.stdin, p.stdout, p.stderr):
+                try:
+                    f.close()
+                except OSError:
+                    pass
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+        self._closed = False
+        for key in list(self._keys):
+            self.warm(*key)
+
+    def close(self):
+        """
+        Stop every idle process and stop warming
+
+        The keys warmed so far are kept, so a process forked afterwards warms
+        them again for itself.
+        """
+        with self._lock:
+            self._closed = True
+            ps = [p for q in self._idle.values() for p in q]
+            self._idle.clear()
+        for p in ps:
+            _kill(p)
+
+
+def _kill(p):
+    try:
+        p.kill()
+        p.communicate(timeout=5)
+    except Exception:
+        pass
+
+
+_pool = None
+
+
+def init_encoders(ffmpeg, size=2):
+    """Replace the global encoder pool."""
+    global _pool
+    if _pool:
+        _pool.close()
+    _pool = EncoderPool(ffmpeg, size) if ffmpeg else None
+    return _pool
+
+
+def get_pool():
+    """Get the current encoder pool, None when ffmpeg is missing."""
+    return _pool
+
+
+atexit.register(lambda: _pool and _pool.close())
+os.register_at_fork(after_in_child=lambda: _pool and _pool._after_fork())
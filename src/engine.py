@@ -0,0 +1,239 @@
+import os
+import re
+import json
+import wave
+import atexit
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import timing
+import metrics
+from log import logger
+
+try:
+    import onnxruntime
+    from piper import PiperVoice
+    from piper.config import PiperConfig
+except ImportError:  # optional, the piper binary is used instead
+    PiperVoice = None
+
+_split_re = re.compile(r"(?<=[.!?])\s+")
+
+LOOKUPS = metrics.counter(
+    "tts_phoneme_cache_requests", "Phoneme cache lookups by result", ("result",)
+)
+
+
+class PhonemeCache:
+    def __init__(self, maxsize=20000, path=None, save_every=500):
+        """
+        Initialize an LRU of text chunk -> phoneme ids per voice language
+
+        :param maxsize: Maximum number of chunks kept
+        :param path: Optional JSON file the cache is loaded from and saved to
+        :param save_every: Save after this many new entries
+        """
+        self.maxsize = max(1, int(maxsize))
+        self.path = path
+        self.save_every = save_every
+        self._d = OrderedDict()
+        self._new = 0
+        self._lock = threading.Lock()
+
+    def get(self, lang, s):
+        """Return the cached id lists for a chunk, or None."""
+        with self._lock:
+            v = self._d.get((lang, s))
+            if v is not None:
+                self._d.move_to_end((lang, s))
+        LOOKUPS.inc("hit" if v is not None else "miss")
+        return v
+
+    def put(self, lang, s, ids):
+        """Cache the id lists for a chunk."""
+        with self._lock:
+            self._d[(lang, s)] = ids
+            self._d.move_to_end((lang, s))
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+            self._new += 1
+            due = self.path and self._new >= self.save_every
+        if due:
+            self.save()
+
+    def load(self):
+        """Load entries from path, oldest first; a missing or bad file is ignored."""
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                items = json.load(f).get("items", [])
+        except (OSError, ValueError) as e:
+            logger.warning(f"[phonemes] ignoring {self.path}: {e}")
+            return 0
+        with self._lock:
+            for lang, s, ids in items[-self.maxsize :]:
+                self._d[(lang, s)] = ids
+        return len(self._d)
+
+    def save(self):
+        """Write the cache to path atomically."""
+        if not self.path:
+            return
+        with self._lock:
+            items = [[k[0], k[1], v] for k, v in self._d.items()]
+            self._new = 0
+        d = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=d, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"items": items}, f, separators=(",", ":"))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"[phonemes] save failed: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(self._d)
+
+
+class Engine:
+    def __init__(self, cache, threads=None):
+        """
+        Initialize an in-process piper engine with a phoneme cache
+
+        :param cache: PhonemeCache
+        :param threads: Callable returning the inference threads for a voice
+                        session at load time, or None for onnxruntime's default
+        """
+        self.cache = cache
+        self.threads = threads
+        self._voices = {}
+        self._lock = threading.Lock()
+
+    def voice(self, info):
+        """Load (once) and return the PiperVoice for a scanned voice."""
+        m = info["model_path"]
+        v = self._voices.get(m)
+        if v is None:
+            with self._lock:
+                v = self._voices.get(m)
+                if v is None:
+                    t = self.threads() if self.threads else 0
+                    v = self._voices[m] = _load(info, t)
+        return v
+
+    def _lang(self, info, v):
+        # ids depend on the voice's id map as well as its language
+        lang = info.get("language")
+        if not isinstance(lang, str) or not lang:
+            lang = v.config.espeak_voice
+        h = hashlib.sha1(
+            json.dumps(v.config.phoneme_id_map, sort_keys=True).encode()
+        ).hexdigest()[:8]
+        return f"{lang}:{h}"
+
+    def phoneme_ids(self, info, text):
+        """Return one phoneme id list per sentence, phonemizing only cache misses."""
+        v = self.voice(info)
+        lang = self._lang(info, v)
+        out = []
+        for chunk in _split_re.split(text.strip()):
+            if not chunk:
+                continue
+            ids = self.cache.get(lang, chunk)
+            if ids is None:
+                ids = [v.phonemes_to_ids(p) for p in v.phonemize(chunk)]
+                self.cache.put(lang, chunk, ids)
+            out += ids
+        return out
+
+    def synthesize(self, info, text, out, ls=None, ns=None, nw=None, ss=None, spk=None):
+        """Render text to a 16-bit mono WAV file at out."""
+        with timing.span("phonemize"):
+            sents = self.phoneme_ids(info, text)
+
+        v = self.voice(info)
+        sr = v.config.sample_rate
+        gap = bytes(int((ss or 0.0) * sr) * 2)
+
+        with timing.span("infer"), wave.open(out, "wb") as w:
+            w.setframerate(sr)
+            w.setsampwidth(2)
+            w.setnchannels(1)
+            for ids in sents:
+                w.writeframes(
+                    v.synthesize_ids_to_raw(
+                        ids,
+                        speaker_id=spk,
+                        length_scale=ls,
+                        noise_scale=ns,
+                        noise_w=nw,
+                    )
+                    + gap
+                )
+
+
+def _load(info, threads=0):
+    mm = info.get("mapped_model")
+    o = onnxruntime.SessionOptions()
+    if threads:
+        # the default pool has a thread per core, which concurrent renders
+        # would oversubscribe
+        o.intra_op_num_threads = int(threads)
+    if mm:
+        # without prepacking onnxruntime keeps the mapped weights file as the
+        # only copy, so processes loading the same voice share its pages
+        o.add_session_config_entry("session.disable_prepacking", "1")
+    try:
+        with open(info["config_path"], "r", encoding="utf-8") as f:
+            c = PiperConfig.from_dict(json.load(f))
+        s = onnxruntime.InferenceSession(
+            mm or info["model_path"], sess_options=o, providers=["CPUExecutionProvider"]
+        )
+        return PiperVoice(session=s, config=c)
+    except TypeError:  # PiperVoice takes other fields in this piper-tts
+        logger.warning("[engine] cannot pass session options; using defaults")
+    return PiperVoice.load(mm or info["model_path"], config_path=info["config_path"])
+
+
+_engine = None
+
+
+def init_engine(cfg, path=None, threads=None):
+    """
+    Create the in-process engine when configured and piper-tts is installed
+
+    :param cfg: Config dict
+    :param path: Phoneme cache file, or None to keep it in memory
+    :param threads: Passed to Engine
+    """
+    global _engine
+    if _engine:
+        _engine.cache.save()
+    _engine = None
+
+    if cfg.get("engine", "subprocess") != "inprocess":
+        return None
+    if PiperVoice is None:
+        logger.warning("[engine] piper-tts not installed; using the piper binary")
+        return None
+
+    cache = PhonemeCache(int(cfg.get("phoneme_cache_size", 20000)), path)
+    n = cache.load()
+    _engine = Engine(cache, threads)
+    logger.info(f"[engine] in-process; {n} cached phoneme chunks")
+    return _engine
+
+
+def get_engine():
+    """Get the in-process engine, None when synthesis goes through the binary."""
+    return _engine
+
+
+atexit.register(lambda: _engine and _engine.cache.save())
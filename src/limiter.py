@@ -0,0 +1,141 @@
+import os
+import time
+import threading
+
+
+def cpu_count():
+    """Return the CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 1
+
+
+class CPUSampler:
+    def __init__(self, interval=1.0):
+        """Sample host CPU utilization from /proc/stat at most once per interval."""
+        self.interval = interval
+        self._last = None
+        self._t = 0.0
+        self._busy = None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        with open("/proc/stat", encoding="ascii") as f:
+            v = [int(x) for x in f.readline().split()[1:]]
+        return sum(v), v[3] + (v[4] if len(v) > 4 else 0)
+
+    def busy(self):
+        """Return the busy fraction over the last interval, None if unknown."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._t < self.interval:
+                return self._busy
+            self._t = now
+            try:
+                cur = self._read()
+            except (OSError, ValueError, IndexError):
+                return None
+            if self._last is not None:
+                dt, di = cur[0] - self._last[0], cur[1] - self._last[1]
+                if dt > 0:
+                    self._busy = 1.0 - di / dt
+            self._last = cur
+            return self._busy
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        initial=2,
+        floor=1,
+        ceiling=None,
+        tolerance=2.0,
+        backoff=0.8,
+        cpu_max=0.95,
+        cpu=None,
+    ):
+        """
+        Initialize an AIMD concurrency limit
+
+        The limit grows by one per limit-many completions while requests are
+        queueing, and shrinks by backoff when latency rises past tolerance
+        times the observed baseline or the CPU is saturated. Baselines are
+        kept per power-of-two size of the work, since a render has a fixed
+        cost per process and short texts are slower per character.
+
+        :param initial: Starting limit
+        :param floor: Lowest limit
+        :param ceiling: Highest limit, defaults to the CPU count
+        :param tolerance: Latency ratio over the baseline that counts as overload
+        :param backoff: Multiplier applied on overload
+        :param cpu_max: Host CPU busy fraction that counts as saturated
+        :param cpu: Optional CPUSampler
+        """
+        self.floor = max(1, int(floor))
+        self.ceiling = max(self.floor, int(ceiling or cpu_count()))
+        self.limit = float(min(max(initial, self.floor), self.ceiling))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.cpu_max = cpu_max
+        self.cpu = cpu
+        self.inflight = 0
+        self.waiting = 0
+        self.base = {}
+        self._since_drop = 0
+        self._cv = threading.Condition()
+
+    def acquire(self):
+        """Block until a permit is free."""
+        with self._cv:
+            self.waiting += 1
+            try:
+                while self.inflight >= int(self.limit):
+                    self._cv.wait()
+            finally:
+                self.waiting -= 1
+            self.inflight += 1
+
+    def release(self, sec=None, units=1, ok=True):
+        """
+        Return a permit and feed the controller
+
+        :param sec: Wall time of the work, None to skip adjusting
+        :param units: Size of the work (e.g. characters) to normalize latency
+        :param ok: False for failures, which count as overload
+        """
+        with self._cv:
+            self.inflight -= 1
+            if sec is not None:
+                self._update(sec, max(int(units), 1), ok)
+            self._cv.notify_all()
+
+    def _update(self, sec, units, ok):
+        # each baseline is a minimum that drifts up slowly so it follows load
+        # changes; work of similar size is compared only with itself
+        k = units.bit_length()
+        b = self.base.get(k)
+        b = self.base[k] = sec if b is None else min(b * 1.005, sec)
+        self._since_drop += 1
+
+        busy = self.cpu.busy() if self.cpu else None
+        over = not ok or sec > b * self.tolerance
+        over = over or (busy is not None and busy > self.cpu_max)
+
+        if over:
+            if self._since_drop >= self.limit:
+                self.limit = max(self.floor, self.limit * self.backoff)
+                self._since_drop = 0
+        elif self.waiting or self.inflight + 1 >= int(self.limit):
+            self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+
+    def snapshot(self):
+        """Return the controller state for health reports."""
+        with self._cv:
+            return {
+                "limit": int(self.limit),
+                "inflight": self.inflight,
+                "waiting": self.waiting,
+                "floor": self.floor,
+                "ceiling": self.ceiling,
+            }
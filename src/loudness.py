@@ -0,0 +1,200 @@
+import wave
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # optional, callers fall back to ffmpeg loudnorm
+    np = None
+
+TARGET_LUFS = -16.0
+PEAK_DB = -1.5
+BLOCK_S = 0.4
+HOP_S = 0.1
+LIMIT_BLOCK_S = 0.005
+SKIP_DB = 0.5
+
+
+def available():
+    """Check if the in-process normalizer can run (numpy installed)."""
+    return np is not None
+
+
+def read_wav(p):
+    """
+    Read a 16-bit PCM WAV file
+
+    :return: (float32 samples in [-1, 1], shaped (n,) or (n, channels), sample rate)
+             or None if the file is not 16-bit PCM
+    """
+    with wave.open(p, "rb") as w:
+        if w.getsampwidth() != 2 or w.getcomptype() != "NONE":
+            return None
+        ch, sr = w.getnchannels(), w.getframerate()
+        raw = w.readframes(w.getnframes())
+
+    x = np.frombuffer(raw, dtype="<i2").astype(np.float32) / 32768.0
+    return (x.reshape(-1, ch) if ch > 1 else x), sr
+
+
+def write_wav(p, x, sr):
+    """Write float samples as a 16-bit PCM WAV file."""
+    ch = 1 if x.ndim == 1 else x.shape[1]
+    pcm = np.clip(np.round(x * 32767.0), -32768, 32767).astype("<i2")
+    with wave.open(p, "wb") as w:
+        w.setnchannels(ch)
+        w.setsampwidth(2)
+        w.setframerate(sr)
+        w.writeframes(pcm.tobytes())
+
+
+def loudness(x, sr):
+    """
+    Estimate integrated loudness with BS.1770 style gating
+
+    Uses 400 ms blocks at 100 ms hops with the absolute (-70) and relative
+    (-10) gates, but no K-weighting filter, which is close enough for
+    speech and cheap.
+
+    :return: Loudness in LUFS, or None for silence
+    """
+    sq = x * x if x.ndim == 1 else (x * x).sum(axis=1)
+    n = len(sq)
+    if not n:
+        return None
+
+    win, hop = max(1, int(sr * BLOCK_S)), max(1, int(sr * HOP_S))
+    cs = np.concatenate(([0.0], np.cumsum(sq, dtype=np.float64)))
+    if n <= win:
+        p = np.array([cs[-1] / n])
+    else:
+        st = np.arange(0, n - win + 1, hop)
+        p = (cs[st + win] - cs[st]) / win
+
+    p = p[p > 0]
+    lk = -0.691 + 10 * np.log10(p) if len(p) else p
+    p = p[lk > -70]
+    if not len(p):
+        return None
+
+    rel = -0.691 + 10 * np.log10(p.mean()) - 10
+    p = p[-0.691 + 10 * np.log10(p) > rel]
+
+    return float(-0.691 + 10 * np.log10(p.mean()))
+
+
+def limit(x, ceil, sr):
+    """
+    Keep peaks under ceil with smooth per-block gain reduction
+
+    Gain is computed per 5 ms block, widened to the neighbouring blocks and
+    linearly interpolated, so no sample ends up above the ceiling.
+    """
+    a = np.abs(x) if x.ndim == 1 else np.abs(x).max(axis=1)
+    if not len(a) or a.max() <= ceil:
+        return x
+
+    n = max(1, int(sr * LIMIT_BLOCK_S))
+    nb = -(-len(a) // n)
+    pk = np.pad(a, (0, nb * n - len(a))).reshape(nb, n).max(axis=1)
+
+    g = np.minimum(1.0, ceil / np.maximum(pk, 1e-9))
+    g = np.minimum(g, np.minimum(np.r_[g[1:], 1.0], np.r_[1.0, g[:-1]]))
+    gs = np.interp(np.arange(len(a)), (np.arange(nb) + 0.5) * n, g)
+
+    return x * (gs if x.ndim == 1 else gs[:, None]).astype(np.float32)
+
+
+class GainTable:
+    def __init__(self, alpha=0.2, warm=3, refresh=16):
+        """
+        Initialize a table of learned gains
+
+        :param alpha: EMA weight of a new measurement
+        :param warm: Measurements needed before the learned gain is used alone
+        :param refresh: Re-measure every this many renders to follow drift
+        """
+        self.alpha = alpha
+        self.warm = warm
+        self.refresh = refresh
+        self._t = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the learned gain in dB, or None when it should be measured."""
+        if key is None:
+            return None
+        with self._lock:
+            e = self._t.get(key)
+            if not e or e[1] < self.warm:
+                return None
+            e[2] += 1
+            if e[2] % self.refresh == 0:
+                return None
+            return e[0]
+
+    def update(self, key, db):
+        """Fold a measured gain into the entry for key."""
+        if key is None:
+            return
+        with self._lock:
+            e = self._t.get(key)
+            if e is None:
+                self._t[key] = [db, 1, 0]
+            else:
+                e[0] += self.alpha * (db - e[0])
+                e[1] += 1
+
+    def snapshot(self):
+        """Return {key: (gain dB, measurements)}."""
+        with self._lock:
+            return {k: (round(e[0], 2), e[1]) for k, e in self._t.items()}
+
+    def __len__(self):
+        return len(self._t)
+
+
+def normalize(inp, out, key=None, table=None, target=TARGET_LUFS, peak_db=PEAK_DB):
+    """
+    Normalize a WAV file to a loudness target with peak limiting
+
+    With a warm entry in table for key, the learned gain is applied without
+    measuring, and the input is returned untouched (not even read) when
+    that gain is within SKIP_DB.
+
+    :param inp: Input WAV path
+    :param out: Output WAV path, written only when the audio changes
+    :return: (path of the result, mode) where mode is 'learned', 'measured',
+             'skipped' or 'silent'; None if the file cannot be handled here
+    """
+    g = table.get(key) if table is not None else None
+    if g is not None and abs(g) < SKIP_DB:
+        return inp, "skipped"
+
+    r = read_wav(inp)
+    if r is None:
+        return None
+    x, sr = r
+
+    mode = "learned"
+    if g is None:
+        lu = loudness(x, sr)
+        if lu is None:
+            return inp, "silent"
+        g = target - lu
+        if table is not None:
+            table.update(key, g)
+        mode = "measured"
+
+    ceil = 10 ** (peak_db / 20)
+    k = 10 ** (g / 20)
+    pk = float(np.abs(x).max()) if len(x) else 0.0
+
+    if abs(g) < SKIP_DB and pk <= ceil:
+        return inp, "skipped"
+
+    y = x * np.float32(k)
+    if pk * k > ceil:
+        y = limit(y, ceil, sr)
+    write_wav(out, y, sr)
+
+    return out, mode
@@ -0,0 +1,297 @@
+import time
+import bisect
+import threading
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def _esc(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{k}="{_esc(v)}"' for k, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _num(v):
+    if isinstance(v, bool):
+        return str(int(v))
+    if isinstance(v, float):
+        if v == float("inf"):
+            return "+Inf"
+        if v.is_integer() and abs(v) < 1e15:
+            return str(int(v))
+        return repr(v)
+    return str(v)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help="", labels=()):
+        """
+        Initialize a labeled, monotonically increasing counter
+
+        :param name: Metric name without the _total suffix
+        :param help: One line description
+        :param labels: Label names, values are passed positionally to inc()
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *lv, n=1):
+        """Add n to the series for the given label values."""
+        with self._lock:
+            self._series[lv] = self._series.get(lv, 0) + n
+
+    def value(self, *lv):
+        """Return the current value for the given label values."""
+        return self._series.get(lv, 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._series.items())
+        return [
+            f"{self.name}_total{_labels(self.labels, k)} {_num(v)}" for k, v in items
+        ]
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help="", labels=(), fn=None):
+        """
+        Initialize a labeled gauge
+
+        :param fn: Optional callable returning the current value (unlabeled)
+                   or a {label values: value} dict, read at exposition time
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def set(self, v, *lv):
+        """Set the series for the given label values."""
+        with self._lock:
+            self._series[lv] = v
+
+    def inc(self, *lv, n=1):
+        """Add n to the series for the given label values."""
+        with self._lock:
+            self._series[lv] = self._series.get(lv, 0) + n
+
+    def dec(self, *lv, n=1):
+        """Subtract n from the series for the given label values."""
+        self.inc(*lv, n=-n)
+
+    def value(self, *lv):
+        """Return the current value for the given label values."""
+        if self.fn is not None and not self.labels:
+            return self.fn()
+        return self._series.get(lv, 0)
+
+    def render(self):
+        if self.fn is not None:
+            try:
+                v = self.fn()
+            except Exception:
+                return []
+            items = sorted(v.items()) if isinstance(v, dict) else [((), v)]
+        else:
+            with self._lock:
+                items = sorted(self._series.items())
+        return [f"{self.name}{_labels(self.labels, k)} {_num(v)}" for k, v in items]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help="", labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Initialize a labeled histogram with fixed upper bounds
+
+        :param name: Metric name
+        :param help: One line description
+        :param labels: Label names, values are passed positionally to observe()
+        :param buckets: Sorted bucket upper bounds (+Inf is implicit)
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, v, *lv):
+        """Record one observation for the given label values."""
+        i = bisect.bisect_left(self.buckets, v)
+        with self._lock:
+            s = self._series.get(lv)
+            if s is None:
+                s = self._series[lv] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            s[0][i] += 1
+            s[1] += v
+            s[2] += 1
+
+    def series(self):
+        """Return {label values: (cumulative bucket counts, sum, count)}."""
+        with self._lock:
+            items = [(k, list(c), sm, n) for k, (c, sm, n) in self._series.items()]
+
+        out = {}
+        for k, c, sm, n in items:
+            acc, cum = 0, []
+            for x in c:
+                acc += x
+                cum.append(acc)
+            out[k] = (cum, sm, n)
+        return out
+
+    def quantile(self, q, cum, n):
+        """Estimate a quantile from cumulative bucket counts by linear interpolation."""
+        if not n:
+            return 0.0
+        rank = q * n
+        lo, prev = 0.0, 0
+        for i, c in enumerate(cum):
+            hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+            if c >= rank:
+                if c == prev:
+                    return hi
+                return lo + (hi - lo) * (rank - prev) / (c - prev)
+            lo, prev = hi, c
+        return self.buckets[-1]
+
+    def summary(self):
+        """Summarize each series as count, mean and p50/p95/p99 in milliseconds."""
+        out = {}
+        for k, (cum, sm, n) in self.series().items():
+            out[",".join(k) or "_"] = {
+                "count": n,
+                "avg_ms": round(sm / n * 1000, 2) if n else 0.0,
+                "p50_ms": round(self.quantile(0.5, cum, n) * 1000, 2),
+                "p95_ms": round(self.quantile(0.95, cum, n) * 1000, 2),
+                "p99_ms": round(self.quantile(0.99, cum, n) * 1000, 2),
+            }
+        return out
+
+    def render(self):
+        out = []
+        for k, (cum, sm, n) in sorted(self.series().items()):
+            for i, c in enumerate(cum):
+                le = _num(self.buckets[i]) if i < len(self.buckets) else "+Inf"
+                out.append(
+                    f"{self.name}_bucket{_labels(self.labels, k, ('le', le))} {c}"
+                )
+            out.append(f"{self.name}_sum{_labels(self.labels, k)} {_num(sm)}")
+            out.append(f"{self.name}_count{_labels(self.labels, k)} {n}")
+        return out
+
+
+def _get(cls, name, *a, **k):
+    with _lock:
+        m = _registry.get(name)
+        if m is None:
+            m = _registry[name] = cls(name, *a, **k)
+        return m
+
+
+def histogram(name, help="", labels=(), buckets=DEFAULT_BUCKETS):
+    """Get or create a registered histogram."""
+    return _get(Histogram, name, help, labels, buckets)
+
+
+def counter(name, help="", labels=()):
+    """Get or create a registered counter."""
+    return _get(Counter, name, help, labels)
+
+
+def gauge(name, help="", labels=(), fn=None):
+    """Get or create a registered gauge; a new fn replaces the old one."""
+    g = _get(Gauge, name, help, labels)
+    if fn is not None:
+        g.fn = fn
+    return g
+
+
+def render():
+    """Render every registered metric in OpenMetrics text format."""
+    with _lock:
+        ms = sorted(_registry.values(), key=lambda m: m.name)
+
+    out = []
+    for m in ms:
+        out.append(f"# TYPE {m.name} {m.kind}")
+        if m.help:
+            out.append(f"# HELP {m.name} {_esc(m.help)}")
+        out += m.render()
+    out.append("# EOF")
+
+    return "\n".join(out) + "\n"
+
+
+HTTP_REQUESTS = counter(
+    "http_requests",
+    "HTTP requests by route, method and status",
+    ("route", "method", "status"),
+)
+HTTP_LATENCY = histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("route",)
+)
+
+
+class HTTPMetricsMiddleware:
+    def __init__(self, app):
+        """Count and time HTTP requests by their matched route template."""
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        t0 = time.perf_counter()
+        status = [500]
+
+        async def snd(msg):
+            if msg["type"] == "http.response.start":
+                status[0] = msg["status"]
+            await send(msg)
+
+        try:
+            await self.app(scope, receive, snd)
+        finally:
+            rt = scope.get("route")
+            route = getattr(rt, "path", None) or "other"
+            HTTP_REQUESTS.inc(route, scope.get("method", ""), str(status[0]))
+            HTTP_LATENCY.observe(time.perf_counter() - t0, route)
@@ -0,0 +1,148 @@
+import os
+import hashlib
+import tempfile
+
+from log import logger
+
+try:
+    import onnx
+    from onnx import numpy_helper
+except ImportError:  # optional, models are then loaded as they are
+    onnx = None
+
+# offsets are page aligned so onnxruntime can map weights instead of reading them
+ALIGN = 65536
+MIN_BYTES = 4096
+_CLEAR = (
+    "raw_data",
+    "float_data",
+    "int32_data",
+    "int64_data",
+    "double_data",
+    "uint64_data",
+)
+
+
+def available():
+    """Check if models can be converted (onnx installed)."""
+    return onnx is not None
+
+
+def _key(p):
+    st = os.stat(p)
+    s = f"{os.path.abspath(p)}:{st.st_size}:{st.st_mtime_ns}"
+    return hashlib.sha1(s.encode()).hexdigest()[:12]
+
+
+def external(model, out_dir):
+    """
+    Return a copy of an ONNX model with its weights in a separate file
+
+    The weights file is what onnxruntime maps into memory, so every process
+    (and every piper run) using the voice shares one copy in the page cache
+    instead of each holding a private one. Conversions are kept in out_dir
+    and reused until the source model changes.
+
+    :param model: Path to the .onnx model
+    :param out_dir: Directory for converted models
+    :return: Path of the converted model, or None if it cannot be converted
+             or has no weights worth mapping
+    """
+    if onnx is None:
+        return None
+
+    try:
+        base = f"{os.path.splitext(os.path.basename(model))[0]}-{_key(model)}"
+        out = os.path.join(out_dir, base + ".onnx")
+        if os.path.exists(out):
+            return out
+
+        os.makedirs(out_dir, exist_ok=True)
+        m = onnx.load(model, load_external_data=False)
+        wname = base + ".weights"
+        fd, wtmp = tempfile.mkstemp(dir=out_dir, suffix=".tmp")
+        n = 0
+        with os.fdopen(fd, "wb") as f:
+            for t in m.graph.initializer:
+                if t.data_location == onnx.TensorProto.EXTERNAL:
+                    continue
+                if t.data_type == onnx.TensorProto.STRING:
+                    continue
+                b = numpy_helper.to_array(t).tobytes()
+                if len(b) < MIN_BYTES:
+                    continue
+
+                off = -(-f.tell() // ALIGN) * ALIGN
+                f.write(bytes(off - f.tell()))
+                f.write(b)
+                n += 1
+
+                for k in _CLEAR:
+                    t.ClearField(k)
+                t.data_location = onnx.TensorProto.EXTERNAL
+                del t.external_data[:]
+                for k, v in (("location", wname), ("offset", off), ("length", len(b))):
+                    e = t.external_data.add()
+                    e.key, e.value = k, str(v)
+
+        if not n:
+            os.remove(wtmp)
+            return None
+
+        fd, mtmp = tempfile.mkstemp(dir=out_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(m.SerializeToString())
+        os.replace(wtmp, os.path.join(out_dir, wname))
+        os.replace(mtmp, out)
+    except Exception as e:
+        logger.warning(f"[models] cannot convert {model}: {e}")
+        for p in (locals().get("wtmp"), locals().get("mtmp")):
+            if p and os.path.exists(p):
+                os.remove(p)
+        return None
+
+    logger.info(f"[models] {os.path.basename(model)} -> {out}")
+    return out
+
+
+def weights(model):
+    """Return the weights file next to a converted model, None if there is none."""
+    p = os.path.splitext(model)[0] + ".weights"
+    return p if os.path.exists(p) else None
+
+
+def prefetch(p):
+    """Ask the kernel to read a file into the page cache ahead of first use."""
+    try:
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except (OSError, AttributeError):
+        pass
+
+
+def mapped(paths, smaps="/proc/self/smaps"):
+    """
+    Measure how much of each file is mapped into a process
+
+    :param paths: Files to look for
+    :return: {path: {"rss_kb": resident, "pss_kb": proportional share}}; Pss
+             splits shared pages between the processes mapping them
+    """
+    want = {os.path.realpath(p): p for p in paths}
+    out = {p: {"rss_kb": 0, "pss_kb": 0} for p in paths}
+    cur = None
+    try:
+        with open(smaps, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if line[0] in "0123456789abcdef":
+                    parts = line.split(None, 5)
+                    cur = want.get(parts[5].strip()) if len(parts) > 5 else None
+                elif cur and line.startswith(("Rss:", "Pss:")):
+                    k = "rss_kb" if line[0] == "R" else "pss_kb"
+                    out[cur][k] += int(line.split()[1])
+    except OSError:
+        pass
+    return out
@@ -0,0 +1,74 @@
+import re
+
+SPEEDS = {"fast": 0.5, "slow": 2.0}
+
+# the scan stops only at brackets and colons; names are read back from a colon
+_tok_re = re.compile(r"\[([^\[\]]*)\]|:(?!//)")
+_sfx_re = re.compile(r"\s*sfx\s*:\s*(.*?)\s*$", re.IGNORECASE)
+_word_re = re.compile(r"[\w.-]+")
+
+
+def parse(text, voice=None, presets=()):
+    """
+    Compile a message into a render plan in one scan
+
+    The message is split into runs at voice switches ("name:" at the start
+    or after whitespace, for a known alias or voice id). A [preset], [fast]
+    or [slow] tag applies to the whole run it appears in, and [SFX: name]
+    splits a run into speech segments around the sound. Unknown tags and
+    names are read out as text.
+
+    :param text: Sanitized message
+    :param voice: Function mapping a name to a voice id, or None if unknown
+    :param presets: Preset names, checked before the speed tags
+    :return: List of {"text", "voice", "preset", "speed"} and {"sfx"}
+             segments; "voice" and "preset" are None where the message
+             does not set them
+    """
+    if "[" not in text and ":" not in text:
+        t = " ".join(text.split())
+        return [{"text": t, "voice": None, "preset": None, "speed": 1.0}] if t else []
+
+    runs = [{"voice": None, "preset": None, "speed": 1.0}]
+    out, buf, pos = [], [], 0
+
+    def flush():
+        t = " ".join("".join(buf).split())
+        buf.clear()
+        if t:
+            out.append((t, runs[-1]))
+
+    for m in _tok_re.finditer(text):
+        inner = m.group(1)
+        if inner is None:
+            i = max(text.rfind(" ", pos, m.start()) + 1, pos)
+            name = text[i : m.start()]
+            vid = voice(name) if voice and _word_re.fullmatch(name) else None
+            if not vid:
+                continue
+            buf.append(text[pos:i])
+            pos = m.end()
+            flush()
+            runs.append({"voice": vid, "preset": None, "speed": 1.0})
+            continue
+
+        buf.append(text[pos : m.start()])
+        pos = m.end()
+        sm = _sfx_re.match(inner)
+        if sm:
+            flush()
+            if sm.group(1):
+                out.append((None, sm.group(1)))
+            continue
+
+        k = inner.strip().lower()
+        if k in presets:
+            runs[-1]["preset"] = k
+        elif k in SPEEDS:
+            runs[-1]["speed"] = SPEEDS[k]
+        else:
+            buf.append(m.group(0))
+
+    buf.append(text[pos:])
+    flush()
+    return [{"sfx": r} if t is None else {"text": t, **r} for t, r in out]
@@ -0,0 +1,180 @@
+import os
+import sys
+import math
+import time
+import marshal
+import threading
+import tracemalloc
+from collections import Counter
+
+_busy = threading.Lock()
+
+MAX_SECONDS = 60
+
+
+def _window(seconds):
+    """
+    Check a capture window
+
+    :raise ValueError: Unless 0.1 <= seconds <= MAX_SECONDS
+    """
+    s = float(seconds)
+    if not math.isfinite(s) or not 0.1 <= s <= MAX_SECONDS:
+        raise ValueError(f"seconds must be between 0.1 and {MAX_SECONDS}")
+    return s
+
+
+def _fn(code):
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def _stack(frame):
+    out = []
+    while frame is not None:
+        out.append(frame.f_code)
+        frame = frame.f_back
+    out.reverse()
+    return tuple(out)
+
+
+def _sample(seconds, hz):
+    """
+    Sample the stacks of every other thread at a fixed rate
+
+    :return: Counter of {(thread name, code objects root->leaf): samples}
+    """
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    out = Counter()
+    iv = 1.0 / hz
+    end = time.perf_counter() + seconds
+    nxt = time.perf_counter()
+
+    while nxt < end:
+        for tid, fr in sys._current_frames().items():
+            if tid == me:
+                continue
+            if tid not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            out[(names.get(tid) or str(tid), _stack(fr))] += 1
+        nxt += iv
+        time.sleep(max(0.0, nxt - time.perf_counter()))
+
+    return out
+
+
+def collapsed(samples):
+    """Format samples as collapsed stacks ("a;b;c count") for flamegraph tools."""
+    lines = []
+    for (th, stack), n in samples.items():
+        fs = [th.replace(";", "_").replace(" ", "_")]
+        for c in stack:
+            fs.append(
+                f"{c.co_name} ({os.path.basename(c.co_filename)}:{c.co_firstlineno})"
+            )
+        lines.append(";".join(fs) + f" {n}")
+    lines.sort()
+    return "\n".join(lines) + "\n"
+
+
+def pstats_dump(samples, hz):
+    """
+    Convert samples to the marshalled dict read by pstats.Stats
+
+    Calls are sample counts, tottime is time seen as the leaf frame and
+    cumtime time seen anywhere on the stack, both estimated as samples/hz.
+    """
+    dt = 1.0 / hz
+    st = {}
+
+    def ent(k):
+        e = st.get(k)
+        if e is None:
+            e = st[k] = [0, 0, 0.0, 0.0, {}]
+        return e
+
+    for (_, stack), n in samples.items():
+        keys = [_fn(c) for c in stack]
+        for k in set(keys):
+            e = ent(k)
+            e[0] += n
+            e[1] += n
+            e[3] += n * dt
+        if keys:
+            ent(keys[-1])[2] += n * dt
+        for a, b in set(zip(keys, keys[1:])):
+            cl = ent(b)[4]
+            c = cl.get(a, (0, 0, 0.0, 0.0))
+            cl[a] = (c[0] + n, c[1] + n, c[2], c[3] + n * dt)
+
+    return marshal.dumps({k: (e[0], e[1], e[2], e[3], e[4]) for k, e in st.items()})
+
+
+def profile(seconds=10, hz=100, fmt="collapsed"):
+    """
+    Profile all threads of the running process for a bounded time
+
+    :param seconds: Capture window, at most MAX_SECONDS
+    :param hz: Samples per second
+    :param fmt: 'collapsed' (text) or 'pstats' (marshalled bytes)
+    :return: Profile data as str or bytes
+    """
+    if fmt not in ("collapsed", "pstats"):
+        raise ValueError(f"unknown profile format: {fmt}")
+    seconds = _window(seconds)
+    hz = min(max(int(hz), 1), 1000)
+
+    if not _busy.acquire(blocking=False):
+        raise RuntimeError("a profile is already running")
+    try:
+        samples = _sample(seconds, hz)
+    finally:
+        _busy.release()
+
+    return collapsed(samples) if fmt == "collapsed" else pstats_dump(samples, hz)
+
+
+def memory(seconds=10, top=25, frames=1):
+    """
+    Diff tracemalloc snapshots taken at the start and end of a window
+
+    Tracing is started for the window when it is not already on, so only
+    allocations made during the window are seen in that case.
+
+    :return: Dict with the top allocation sites by size growth
+    :raise ValueError: For a window outside 0.1..MAX_SECONDS
+    """
+    seconds = _window(seconds)
+    frames = min(max(int(frames), 1), 100)
+
+    if not _busy.acquire(blocking=False):
+        raise RuntimeError("a profile is already running")
+    started = not tracemalloc.is_tracing()
+    try:
+        if started:
+            tracemalloc.start(frames)
+        a = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        b = tracemalloc.take_snapshot()
+        cur, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+        _busy.release()
+
+    diff = b.compare_to(a, "traceback" if frames > 1 else "lineno")
+    return {
+        "seconds": seconds,
+        "traced_bytes": cur,
+        "traced_peak_bytes": peak,
+        "top": [
+            {
+                "where": [f"{f.filename}:{f.lineno}" for f in d.traceback],
+                "size_diff": d.size_diff,
+                "count_diff": d.count_diff,
+                "size": d.size,
+                "count": d.count,
+            }
+            for d in diff[: max(1, int(top))]
+        ],
+    }
@@ -1,8 +1,5 @@
 import { api } from "./api.js";
 
-let ALIAS_SET = new Set();
-let SFX_MAP = {};
-
 function byId(id) {
   return document.getElementById(id);
 }
@@ -95,104 +92,14 @@ async function loadVoices() {
     }
     if ([...tgt.options].some((o) => o.value === keep2)) tgt.value = keep2;
   }
-
-  ALIAS_SET = new Set([
-    ...Object.keys(aliases).map((s) => s.toLowerCase()),
-    ...voices.map((v) => v.id.toLowerCase()),
-  ]);
-}
-
-async function loadSounds() {
-  SFX_MAP = {};
-  try {
-    const { index, aliases } = await api.sounds();
-    for (const [id, v] of Object.entries(index))
-      SFX_MAP[id.toLowerCase()] = "/sounds/" + v.file;
-    for (const [name, target] of Object.entries(aliases || {})) {
-      const tgt = index[target];
-      if (tgt) SFX_MAP[name.toLowerCase()] = "/sounds/" + tgt.file;
-    }
-  } catch {}
-}
-function parseParts(input, fallbackVoice) {
-  const reVoice = /(^|\s)([a-z0-9_]+):\s*/gi;
-  const reSfx = /\[sfx:\s*([a-z0-9_]+)\]/gi;
-  const reSpeed = /\[(fast|slow)\]/gi;
-  const parts = [];
-  let curVoice = fallbackVoice || null;
-  let i = 0,
-    m,
-    sfxCount = 0;
-
-  let speedMult = 1.0;
-  const speedMatch = reSpeed.exec(input);
-  if (speedMatch) {
-    speedMult = speedMatch[1].toLowerCase() === "fast" ? 0.5 : 2.0;
-    input = input.replace(reSpeed, "").trim();
-  }
-
-  function pushText(chunk) {
-    if (!chunk) return;
-    reSfx.lastIndex = 0;
-    let pos = 0,
-      sm;
-    while ((sm = reSfx.exec(chunk)) !== null) {
-      const t0 = chunk.slice(pos, sm.index);
-      if (t0.trim())
-        parts.push({ type: "tts", text: t0.trim(), voice: curVoice });
-      const key = sm[1].toLowerCase();
-      if (SFX_MAP[key] && sfxCount < 10) {
-        parts.push({ type: "sfx", name: key });
-        sfxCount += 1;
-      } else parts.push({ type: "tts", text: sm[0], voice: curVoice });
-      pos = reSfx.lastIndex;
-    }
-    const tail = chunk.slice(pos);
-    if (tail.trim())
-      parts.push({ type: "tts", text: tail.trim(), voice: curVoice });
-  }
-
-  while ((m = reVoice.exec(input)) !== null) {
-    const segStart = m.index + m[1].length;
-    if (segStart > i) pushText(input.slice(i, segStart));
-    curVoice = m[2].toLowerCase();
-    i = reVoice.lastIndex;
-  }
-  pushText(input.slice(i));
-  const resultParts = parts.length
-    ? parts
-    : [{ type: "tts", text: input, voice: fallbackVoice || null }];
-  return { parts: resultParts, speedMult };
 }
 
 async function playText(fullText, fallbackVoice, statusEl) {
+  // voice switches, presets, [fast]/[slow] and [SFX: ...] are parsed server-side
   const a = byId("player");
-  const { parts, speedMult } = parseParts(fullText, fallbackVoice);
-  const single = parts.length === 1 && parts[0].type !== "sfx";
-  statusEl.textContent = single ? "playing..." : "rendering...";
-
-  let ls = numOrNull("length_scale");
-  if (speedMult !== 1.0) {
-    ls = (ls || 1.0) * speedMult;
-  }
-
+  statusEl.textContent = "rendering...";
   try {
-    const body = single
-      ? { ...payload(parts[0].text, parts[0].voice), length_scale: ls }
-      : {
-          parts: parts.map((p) =>
-            p.type === "sfx"
-              ? { sfx: p.name }
-              : { text: p.text, voice: p.voice || null }
-          ),
-          format: "mp3",
-          preset: byId("preset")?.value || null,
-          length_scale: ls,
-          noise_w: numOrNull("noise_w"),
-          sentence_silence: numOrNull("sentence_silence"),
-          speaker_id: numOrNull("speaker_id"),
-        };
-    const res = single ? await api.tts(body) : await api.ttsBatch(body);
+    const res = await api.tts(payload(fullText, fallbackVoice));
     // res: { arrayBuffer, contentType }
     const blobObj = new Blob([res.arrayBuffer], { type: res.contentType });
     const url = URL.createObjectURL(blobObj);
@@ -257,13 +164,13 @@ document.addEventListener("click", async (e) => {
         const key = byId("key_admin").value.trim();
         if (key) await api.panel.login("admin", key);
         await getPanelStatus();
-        await Promise.all([loadVoices(), loadSounds()]);
+        await loadVoices();
         break;
       }
       case "logout":
         await api.panel.logout();
         await getPanelStatus();
-        await Promise.all([loadVoices(), loadSounds()]);
+        await loadVoices();
         break;
       case "alias-add": {
         const name = byId("alias_name").value.trim().toLowerCase();
@@ -275,7 +182,7 @@ document.addEventListener("click", async (e) => {
         break;
       }
       case "refresh":
-        Promise.all([loadVoices(), loadSounds()]);
+        loadVoices();
         break;
       case "play-text":
         await playText(row.dataset.text, row.dataset.voice, row.children[3]);
@@ -364,5 +271,5 @@ async function handleOAuthWhoami() {
 }
 
 getPanelStatus()
-  .then(() => Promise.all([loadVoices(), loadSounds()]))
+  .then(() => loadVoices())
   .then(pollQueue);
@@ -0,0 +1,153 @@
+import time
+import random
+import threading
+from collections import OrderedDict
+
+import metrics
+import shared
+from log import logger
+
+LIMITED = metrics.counter(
+    "rate_limited", "Requests rejected by the rate limiter", ("role", "bucket")
+)
+
+_SCHEMA = "CREATE TABLE IF NOT EXISTS buckets (k TEXT PRIMARY KEY, tokens REAL, t REAL)"
+IDLE_S = 3600
+
+
+def _refill(st, rate, burst, now):
+    tok, t = st if st else (burst, now)
+    return min(burst, tok + max(0.0, now - t) * rate)
+
+
+class TokenBuckets:
+    def __init__(self, store=None, max_keys=100000):
+        """
+        Initialize token buckets keyed by caller and bucket name
+
+        :param store: Optional shared.Store; buckets then live in its SQLite
+                      file so every worker draws from the same tokens
+        :param max_keys: Buckets kept in memory, least recently used dropped
+        """
+        self.store = store
+        self.max_keys = max_keys
+        self._d = OrderedDict()
+        self._lock = threading.Lock()
+        if store:
+            with store.db() as c:
+                c.execute(_SCHEMA)
+
+    def take(self, key, costs):
+        """
+        Take tokens from several buckets at once, or from none of them
+
+        :param key: Caller identity
+        :param costs: (bucket name, rate per second, burst, tokens wanted);
+                      a cost larger than the burst is capped at the burst
+        :return: (0, None) when allowed, else (seconds to wait, bucket name)
+        """
+        now = time.time()
+        ks = [f"{key}|{c[0]}" for c in costs]
+        if self.store:
+            return self._take_db(ks, costs, now)
+
+        with self._lock:
+            st = [self._d.get(k) for k in ks]
+            wait, name, new = self._plan(st, costs, now)
+            if not wait:
+                for k, tok in zip(ks, new):
+                    self._d[k] = (tok, now)
+                    self._d.move_to_end(k)
+                while len(self._d) > self.max_keys:
+                    self._d.popitem(last=False)
+        return wait, name
+
+    def _plan(self, st, costs, now):
+        wait, name, new = 0.0, None, []
+        for s, (b, rate, burst, n) in zip(st, costs):
+            tok = _refill(s, rate, burst, now)
+            n = min(n, burst)
+            if tok < n and (n - tok) / rate > wait:
+                wait, name = (n - tok) / rate, b
+            new.append(tok - n)
+        return wait, name, new
+
+    def _take_db(self, ks, costs, now):
+        c = self.store.db()
+        with c:
+            c.execute("BEGIN IMMEDIATE")
+            st = []
+            for k in ks:
+                r = c.execute("SELECT tokens, t FROM buckets WHERE k = ?", (k,))
+                st.append(r.fetchone())
+            wait, name, new = self._plan(st, costs, now)
+            if not wait:
+                c.executemany(
+                    "INSERT OR REPLACE INTO buckets (k, tokens, t) VALUES (?, ?, ?)",
+                    [(k, tok, now) for k, tok in zip(ks, new)],
+                )
+            if random.random() < 0.001:
+                c.execute("DELETE FROM buckets WHERE t < ?", (now - IDLE_S,))
+        return wait, name
+
+
+class RateLimiter:
+    def __init__(self, limits, buckets):
+        """
+        Initialize per-role request and character limits
+
+        :param limits: {role: {"rps", "burst", "chars_per_s", "chars_burst"}};
+                       "default" applies to roles without an entry, and a
+                       missing or zero rate means unlimited
+        :param buckets: TokenBuckets holding the state
+        """
+        self.limits = limits
+        self.buckets = buckets
+
+    def costs(self, role, chars):
+        """Return the bucket costs for one request by role, [] when unlimited."""
+        lim = self.limits.get(role, self.limits.get("default")) or {}
+        out = []
+        rps = float(lim.get("rps") or 0)
+        if rps > 0:
+            out.append(("requests", rps, float(lim.get("burst") or rps), 1))
+        cps = float(lim.get("chars_per_s") or 0)
+        if cps > 0 and chars:
+            out.append(("chars", cps, float(lim.get("chars_burst") or cps * 5), chars))
+        return out
+
+    def check(self, ident, role, chars=0):
+        """
+        Charge a request to ident
+
+        :return: Seconds until it would be allowed, 0 when allowed now
+        """
+        cs = self.costs(role, chars)
+        if not cs:
+            return 0
+        wait, name = self.buckets.take(ident, cs)
+        if wait:
+            LIMITED.inc(role, name)
+        return wait
+
+
+_limiter = None
+
+
+def init_ratelimit(cfg):
+    """Create the limiter from cfg rate_limits, None when it is not set."""
+    global _limiter
+    lim = cfg.get("rate_limits") or {}
+    if not lim:
+        _limiter = None
+        return None
+
+    st = shared.get_store()
+    _limiter = RateLimiter(lim, TokenBuckets(st))
+    logger.info(f"[ratelimit] roles={sorted(lim)} shared={bool(st)}")
+    return _limiter
+
+
+def get_limiter():
+    """Get the rate limiter, None when requests are not limited."""
+    return _limiter
@@ -0,0 +1,244 @@
+import bisect
+import hashlib
+import threading
+
+import requests
+
+import metrics
+from log import logger
+
+# hop-by-hop and framing headers that must not be copied between connections
+HOP = {
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+    "content-length",
+    "content-encoding",
+    "host",
+    "te",
+    "trailer",
+    "upgrade",
+    "proxy-authorization",
+    "proxy-connection",
+}
+
+FORWARDS = metrics.counter(
+    "router_forwards", "Requests forwarded by node and result", ("node", "result")
+)
+
+
+def _h(s):
+    return int.from_bytes(hashlib.sha1(s.encode()).digest()[:8], "big")
+
+
+class Ring:
+    def __init__(self, nodes=(), vnodes=64):
+        """
+        Initialize a consistent hash ring
+
+        Each node owns vnodes points, so adding or removing a node only moves
+        about 1/N of the keys, and those all go to or come from that node.
+        """
+        self.vnodes = max(1, int(vnodes))
+        self.set_nodes(nodes)
+
+    def set_nodes(self, nodes):
+        """Replace the nodes on the ring."""
+        pts = sorted(
+            (_h(f"{n}#{i}"), n)
+            for n in dict.fromkeys(nodes)
+            for i in range(self.vnodes)
+        )
+        self._keys = [p[0] for p in pts]
+        self._nodes = [p[1] for p in pts]
+        self.nodes = list(dict.fromkeys(nodes))
+
+    def walk(self, key):
+        """Return every node once, in ring order starting at key's owner."""
+        if not self._keys:
+            return []
+        i = bisect.bisect(self._keys, _h(key))
+        out = {}
+        for j in range(len(self._nodes)):
+            out.setdefault(self._nodes[(i + j) % len(self._nodes)])
+            if len(out) == len(self.nodes):
+                break
+        return list(out)
+
+
+class Router:
+    def __init__(
+        self,
+        nodes,
+        vnodes=64,
+        interval=2.0,
+        timeout=60,
+        health_path="/api/readyz",
+        tries=2,
+    ):
+        """
+        Initialize a voice-affinity router over backend nodes
+
+        Requests with the same key (the resolved voice id) go to the same
+        node while it is healthy, so each node loads and caches only its
+        share of the voices. Down nodes are skipped, which sends their keys
+        to the next node on the ring until they pass a health check again.
+
+        :param nodes: Base URLs such as "http://10.0.0.2:8000"
+        :param interval: Seconds between health checks
+        :param timeout: Seconds allowed for a forwarded request
+        :param health_path: Path that answers 200 on a ready node
+        :param tries: Nodes tried per request before giving up
+        """
+        self.ring = Ring([n.rstrip("/") for n in nodes], vnodes)
+        self.interval = interval
+        self.timeout = timeout
+        self.health_path = health_path
+        self.tries = max(1, int(tries))
+        self.down = set()
+        self._lock = threading.Lock()
+        self._http = requests.Session()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def pick(self, key):
+        """Return the nodes to try for key, healthy ones first."""
+        with self._lock:
+            order = self.ring.walk(key)
+            down = set(self.down)
+        return [n for n in order if n not in down] + [n for n in order if n in down]
+
+    def mark(self, node, up):
+        """Record a node's health, logging changes."""
+        with self._lock:
+            was = node not in self.down
+            if up:
+                self.down.discard(node)
+            else:
+                self.down.add(node)
+        if was != up:
+            logger.warning(f"[router] {node} is {'up' if up else 'down'}")
+
+    def forward(self, method, path, key=None, headers=None, **kw):
+        """
+        Send a request to the node owning key
+
+        With key None, nodes are tried in ring order until one does not
+        answer 404, for lookups by content address.
+
+        :return: (node, requests.Response)
+        :raise RuntimeError: If no node answered
+        """
+        hh = {k: v for k, v in (headers or {}).items() if k.lower() not in HOP}
+        nodes = self.pick(key or "")
+        if key is not None:
+            nodes = nodes[: self.tries]
+
+        last = None
+        for n in nodes:
+            try:
+                r = self._http.request(
+                    method, n + path, headers=hh, timeout=self.timeout, **kw
+                )
+            except requests.RequestException as e:
+                FORWARDS.inc(n, "error")
+                self.mark(n, False)
+                last = e
+                continue
+            if r.status_code in (502, 503, 504):
+                FORWARDS.inc(n, "unavailable")
+                self.mark(n, False)
+                last = r
+                continue
+            if key is None and r.status_code == 404:
+                last = r
+                continue
+            FORWARDS.inc(n, "ok")
+            return n, r
+
+        if isinstance(last, requests.Response):
+            return None, last
+        raise RuntimeError(f"no backend available: {last}")
+
+    def check(self):
+        """Probe every node's health path once."""
+        for n in list(self.ring.nodes):
+            try:
+                ok = self._http.get(n + self.health_path, timeout=2).status_code == 200
+            except requests.RequestException:
+                ok = False
+            self.mark(n, ok)
+
+    def start(self):
+        """Start the background health checker."""
+        if self._thread:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.check()
+                except Exception as e:
+                    logger.warning(f"[router] health check failed: {e}")
+                if self._stop.wait(self.interval):
+                    return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=loop, name="router-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the health checker."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+        self._thread = None
+
+    def set_nodes(self, nodes):
+        """Replace the backend nodes; only keys of added or removed nodes move."""
+        nodes = [n.rstrip("/") for n in nodes]
+        with self._lock:
+            self.ring.set_nodes(nodes)
+            self.down &= set(nodes)
+        logger.info(f"[router] nodes: {nodes}")
+
+    def snapshot(self):
+        """Return the nodes and their health."""
+        with self._lock:
+            return {
+                "nodes": [
+                    {"url": n, "up": n not in self.down} for n in self.ring.nodes
+                ],
+                "vnodes": self.ring.vnodes,
+            }
+
+
+_router = None
+
+
+def init_router(cfg):
+    """Create the router when cfg has router.nodes, stopping any previous one."""
+    global _router
+    if _router:
+        _router.stop()
+    _router = None
+
+    rc = cfg.get("router") or {}
+    if not rc.get("nodes"):
+        return None
+
+    _router = Router(
+        rc["nodes"],
+        int(rc.get("vnodes", 64)),
+        float(rc.get("health_interval_s", 2)),
+        float(rc.get("timeout_s", 60)),
+        rc.get("health_path", "/api/readyz"),
+        int(rc.get("tries", 2)),
+    )
+    logger.info(f"[router] routing by voice to {len(_router.ring.nodes)} nodes")
+    return _router
+
+
+def get_router():
+    """Get the router, None when this node renders requests itself."""
+    return _router
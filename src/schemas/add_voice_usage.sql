@@ -0,0 +1,2 @@
+-- Add request counts for a voice
+INSERT INTO voice_usage (voice, requests, last_used) VALUES (?, ?, ?) ON CONFLICT (voice) DO UPDATE SET requests = requests + excluded.requests, last_used = excluded.last_used
\ No newline at end of file
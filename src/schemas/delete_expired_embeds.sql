@@ -0,0 +1,2 @@
+-- Delete embeds whose token expired before a cutoff
+DELETE FROM embeds WHERE jti IN (SELECT jti FROM tokens WHERE expires < ?)
\ No newline at end of file
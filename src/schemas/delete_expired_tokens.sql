@@ -0,0 +1,2 @@
+-- Delete tokens that expired before a cutoff
+DELETE FROM tokens WHERE expires < ?
\ No newline at end of file
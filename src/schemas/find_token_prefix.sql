@@ -0,0 +1,2 @@
+-- Find token JTIs by prefix (range scan on the primary key)
+SELECT jti FROM tokens WHERE jti >= ? AND jti < ?
\ No newline at end of file
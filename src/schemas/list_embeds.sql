@@ -1,2 +1,2 @@
--- List all embeds ordered by creation date
-SELECT embed_id, jti, created_at, note, origin FROM embeds ORDER BY created_at DESC
\ No newline at end of file
+-- List embeds with their token ordered by creation date
+SELECT e.rowid, e.embed_id, e.jti, e.created_at, e.note, e.origin, t.expires, t.revoked FROM embeds e LEFT JOIN tokens t ON t.jti = e.jti ORDER BY e.created_at DESC, e.rowid DESC LIMIT ?
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- List embeds with their token created before a (created_at, rowid) cursor
+SELECT e.rowid, e.embed_id, e.jti, e.created_at, e.note, e.origin, t.expires, t.revoked FROM embeds e LEFT JOIN tokens t ON t.jti = e.jti WHERE (e.created_at, e.rowid) < (?, ?) ORDER BY e.created_at DESC, e.rowid DESC LIMIT ?
\ No newline at end of file
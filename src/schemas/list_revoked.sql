@@ -0,0 +1,2 @@
+-- List revoked token JTIs
+SELECT jti FROM tokens WHERE revoked=1
\ No newline at end of file
@@ -1,2 +1,2 @@
--- List all tokens ordered by creation date
-SELECT jti, roles, expires, created_by, created_at, revoked, note FROM tokens ORDER BY created_at DESC
\ No newline at end of file
+-- List tokens ordered by creation date
+SELECT rowid, jti, roles, expires, created_by, created_at, revoked, note FROM tokens ORDER BY created_at DESC, rowid DESC LIMIT ?
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- List tokens created before a (created_at, rowid) cursor
+SELECT rowid, jti, roles, expires, created_by, created_at, revoked, note FROM tokens WHERE (created_at, rowid) < (?, ?) ORDER BY created_at DESC, rowid DESC LIMIT ?
\ No newline at end of file
@@ -0,0 +1,5 @@
+-- Indexes for listing by creation date, retention sweeps and embed joins
+CREATE INDEX IF NOT EXISTS tokens_created_at ON tokens (created_at);
+CREATE INDEX IF NOT EXISTS tokens_expires ON tokens (expires);
+CREATE INDEX IF NOT EXISTS embeds_created_at ON embeds (created_at);
+CREATE INDEX IF NOT EXISTS embeds_jti ON embeds (jti);
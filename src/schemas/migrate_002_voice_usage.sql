@@ -0,0 +1,6 @@
+-- Requests per voice, used to pick which voices to preload at startup
+CREATE TABLE IF NOT EXISTS voice_usage (
+    voice TEXT PRIMARY KEY,
+    requests INTEGER NOT NULL DEFAULT 0,
+    last_used INTEGER NOT NULL DEFAULT 0
+);
@@ -1,2 +1,2 @@
--- Revoke tokens by prefix
-UPDATE tokens SET revoked=1 WHERE jti LIKE ?
\ No newline at end of file
+-- Revoke tokens by prefix (range scan on the primary key)
+UPDATE tokens SET revoked=1 WHERE jti >= ? AND jti < ?
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- Most requested voices
+SELECT voice FROM voice_usage ORDER BY requests DESC, last_used DESC LIMIT ?
\ No newline at end of file
@@ -1,9 +1,18 @@
 import os
+import copy
 import stat
 import secrets
+import tempfile
+import threading
+from contextlib import contextmanager
 
 import yaml
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from log import logger
 
 ROLES = ["admin", "mod", "tts", "push", "pull", "overlay"]
@@ -27,6 +36,10 @@ TOKEN_LEN = 32
 SECRET_LEN = 48
 FILE_MODE = stat.S_IRUSR | stat.S_IWUSR
 
+# resolved path -> ((mtime_ns, size), parsed data)
+_cache = {}
+_lock = threading.RLock()
+
 
 def _chmod600(p):
     try:
@@ -49,35 +62,96 @@ def _resolve(p, base_dir=None):
     return os.path.normpath(os.path.join(_CFG_DIR, p))
 
 
-def _read(p, base_dir=None):
+def _stat_key(rp):
+    try:
+        st = os.stat(rp)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _view(p, base_dir=None):
+    """Return the parsed secrets file, re-reading it only when mtime or size changed."""
     rp = _resolve(p, base_dir)
+    k = _stat_key(rp)
+
+    if k is None:
+        return {}
+
+    hit = _cache.get(rp)
+    if hit and hit[0] == k:
+        return hit[1]
 
-    if os.path.exists(rp):
-        with open(rp, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f) or {}
+    with open(rp, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
+
+    _cache[rp] = (k, data)
+    return data
+
+
+def _read(p, base_dir=None):
+    """Return a private copy of the secrets file for modification."""
+    return copy.deepcopy(_view(p, base_dir))
+
+
+@contextmanager
+def _locked(p, base_dir=None):
+    """Serialize read-modify-write cycles across threads and processes."""
+    rp = _resolve(p, base_dir)
+    with _lock:
+        if fcntl is None:
+            yield
+            return
 
-    return {}
+        os.makedirs(os.path.dirname(rp) or ".", exist_ok=True)
+        with open(rp + ".lock", "a") as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
 
 
 def _write(p, data, base_dir=None):
     rp = _resolve(p, base_dir)
-    os.makedirs(os.path.dirname(rp) or ".", exist_ok=True)
+    d = os.path.dirname(rp) or "."
+    os.makedirs(d, exist_ok=True)
 
-    with open(rp, "w", encoding="utf-8") as f:
-        yaml.safe_dump(data, f, sort_keys=True)
+    fd, tmp = tempfile.mkstemp(prefix=".secrets-", suffix=".tmp", dir=d)
+    try:
+        _chmod600(tmp)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            yaml.safe_dump(data, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, rp)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
 
     _chmod600(rp)
+    k = _stat_key(rp)
+    if k:
+        _cache[rp] = (k, copy.deepcopy(data))
 
 
 def ensure_session_secret(path=None, base_dir=None):
     """Ensure session secret exists."""
     rp = _resolve(path, base_dir)
-    data = _read(path, base_dir)
+    data = _view(path, base_dir)
+    if "session_secret" in data:
+        return data["session_secret"]
 
-    if "session_secret" not in data:
-        data["session_secret"] = secrets.token_urlsafe(SECRET_LEN)
-        _write(path, data, base_dir)
-        logger.info(f"[session] wrote {rp}")
+    with _locked(path, base_dir):
+        data = _read(path, base_dir)
+
+        if "session_secret" not in data:
+            data["session_secret"] = secrets.token_urlsafe(SECRET_LEN)
+            _write(path, data, base_dir)
+            logger.info(f"[session] wrote {rp}")
 
     return data["session_secret"]
 
@@ -86,25 +160,27 @@ def ensure_keys(auth_cfg, base_dir=None):
     """Ensure auth keys exist."""
     path = (auth_cfg or {}).get("file") or DEFAULT_SECRETS
     rp = _resolve(path, base_dir)
-    data = _read(path, base_dir)
-    ks = dict(data.get("keys", {}))
-    created = []
 
-    for r in ROLES:
-        if r == "mod":
-            continue
+    with _locked(path, base_dir):
+        data = _read(path, base_dir)
+        ks = dict(data.get("keys", {}))
+        created = []
 
-        if not ks.get(r):
-            ks[r] = secrets.token_urlsafe(TOKEN_LEN)
-            created.append(r)
+        for r in ROLES:
+            if r == "mod":
+                continue
 
-    if created or "keys" not in data:
-        data["keys"] = ks
-        _write(path, data, base_dir)
-        logger.info(f"[auth] wrote {rp}")
+            if not ks.get(r):
+                ks[r] = secrets.token_urlsafe(TOKEN_LEN)
+                created.append(r)
+
+        if created or "keys" not in data:
+            data["keys"] = ks
+            _write(path, data, base_dir)
+            logger.info(f"[auth] wrote {rp}")
 
-        for r in created:
-            logger.info(f"[auth] save this {r} key: {ks[r]}")
+            for r in created:
+                logger.info(f"[auth] save this {r} key: {ks[r]}")
 
     return ks
 
@@ -112,64 +188,71 @@ def ensure_keys(auth_cfg, base_dir=None):
 def ensure_jwt_secret(path=None, base_dir=None):
     """Ensure JWT secret exists."""
     rp = _resolve(path, base_dir)
-    data = _read(path, base_dir)
+    data = _view(path, base_dir)
+    if "jwt_secret" in data:
+        return data["jwt_secret"]
 
-    if "jwt_secret" not in data:
-        data["jwt_secret"] = secrets.token_urlsafe(SECRET_LEN)
-        _write(path, data, base_dir)
-        logger.info(f"[jwt] wrote {rp}")
+    with _locked(path, base_dir):
+        data = _read(path, base_dir)
+
+        if "jwt_secret" not in data:
+            data["jwt_secret"] = secrets.token_urlsafe(SECRET_LEN)
+            _write(path, data, base_dir)
+            logger.info(f"[jwt] wrote {rp}")
 
     return data["jwt_secret"]
 
 
 def get_oauth_provider(provider, path=None, base_dir=None):
     """Get OAuth provider config."""
-    data = _read(path, base_dir)
-    return (data.get("oauth") or {}).get(provider, {})
+    data = _view(path, base_dir)
+    return dict((data.get("oauth") or {}).get(provider) or {})
 
 
 def save_oauth_mapping(provider, remote_id, role, path=None, base_dir=None):
     """Save OAuth mapping."""
-    data = _read(path, base_dir)
-    oauth = data.setdefault("oauth", {})
-    maps = oauth.setdefault("mappings", {})
-    prov = maps.setdefault(provider, {})
-
     r = str(remote_id)
     if not r.isdigit():
         r = r.lower()
 
-    prov[r] = role
-    _write(path, data, base_dir)
+    with _locked(path, base_dir):
+        data = _read(path, base_dir)
+        oauth = data.setdefault("oauth", {})
+        maps = oauth.setdefault("mappings", {})
+        prov = maps.setdefault(provider, {})
+
+        prov[r] = role
+        _write(path, data, base_dir)
 
 
 def list_oauth_mappings(provider=None, path=None, base_dir=None):
     """List OAuth mappings."""
-    data = _read(path, base_dir)
+    data = _view(path, base_dir)
     maps = (data.get("oauth") or {}).get("mappings") or {}
 
     if provider:
-        return maps.get(provider) or {}
+        return dict(maps.get(provider) or {})
 
-    return maps
+    return copy.deepcopy(maps)
 
 
 def delete_oauth_mapping(provider, remote_id, path=None, base_dir=None):
     """Delete OAuth mapping."""
-    data = _read(path, base_dir)
-    oauth = data.get("oauth") or {}
-    maps = oauth.get("mappings") or {}
-    prov = maps.get(provider) or {}
-
     r = str(remote_id)
     rl = r.lower()
 
-    for key in (r, rl):
-        if key in prov:
-            del prov[key]
-            oauth["mappings"] = maps
-            data["oauth"] = oauth
-            _write(path, data, base_dir)
-            return True
+    with _locked(path, base_dir):
+        data = _read(path, base_dir)
+        oauth = data.get("oauth") or {}
+        maps = oauth.get("mappings") or {}
+        prov = maps.get(provider) or {}
+
+        for key in (r, rl):
+            if key in prov:
+                del prov[key]
+                oauth["mappings"] = maps
+                data["oauth"] = oauth
+                _write(path, data, base_dir)
+                return True
 
     return False
@@ -1,5 +1,4 @@
 import os
-import re
 import glob
 
 from log import logger
@@ -7,8 +6,6 @@ from log import logger
 DEFAULT_SOUNDS = os.path.join(os.path.dirname(__file__), "..", "sounds")
 SFX_EXTENSIONS = (".mp3", ".wav", ".ogg", ".m4a")
 
-_sfx_re = re.compile(r"\[SFX:\s*([^\]]+)\]", re.IGNORECASE)
-
 sfx_files = {}
 sfx_aliases = {}
 
@@ -82,34 +79,3 @@ def _resolve_sfx(name, cfg):
     abspath = sfx_files[sid]
 
     return url, abspath
-
-
-def parse_sfx_tags(text):
-    """Parse [SFX: name] tags into parts list."""
-    parts = []
-    last_end = 0
-
-    for m in _sfx_re.finditer(text):
-        before = text[last_end:m.start()].strip()
-
-        if before:
-            parts.append({"text": before})
-
-        sfx_name = m.group(1).strip()
-
-        if sfx_name:
-            parts.append({"sfx": sfx_name})
-
-        last_end = m.end()
-
-    after = text[last_end:].strip()
-
-    if after:
-        parts.append({"text": after})
-
-    return parts
-
-
-def has_sfx_tags(text):
-    """Check if text contains SFX tags."""
-    return bool(_sfx_re.search(text))
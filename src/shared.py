@@ -0,0 +1,338 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import threading
+from collections import deque
+from collections.abc import MutableMapping
+
+from cachetools import TTLCache
+
+from log import logger
+
+BUSY_TIMEOUT_MS = 5000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (ns TEXT, k TEXT, v TEXT, PRIMARY KEY (ns, k));
+CREATE TABLE IF NOT EXISTS ver (ns TEXT PRIMARY KEY, n INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, ns TEXT, qid TEXT, v TEXT
+);
+CREATE INDEX IF NOT EXISTS queue_ns ON queue (ns, id);
+CREATE TABLE IF NOT EXISTS cache (
+    ns TEXT, k TEXT, v BLOB, expires REAL, PRIMARY KEY (ns, k)
+);
+CREATE INDEX IF NOT EXISTS cache_exp ON cache (ns, expires);
+"""
+
+_store = None
+
+
+class Store:
+    def __init__(self, path):
+        """
+        Initialize a SQLite file shared by every worker process
+
+        Connections are per thread and per process, so a store created
+        before fork() is safe to use in the children.
+        """
+        self.path = path
+        self._local = threading.local()
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        c = self.db()
+        c.execute("PRAGMA journal_mode=WAL")
+        c.executescript(_SCHEMA)
+        c.commit()
+
+    def db(self):
+        """Return the calling thread's connection, reopening it after fork()."""
+        c = getattr(self._local, "conn", None)
+        if c is not None and self._local.pid == os.getpid():
+            return c
+        c = sqlite3.connect(
+            self.path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False
+        )
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self._local.conn = c
+        self._local.pid = os.getpid()
+        return c
+
+    def version(self, ns):
+        """Return the change counter for a namespace."""
+        r = self.db().execute("SELECT n FROM ver WHERE ns = ?", (ns,)).fetchone()
+        return r[0] if r else 0
+
+    def bump(self, c, ns):
+        """Advance a namespace's change counter inside the caller's transaction."""
+        c.execute(
+            "INSERT INTO ver (ns, n) VALUES (?, 1) "
+            "ON CONFLICT (ns) DO UPDATE SET n = n + 1",
+            (ns,),
+        )
+
+
+class SharedMap(MutableMapping):
+    def __init__(self, store, ns, initial=None):
+        """
+        Initialize a string-keyed map of JSON values kept in the store
+
+        Reads come from a local copy that is reloaded only when another
+        process changed the namespace, so lookups cost one indexed read.
+
+        :param initial: Contents to start from, replacing what the store had
+        """
+        self.store = store
+        self.ns = ns
+        self._d = {}
+        self._n = -1
+        self._lock = threading.Lock()
+        if initial is not None:
+            with store.db() as c:
+                c.execute("DELETE FROM kv WHERE ns = ?", (ns,))
+                c.executemany(
+                    "INSERT INTO kv (ns, k, v) VALUES (?, ?, ?)",
+                    [(ns, k, json.dumps(v)) for k, v in initial.items()],
+                )
+                store.bump(c, ns)
+
+    def _sync(self):
+        n = self.store.version(self.ns)
+        if n == self._n:
+            return self._d
+        rows = self.store.db().execute("SELECT k, v FROM kv WHERE ns = ?", (self.ns,))
+        d = {k: json.loads(v) for k, v in rows}
+        with self._lock:
+            self._d, self._n = d, n
+        return d
+
+    def __getitem__(self, k):
+        return self._sync()[k]
+
+    def __setitem__(self, k, v):
+        with self.store.db() as c:
+            c.execute(
+                "INSERT OR REPLACE INTO kv (ns, k, v) VALUES (?, ?, ?)",
+                (self.ns, k, json.dumps(v)),
+            )
+            self.store.bump(c, self.ns)
+
+    def __delitem__(self, k):
+        with self.store.db() as c:
+            r = c.execute("DELETE FROM kv WHERE ns = ? AND k = ?", (self.ns, k))
+            if r.rowcount:
+                self.store.bump(c, self.ns)
+        if not r.rowcount:
+            raise KeyError(k)
+
+    def __iter__(self):
+        return iter(list(self._sync()))
+
+    def __len__(self):
+        return len(self._sync())
+
+    def __contains__(self, k):
+        return k in self._sync()
+
+
+class MemoryQueue(deque):
+    """A deque with the job queue helpers SharedQueue provides."""
+
+    def take(self):
+        """Pop the oldest job, None when empty."""
+        try:
+            return self.popleft()
+        except IndexError:
+            return None
+
+    def take_many(self, n):
+        """Pop up to n of the oldest jobs, oldest first."""
+        return [self.popleft() for _ in range(min(n, len(self)))]
+
+    def peek(self):
+        """Return the oldest job without removing it, None when empty."""
+        return self[0] if self else None
+
+    def drop(self, qid):
+        """Remove jobs whose "id" is qid and return how many were removed."""
+        keep = [it for it in self if str(it.get("id")) != str(qid)]
+        n = len(self) - len(keep)
+        self.clear()
+        self.extend(keep)
+        return n
+
+
+class SharedQueue:
+    def __init__(self, store, ns, maxlen=None):
+        """
+        Initialize a FIFO of JSON jobs kept in the store
+
+        Like a bounded deque, appending past maxlen drops the oldest jobs.
+        """
+        self.store = store
+        self.ns = ns
+        self.maxlen = maxlen
+
+    def append(self, it):
+        """Add a job at the tail."""
+        with self.store.db() as c:
+            c.execute(
+                "INSERT INTO queue (ns, qid, v) VALUES (?, ?, ?)",
+                (self.ns, str(it.get("id")), json.dumps(it)),
+            )
+            if self.maxlen is not None:
+                c.execute(
+                    "DELETE FROM queue WHERE ns = ? AND id IN (SELECT id FROM queue "
+                    "WHERE ns = ? ORDER BY id DESC LIMIT -1 OFFSET ?)",
+                    (self.ns, self.ns, self.maxlen),
+                )
+
+    def take(self):
+        """Pop the oldest job, None when empty; safe across processes."""
+        with self.store.db() as c:
+            r = c.execute(
+                "DELETE FROM queue WHERE id = (SELECT id FROM queue WHERE ns = ? "
+                "ORDER BY id LIMIT 1) RETURNING v",
+                (self.ns,),
+            ).fetchone()
+        return json.loads(r[0]) if r else None
+
+    def take_many(self, n):
+        """Pop up to n of the oldest jobs in one statement, oldest first."""
+        with self.store.db() as c:
+            rs = c.execute(
+                "DELETE FROM queue WHERE id IN (SELECT id FROM queue WHERE ns = ? "
+                "ORDER BY id LIMIT ?) RETURNING id, v",
+                (self.ns, n),
+            ).fetchall()
+        return [json.loads(v) for _, v in sorted(rs)]
+
+    def peek(self):
+        """Return the oldest job without removing it, None when empty."""
+        r = (
+            self.store.db()
+            .execute("SELECT v FROM queue WHERE ns = ? ORDER BY id LIMIT 1", (self.ns,))
+            .fetchone()
+        )
+        return json.loads(r[0]) if r else None
+
+    def drop(self, qid):
+        """Remove jobs whose "id" is qid and return how many were removed."""
+        with self.store.db() as c:
+            r = c.execute(
+                "DELETE FROM queue WHERE ns = ? AND qid = ?", (self.ns, str(qid))
+            )
+        return r.rowcount
+
+    def __len__(self):
+        return (
+            self.store.db()
+            .execute("SELECT COUNT(*) FROM queue WHERE ns = ?", (self.ns,))
+            .fetchone()[0]
+        )
+
+    def __bool__(self):
+        return self.peek() is not None
+
+
+class SharedCache:
+    def __init__(self, store, ns, maxsize, ttl):
+        """
+        Initialize a TTL cache of picklable values kept in the store
+
+        Keys may be any value with a stable repr (tuples of str, float, None).
+        When full, the entries closest to expiry are dropped first.
+        """
+        self.store = store
+        self.ns = ns
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        r = (
+            self.store.db()
+            .execute(
+                "SELECT v FROM cache WHERE ns = ? AND k = ? AND expires > ?",
+                (self.ns, repr(key), time.time()),
+            )
+            .fetchone()
+        )
+        return pickle.loads(r[0]) if r else default
+
+    def __getitem__(self, key):
+        v = self.get(key, _missing)
+        if v is _missing:
+            raise KeyError(key)
+        return v
+
+    def __setitem__(self, key, v):
+        now = time.time()
+        with self.store.db() as c:
+            c.execute(
+                "INSERT OR REPLACE INTO cache (ns, k, v, expires) VALUES (?, ?, ?, ?)",
+                (self.ns, repr(key), pickle.dumps(v), now + self.ttl),
+            )
+            c.execute("DELETE FROM cache WHERE ns = ? AND expires <= ?", (self.ns, now))
+            c.execute(
+                "DELETE FROM cache WHERE ns = ? AND k IN (SELECT k FROM cache "
+                "WHERE ns = ? ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                (self.ns, self.ns, self.maxsize),
+            )
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return (
+            self.store.db()
+            .execute(
+                "SELECT COUNT(*) FROM cache WHERE ns = ? AND expires > ?",
+                (self.ns, time.time()),
+            )
+            .fetchone()[0]
+        )
+
+
+_missing = object()
+
+
+def init_shared(path=None):
+    """
+    Select where mutable service state lives
+
+    :param path: SQLite file shared by worker processes, None to keep state
+                 in this process's memory
+    """
+    global _store
+    _store = Store(path) if path else None
+    if _store:
+        logger.info(f"[shared] state in {path}")
+    return _store
+
+
+def get_store():
+    """Get the shared store, None when state is process-local."""
+    return _store
+
+
+def mapping(name, initial=None):
+    """Return a dict-like map that every worker sees."""
+    if _store is None:
+        return dict(initial or {})
+    return SharedMap(_store, name, initial or {})
+
+
+def queue(name, maxlen=None):
+    """Return a job FIFO that every worker pops from."""
+    if _store is None:
+        return MemoryQueue(maxlen=maxlen)
+    return SharedQueue(_store, name, maxlen)
+
+
+def cache(name, maxsize, ttl):
+    """Return a TTL cache that every worker reads and fills."""
+    if _store is None:
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    return SharedCache(_store, name, maxsize, ttl)
@@ -0,0 +1,78 @@
+import json
+import time
+import contextvars
+from contextlib import contextmanager
+
+import metrics
+from log import logger
+
+STAGES = metrics.histogram(
+    "tts_stage_seconds", "Time spent in each synthesis stage", ("stage",)
+)
+
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    def __init__(self):
+        """Initialize an empty per-request list of spans."""
+        self.spans = []
+        self.t0 = time.perf_counter()
+        self.total = None
+
+    def add(self, name, sec):
+        """Record a finished span."""
+        self.spans.append((name, sec))
+
+    def durations(self):
+        """Return {stage: milliseconds}, summing repeated stages in first-seen order."""
+        out = {}
+        for name, sec in self.spans:
+            out[name] = out.get(name, 0.0) + sec * 1000
+        if self.total is not None:
+            out["total"] = self.total * 1000
+        return out
+
+    def header(self):
+        """Format the spans as a Server-Timing header value."""
+        return ", ".join(f"{k};dur={v:.1f}" for k, v in self.durations().items())
+
+    def log(self, rid=None):
+        """Write the spans as one structured debug log line."""
+        logger.debug(
+            "[timing] "
+            + json.dumps(
+                {"rid": rid, **{k: round(v, 2) for k, v in self.durations().items()}}
+            )
+        )
+
+
+@contextmanager
+def trace():
+    """Collect spans recorded in this context into a new Trace."""
+    tr = Trace()
+    tok = _trace.set(tr)
+    try:
+        yield tr
+    finally:
+        tr.total = time.perf_counter() - tr.t0
+        _trace.reset(tok)
+
+
+@contextmanager
+def span(name):
+    """
+    Time a block as a named stage
+
+    The duration goes to the current trace (if any) and the per-stage
+    latency histogram.
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        STAGES.observe(dt, name)
+        tr = _trace.get()
+        if tr is not None:
+            tr.add(name, dt)
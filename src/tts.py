@@ -1,4 +1,7 @@
+import io
 import os
+import atexit
+import sys
 import glob
 import json
 import re
@@ -9,25 +12,102 @@ import shutil
 import tempfile
 import subprocess
 import threading
+import contextvars
+import wave
 import hmac
+import hashlib
+from array import array
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from log import configure, logger
-from cachetools import TTLCache
 
 import secrets_util as sec
+import db
 import sfx
 import mod
+import timing
+import metrics
+import loudness
+import encoders
+import batcher
+import limiter
+import engine
+import models
+import shared
+import audiocache
+import plan
 from util import resolve_path
 
 cfg = {}
 vc = {}
 scanned = False
-sem = None
+lim = None
 aliases = {}
 presets = {}
 cache = None
+segments = None
+blobs = None
+gains = loudness.GainTable()
+batches = None
+sfx48 = {}
+_sfx_dir = None
+_sfx_dirs = []
+_usage = {}
+_usage_t = 0.0
+_usage_lock = threading.Lock()
+_ready = threading.Event()
+_warm = []
 _auth = {"enabled": False, "keys": {}}
-_speed_re = re.compile(r"\[(fast|slow)\]", re.IGNORECASE)
+_audio_re = re.compile(r"^([0-9a-f]{64})\.([a-z0-9]+)$")
+
+EXTS = {
+    "audio/mpeg": "mp3",
+    "audio/wav": "wav",
+    "audio/ogg; codecs=opus": "opus",
+    "audio/ogg": "ogg",
+    "audio/L16": "pcm",
+}
+MIMES = {"mp3": "audio/mpeg", "opus": "audio/ogg; codecs=opus", "ogg": "audio/ogg"}
+FORMATS = ("mp3", "wav", "opus", "ogg", "pcm")
+BITRATES = {"mp3": "128k", "opus": "32k", "ogg": "64k"}
+USAGE_FLUSH_S = 30
+
+
+REQ_LATENCY = metrics.histogram(
+    "tts_request_duration_seconds",
+    "End-to-end synthesis latency by voice, format and cache result",
+    ("voice", "format", "cache"),
+)
+CACHE_REQS = metrics.counter(
+    "tts_cache_requests", "Render cache lookups by result", ("result",)
+)
+SEG_REQS = metrics.counter(
+    "tts_segment_cache_requests", "Render plan segment lookups by result", ("result",)
+)
+INFLIGHT = metrics.gauge("tts_inflight", "Synthesis processes holding a permit")
+metrics.gauge(
+    "tts_concurrency_limit",
+    "Current adaptive synthesis concurrency limit",
+    fn=lambda: lim.snapshot()["limit"] if lim else 0,
+)
+SPAWNS = metrics.counter("subprocess_spawns", "External processes started", ("bin",))
+SPAWN_FAILS = metrics.counter(
+    "subprocess_failures", "External processes that exited non-zero", ("bin",)
+)
+SPAWN_TIME = metrics.histogram(
+    "subprocess_duration_seconds", "External process wall time", ("bin",)
+)
+NORMS = metrics.counter(
+    "tts_normalize", "Loudness normalizations by how the gain was found", ("mode",)
+)
+MOD_HITS = metrics.counter(
+    "moderation_hits", "Requests altered by moderation, by rule", ("kind",)
+)
+OUT_BYTES = metrics.counter("tts_output_bytes", "Audio bytes returned", ("format",))
+metrics.gauge(
+    "tts_cache_items", "Entries in the render cache", fn=lambda: len(cache or ())
+)
 
 
 DEFAULT_VOICES = os.path.join(os.path.dirname(__file__), "..", "voices")
@@ -35,21 +115,58 @@ DEFAULT_SOUNDS = os.path.join(os.path.dirname(__file__), "..", "sounds")
 
 
 def init(c, base_dir: str | None = None):
-    global cfg, sem, cache, aliases, presets, _auth
+    global cfg, lim, cache, segments, blobs, gains, batches, aliases, presets, _auth
+    global vc, scanned
     cfg = c
+    vc, scanned = {}, False
     if base_dir:
         try:
-            for k in ("voices_dir", "sounds_dir"):
+            for k in ("voices_dir", "sounds_dir", "model_cache_dir", "cache_disk_dir"):
                 v = cfg.get(k)
                 if v and not os.path.isabs(v):
                     cfg[k] = resolve_path(v, base_dir)
         except Exception:
             pass
-    sem = threading.Semaphore(int(cfg.get("max_concurrency", 2)))
-    cache = TTLCache(
-        maxsize=int(cfg.get("cache_size", 64)), ttl=int(cfg.get("cache_ttl_s", 300))
+    n = int(cfg.get("max_concurrency", 2))
+    if cfg.get("concurrency_adaptive", True):
+        lim = limiter.AdaptiveLimiter(
+            n,
+            int(cfg.get("concurrency_floor", 1)),
+            int(cfg.get("concurrency_ceiling") or max(n, limiter.cpu_count())),
+            cpu=limiter.CPUSampler(),
+        )
+    else:
+        lim = limiter.AdaptiveLimiter(n, n, n)
+    shared.init_shared(resolve_path(cfg.get("shared_store"), base_dir))
+    t = int(cfg.get("cache_ttl_s", 300))
+    cache = audiocache.tiered(
+        shared.cache("renders", int(cfg.get("cache_size", 64)), t), cfg, "renders", t
+    )
+    segments = audiocache.tiered(
+        shared.cache("segments", int(cfg.get("segment_cache_size", 256)), t),
+        cfg,
+        "segments",
+        t,
     )
-    aliases = dict(cfg.get("aliases", {}))
+    t = int(cfg.get("audio_cache_ttl_s", 3600))
+    blobs = audiocache.tiered(
+        shared.cache("audio", int(cfg.get("audio_cache_size", 256)), t),
+        cfg,
+        "audio",
+        t,
+    )
+    gains = loudness.GainTable()
+    engine.init_engine(
+        cfg, resolve_path(cfg.get("phoneme_cache_file"), base_dir), _threads
+    )
+    w = float(cfg.get("batch_window_ms", 0))
+    batches = (
+        batcher.MicroBatcher(_piper_batch, w, int(cfg.get("batch_max", 8)))
+        if w > 0
+        else None
+    )
+    aliases = shared.mapping("aliases", cfg.get("aliases", {}))
+    sfx.sfx_aliases = shared.mapping("sfx_aliases")
     presets = dict(cfg.get("presets", {}))
     mod.init_moderator(cfg, base_dir=base_dir)
     a = cfg.get("auth") or {}
@@ -59,7 +176,11 @@ def init(c, base_dir: str | None = None):
     else:
         _auth = {"enabled": False, "keys": {}}
         logger.info("[auth] disabled")
-    voices()
+    if not (cfg.get("router") or {}).get("nodes"):
+        # a router renders nothing, so it neither scans nor converts models
+        voices()
+        _prep_sfx()
+    _init_encoders()
 
 
 def auth_enabled():
@@ -113,6 +234,11 @@ def _scan():
             "speakers": len(meta.get("speakers", [0])),
             "language": meta.get("language", meta.get("espeak", {}).get("voice", "")),
         }
+        if cfg.get("mmap_models", True) and models.available():
+            mm = models.external(m, _model_dir())
+            if mm:
+                v[i]["mapped_model"] = mm
+                models.prefetch(models.weights(mm))
 
     vc = v
     scanned = True
@@ -120,6 +246,19 @@ def _scan():
     return [vc[k] for k in sorted(vc.keys())]
 
 
+def _model_dir():
+    d = cfg.get("model_cache_dir") or os.path.join(
+        cfg.get("voices_dir", DEFAULT_VOICES), ".mapped"
+    )
+    try:
+        os.makedirs(d, exist_ok=True)
+        if os.access(d, os.W_OK):
+            return d
+    except OSError:
+        pass
+    return os.path.join(tempfile.gettempdir(), "tts-models")
+
+
 def _default_voice_id():
     return next(iter(sorted(voices(), key=lambda x: x["id"])))["id"]
 
@@ -133,6 +272,23 @@ def _resolve_voice_id(v):
     return _default_voice_id(), bool(v)
 
 
+def route_voice(d, seg=None):
+    """
+    Return the voice name a request is routed by
+
+    Only aliases are resolved, so a router needs no voice models of its own;
+    requests for the default voice route as "".
+
+    :param seg: Segment to route by, defaults to the first speech segment of
+                d["text"]
+    """
+    if seg is None:
+        segs = plan.parse(_san(d.get("text")), lambda n: aliases.get(n.lower()))
+        seg = next((x for x in segs if "text" in x), {})
+    v = seg.get("voice") or (d.get("voice") or "").strip()
+    return aliases.get(v, v)
+
+
 def voices():
     return _scan() if not scanned else [vc[k] for k in sorted(vc.keys())]
 
@@ -141,7 +297,9 @@ def reload():
     global vc, scanned
     vc = {}
     scanned = False
-    return len(voices())
+    n = len(voices())
+    _prep_sfx()
+    return n
 
 
 def _vinfo(i):
@@ -161,51 +319,74 @@ def _san(s):
     return s[:n]
 
 
-def _alias_prefix(s):
-    if ":" in s:
-        h, t = s.split(":", 1)
-        a = h.strip().lower()
-        if a in aliases:
-            return aliases[a], t.strip()
-
-    return None, s
+def _voice_name(n):
+    n = n.strip()
+    v = aliases.get(n.lower())
+    return v or (n if _vinfo(n) else None)
 
 
-def _preset_prefix(s):
-    if s.startswith("[") and "]" in s:
-        tag = s[1 : s.index("]")].strip().lower()
-        rest = s[s.index("]") + 1 :].strip()
-        if tag in presets:
-            return tag, rest
+def _plan(tx):
+    return plan.parse(tx, _voice_name, presets)
 
-    return None, s
 
+def _prepare(text):
+    """
+    Sanitize, moderate and parse a message, as every synthesis endpoint must
 
-def _parse_speed_modifier(s):
+    :return: (plan segments, moderation flags)
+    :raise RuntimeError: If nothing is left to render
     """
-    Parse and remove [fast] or [slow] tag from text.
-    Returns (clean_text, speed_multiplier).
-    [fast] = 0.5 (half length_scale = faster)
-    [slow] = 2.0 (double length_scale = slower)
+    with timing.span("san"):
+        tx = _san(text or "")
+    if not tx:
+        raise RuntimeError("empty")
+
+    with timing.span("mod"):
+        tx, flags = mod.filter_text(tx, mode="drop")
+    for k, v in flags.items():
+        if v:
+            MOD_HITS.inc(k)
+    if not tx:
+        raise RuntimeError("empty")
+
+    with timing.span("parse"):
+        segs = _plan(tx)
+    if not segs:
+        raise RuntimeError("empty")
+    return segs, flags
+
+
+def _params(d, seg):
     """
-    m = _speed_re.search(s)
+    Resolve the render settings of one speech segment
 
-    if not m:
-        return s, 1.0
+    Inline voice and preset tags win over the request's voice and preset;
+    request values win over the preset's.
 
-    tag = m.group(1).lower()
-    clean = (s[: m.start()] + s[m.end() :]).strip()
+    :return: (voice id, fallback, requested voice, preset, ls, ns, nw, ss)
+    """
+    req = seg.get("voice") or (d.get("voice") or "").strip() or None
+    vid, fb = _resolve_voice_id(req)
 
-    multiplier = 0.5 if tag == "fast" else 2.0
+    psel = (seg.get("preset") or d.get("preset") or "").lower()
+    pv = presets.get(psel, {})
+
+    ls = d.get("length_scale", pv.get("length_scale"))
+    sp = seg.get("speed", 1.0)
+    if sp != 1.0:
+        ls = (ls or 1.0) * sp
 
-    return clean, multiplier
+    ns = d.get("noise_scale", pv.get("noise_scale"))
+    nw = d.get("noise_w", pv.get("noise_w"))
+    ss = d.get("sentence_silence", pv.get("sentence_silence"))
+    return vid, fb, req, psel, ls, ns, nw, ss
 
 
 def _cmd(info, txt, out, ls, ns, nw, ss, spk):
     c = [
         cfg.get("piper_bin", "piper"),
         "--model",
-        info["model_path"],
+        info.get("mapped_model") or info["model_path"],
         "--config",
         info["config_path"],
         "--input_file",
@@ -229,115 +410,290 @@ def _cmd(info, txt, out, ls, ns, nw, ss, spk):
     return c
 
 
-def _norm(w):
+def _run(kind, c, **k):
+    """Run an external process, counting spawns, failures and wall time."""
+    SPAWNS.inc(kind)
+    t0 = time.perf_counter()
+    try:
+        r = subprocess.run(c, **k)
+    except Exception:
+        SPAWN_FAILS.inc(kind)
+        raise
+    finally:
+        SPAWN_TIME.observe(time.perf_counter() - t0, kind)
+    if r.returncode != 0:
+        SPAWN_FAILS.inc(kind)
+    return r
+
+
+def _norm(w, key=None):
+    """
+    Normalize loudness, in process when numpy is available, else with ffmpeg
+
+    :param key: Gain table key, renders with the same key share a learned gain
+    :return: Path of the normalized file, w itself when unchanged
+    """
     if not bool(cfg.get("normalize", False)):
         return w
 
+    if loudness.available() and cfg.get("normalize_engine", "auto") != "ffmpeg":
+        with timing.span("norm"):
+            try:
+                r = loudness.normalize(
+                    w,
+                    w + ".norm.wav",
+                    key,
+                    gains,
+                    float(cfg.get("normalize_target_lufs", loudness.TARGET_LUFS)),
+                    float(cfg.get("normalize_peak_db", loudness.PEAK_DB)),
+                )
+            except Exception as e:
+                logger.warning(f"[norm] {e}")
+                r = None
+        if r:
+            NORMS.inc(r[1])
+            return r[0]
+
+    NORMS.inc("ffmpeg")
     f = _which(cfg.get("ffmpeg_bin", "ffmpeg"))
 
     if not f:
         return w
 
     n = w + ".norm.wav"
-    r = subprocess.run(
-        [
-            f,
-            "-y",
-            "-loglevel",
-            "error",
-            "-i",
-            w,
-            "-af",
-            "loudnorm=I=-16:TP=-1.5:LRA=11",
-            n,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
+    with timing.span("norm"):
+        r = _run(
+            "ffmpeg",
+            [
+                f,
+                "-y",
+                "-loglevel",
+                "error",
+                "-i",
+                w,
+                "-af",
+                "loudnorm=I=-16:TP=-1.5:LRA=11",
+                n,
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
 
     return n if r.returncode == 0 and os.path.exists(n) else w
 
 
-def _mp3(w, br):
-    f = _which(cfg.get("ffmpeg_bin", "ffmpeg"))
+def _bitrate(fmt):
+    return cfg.get(f"{fmt}_bitrate", BITRATES.get(fmt))
 
-    if not f:
-        return b""
 
-    m = w + ".mp3"
-    r = subprocess.run(
-        [
-            f,
-            "-y",
-            "-loglevel",
-            "error",
-            "-i",
-            w,
-            "-codec:a",
-            "libmp3lame",
-            "-b:a",
-            br,
-            m,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+def _init_encoders():
+    """Start the encoder pool and warm it for the default format at each voice rate."""
+    pool = encoders.init_encoders(
+        _which(cfg.get("ffmpeg_bin", "ffmpeg")), int(cfg.get("encoder_pool_size", 2))
+    )
+    fmt = cfg.get("default_format", "mp3")
+    if pool and fmt in encoders.CODECS:
+        for sr in sorted({v["sample_rate"] for v in vc.values()}):
+            pool.warm(fmt, _bitrate(fmt), sr, 1)
+
+
+def _encode(w, fmt, br=None):
+    """
+    Encode a WAV file to fmt through the encoder pool
+
+    :return: (bytes, mime), the WAV itself if it cannot be encoded
+    """
+    if fmt not in FORMATS:
+        raise RuntimeError("bad format")
+
+    with open(w, "rb") as f:
+        return _encode_wav(f.read(), fmt, br)
+
+
+def _encode_wav(wb, fmt, br=None):
+    """Encode WAV bytes to fmt, see _encode."""
+    if fmt not in FORMATS:
+        raise RuntimeError("bad format")
+    if fmt == "wav":
+        return wb, "audio/wav"
+
+    try:
+        with wave.open(io.BytesIO(wb)) as f:
+            sr, ch, sw = f.getframerate(), f.getnchannels(), f.getsampwidth()
+            pcm = f.readframes(f.getnframes())
+    except (wave.Error, EOFError):
+        return wb, "audio/wav"
+    if sw != 2:
+        return wb, "audio/wav"
+
+    if fmt == "pcm":
+        a = array("h", pcm)
+        if sys.byteorder == "little":
+            a.byteswap()
+        return a.tobytes(), f"audio/L16; rate={sr}; channels={ch}"
+
+    pool = encoders.get_pool()
+    if not pool:
+        return wb, "audio/wav"
+
+    with timing.span("encode"):
+        try:
+            return pool.encode(pcm, sr, ch, fmt, br or _bitrate(fmt)), MIMES[fmt]
+        except RuntimeError:
+            return wb, "audio/wav"
+
+
+def _threads():
+    """Inference threads per render, splitting the CPUs across the permits."""
+    return int(cfg.get("piper_threads") or 0) or max(
+        1, limiter.cpu_count() // max(1, int(lim.limit))
     )
 
-    if r.returncode != 0 or not os.path.exists(m):
-        return b""
 
-    b = open(m, "rb").read()
+@contextmanager
+def _permit(units=1):
+    """
+    Hold a synthesis permit under the adaptive concurrency limit
 
+    :param units: Characters rendered; latency is compared among similar sizes
+    :return: Dict whose "ok" the caller sets once the work succeeded
+    """
+    with timing.span("sem"):
+        lim.acquire()
+    INFLIGHT.inc()
+    t0, st = time.perf_counter(), {"ok": False}
+    try:
+        yield st
+    finally:
+        INFLIGHT.dec()
+        lim.release(time.perf_counter() - t0, units, st["ok"])
+
+
+def _run_piper(c, units=1):
+    """Run a piper command under the concurrency limit."""
+    with _permit(units) as st:
+        with timing.span("piper"):
+            r = _run(
+                "piper",
+                c,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        st["ok"] = r.returncode == 0
+        return r
+
+
+def _piper_inproc(e, item):
+    """Render one text with the in-process engine to a temporary WAV."""
+    info, txt, ls, ns, nw, ss, spk = item
+    fd, p = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
     try:
-        os.remove(m)
+        with _permit(len(txt)) as st:
+            e.synthesize(info, txt, p, ls, ns, nw, ss, spk)
+            st["ok"] = True
     except:
-        pass
+        os.remove(p)
+        raise
+    return p
 
-    return b
 
+def _piper(info, txt, ls, ns, nw, ss, spk):
+    """
+    Synthesize one text to a temporary WAV file owned by the caller
 
-def _core(txt, vid, fmt, ls, ns, nw, ss, spk, norm, br):
-    info = _vinfo(vid)
+    Goes through the micro-batcher when batch_window_ms is set, so texts for
+    the same voice and parameters arriving together share one piper run.
+    """
+    e = engine.get_engine()
+    if e is not None:
+        # piper-tts runs one utterance per session call, so a batch would only
+        # make its callers wait for each other
+        return _piper_inproc(e, (info, txt, ls, ns, nw, ss, spk))
+
+    # piper reads one text per line, so a newline would split a batch item
+    txt = " ".join(txt.split())
+    if batches is None:
+        return _piper_batch(None, [(info, txt, ls, ns, nw, ss, spk)])[0]
+
+    key = (info["model_path"], ls, ns, nw, ss, spk)
+    with timing.span("batch"):
+        return batches.submit(key, (info, txt, ls, ns, nw, ss, spk))
 
-    if not _which(cfg.get("piper_bin", "piper")):
-        raise RuntimeError("piper not found")
+
+def _piper_batch(key, items):
+    """
+    Run piper once for items sharing a voice and parameters
+
+    Several texts are written one per line and rendered with --output_dir;
+    piper writes one WAV per line, named so that they sort in input order.
+
+    :return: Temporary WAV paths in the order of items
+    """
+    info, _, ls, ns, nw, ss, spk = items[0]
 
     tf = tempfile.NamedTemporaryFile(
         mode="w", encoding="utf-8", suffix=".txt", delete=False
     )
-    tf.write(txt + "\n")
+    tf.write("".join(it[1] + "\n" for it in items))
     tf.close()
 
-    of = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-    of.close()
-
-    rm = [tf.name, of.name]
-
+    if len(items) == 1:
+        of = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
+        of.close()
+        try:
+            c = _cmd(info, tf.name, of.name, ls, ns, nw, ss, spk)
+            r = _run_piper(c, len(items[0][1]))
+            if r.returncode != 0 or not os.path.exists(of.name):
+                raise RuntimeError("piper failed")
+        except:
+            if os.path.exists(of.name):
+                os.remove(of.name)
+            raise
+        finally:
+            os.remove(tf.name)
+        return [of.name]
+
+    od = tempfile.mkdtemp(prefix="tts-batch-")
     try:
-        c = _cmd(info, tf.name, of.name, ls, ns, nw, ss, spk)
+        c = _cmd(info, tf.name, None, ls, ns, nw, ss, spk)
+        i = c.index("--output_file")
+        c[i : i + 2] = ["--output_dir", od]
+        r = _run_piper(c, sum(len(it[1]) for it in items))
 
-        with sem:
-            r = subprocess.run(c, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        fs = sorted(
+            (f for f in os.listdir(od) if f.endswith(".wav")), key=lambda f: (len(f), f)
+        )
+        if r.returncode != 0 or len(fs) != len(items):
+            raise RuntimeError("piper batch failed")
+
+        out = []
+        for f in fs:
+            fd, p = tempfile.mkstemp(suffix=".wav")
+            os.close(fd)
+            os.replace(os.path.join(od, f), p)
+            out.append(p)
+        return out
+    finally:
+        os.remove(tf.name)
+        shutil.rmtree(od, ignore_errors=True)
 
-        if r.returncode != 0 or not os.path.exists(of.name):
-            raise RuntimeError("piper failed")
 
-        src = _norm(of.name) if norm else of.name
-        if src != of.name:
-            rm.append(src)
+def _core(txt, vid, fmt, ls, ns, nw, ss, spk, norm, br):
+    info = _vinfo(vid)
 
-        if fmt == "mp3":
-            b = _mp3(src, br)
-            m = "audio/mpeg" if b else "audio/wav"
-            if not b:
-                b = open(src, "rb").read()
+    if not engine.get_engine() and not _which(cfg.get("piper_bin", "piper")):
+        raise RuntimeError("piper not found")
 
-        elif fmt == "wav":
-            b = open(src, "rb").read()
-            m = "audio/wav"
+    wav = _piper(info, txt, ls, ns, nw, ss, spk)
+    rm = [wav]
 
-        else:
-            raise RuntimeError("bad format")
+    try:
+        src = _norm(wav, (vid, spk, ls, ns, nw)) if norm else wav
+        if src != wav:
+            rm.append(src)
+
+        b, m = _encode(src, fmt, br)
 
     finally:
         for p in rm:
@@ -352,40 +708,72 @@ def _core(txt, vid, fmt, ls, ns, nw, ss, spk, norm, br):
     return b, m, info
 
 
-def tts(d):
-    t0 = time.time()
+def _ext(m):
+    return EXTS.get(m) or EXTS.get(m.split(";", 1)[0], "bin")
 
-    tx = _san(d.get("text") or "")
-    if not tx:
-        raise RuntimeError("empty")
 
-    tx, mod_flags = mod.filter_text(tx, mode="drop")
-    if not tx:
-        raise RuntimeError("empty")
+def put_audio(b, m, sha=None):
+    """
+    Register rendered audio under its content address
 
-    a1, rest = _alias_prefix(tx)
-    p1, clean = _preset_prefix(rest)
+    :return: Name of the form "<sha256>.<ext>"
+    """
+    sha = sha or hashlib.sha256(b).hexdigest()
+    name = f"{sha}.{_ext(m)}"
+    blobs[name] = (b, m)
+    return name
 
-    clean, speed_mult = _parse_speed_modifier(clean)
-    if not clean:
-        raise RuntimeError("empty")
 
-    vf = (d.get("voice") or "").strip()
-    if vf in aliases:
-        vf = aliases[vf]
+def get_audio(name):
+    """Look up audio by content address; returns (bytes, mime) or None."""
+    if not _audio_re.match(name or ""):
+        return None
+    return blobs.get(name)
 
-    req_voice = a1 or vf or None
-    vid, used_fallback = _resolve_voice_id(req_voice)
 
-    psel = (d.get("preset") or p1 or "").lower()
-    pv = presets.get(psel, {})
+def _address(h, b, m, sha=None, hit=False):
+    """
+    Add content-address headers for rendered audio and return its sha256
 
-    base_ls = d.get("length_scale", pv.get("length_scale"))
-    ls = (base_ls or 1.0) * speed_mult if speed_mult != 1.0 else base_ls
+    :param hit: The audio came from the render cache, so the blob tiers
+                already had it; only a first tier that dropped it is refilled
+    """
+    if not hit:
+        name = put_audio(b, m, sha)
+    else:
+        name = f"{sha}.{_ext(m)}"
+        l1 = getattr(blobs, "tiers", [blobs])[0]
+        if name not in l1:
+            l1[name] = (b, m)
+    sha = name.split(".", 1)[0]
+    h["ETag"] = f'"{sha}"'
+    h["X-Audio-Url"] = f"/api/audio/{name}"
+    return sha
 
-    ns = d.get("noise_scale", pv.get("noise_scale"))
-    nw = d.get("noise_w", pv.get("noise_w"))
-    ss = d.get("sentence_silence", pv.get("sentence_silence"))
+
+def tts(d):
+    with timing.trace() as tr:
+        b, m, h = _tts(d)
+
+    h["Server-Timing"] = tr.header()
+    tr.log(h.get("X-Req-Id"))
+
+    REQ_LATENCY.observe(tr.total, h.get("X-Voice", ""), _ext(m), h.get("X-Cache", ""))
+    OUT_BYTES.inc(_ext(m), n=len(b))
+
+    return b, m, h
+
+
+def _tts(d):
+    t0 = time.time()
+
+    segs, mod_flags = _prepare(d.get("text"))
+    speech = [x for x in segs if "text" in x]
+
+    vid, used_fallback, req_voice, psel, ls, ns, nw, ss = _params(
+        d, speech[0] if speech else {}
+    )
+    _note_usage({_params(d, x)[0] for x in speech})
     spk = d.get("speaker_id")
 
     fmt = (d.get("format") or cfg.get("default_format", "mp3")).lower()
@@ -394,22 +782,18 @@ def tts(d):
         if d.get("normalize") is not None
         else cfg.get("normalize", False)
     )
-    br = d.get("bitrate") or cfg.get("mp3_bitrate", "128k")
+    br = d.get("bitrate") or _bitrate(fmt)
     rid = uuid.uuid4().hex[:8]
 
-    if sfx.has_sfx_tags(clean):
-        return _tts_with_sfx(
-            clean,
-            vid,
+    if len(segs) > 1 or not speech:
+        return _tts_segments(
+            d,
+            segs,
             fmt,
-            ls,
-            ns,
-            nw,
-            ss,
-            spk,
             norm,
             br,
             rid,
+            vid,
             req_voice,
             used_fallback,
             mod_flags,
@@ -417,11 +801,14 @@ def tts(d):
             t0,
         )
 
+    clean = speech[0]["text"]
     key = (vid, clean, fmt, ls, ns, nw, ss, spk, norm, br, psel)
     hit = cache.get(key)
 
+    CACHE_REQS.inc("hit" if hit else "miss")
+
     if hit:
-        b, m = hit
+        b, m, sha = hit
         h = {
             "X-Req-Id": rid,
             "X-Voice": vid,
@@ -436,15 +823,14 @@ def tts(d):
             "X-Mod-Slurs": str(mod_flags["slurs"]),
         }
 
-        ext = "mp3" if m == "audio/mpeg" else "wav"
-        h["Content-Disposition"] = f'inline; filename="{vid}-{rid}.{ext}"'
+        h["Content-Disposition"] = f'inline; filename="{vid}-{rid}.{_ext(m)}"'
         h["X-Voice-Requested"] = req_voice or ""
         h["X-Voice-Fallback"] = "1" if used_fallback else "0"
+        _address(h, b, m, sha, hit=True)
 
         return b, m, h
 
     b, m, info = _core(clean, vid, fmt, ls, ns, nw, ss, spk, norm, br)
-    cache[key] = (b, m)
 
     dur = int((time.time() - t0) * 1000)
 
@@ -464,115 +850,183 @@ def tts(d):
         "X-Mod-Slurs": str(mod_flags["slurs"]),
     }
 
-    ext = "mp3" if m == "audio/mpeg" else "wav"
-    h["Content-Disposition"] = f'inline; filename="{vid}-{rid}.{ext}"'
+    h["Content-Disposition"] = f'inline; filename="{vid}-{rid}.{_ext(m)}"'
     h["X-Voice-Requested"] = req_voice or ""
     h["X-Voice-Fallback"] = "1" if used_fallback else "0"
+    cache[key] = (b, m, _address(h, b, m))
 
     return b, m, h
 
 
-def _tts_with_sfx(
-    clean,
-    vid,
-    fmt,
-    ls,
-    ns,
-    nw,
-    ss,
-    spk,
-    norm,
-    br,
-    rid,
-    req_voice,
-    used_fallback,
-    mod_flags,
-    psel,
-    t0,
+def _tts_segments(
+    d, segs, fmt, norm, br, rid, vid, req_voice, used_fallback, mod_flags, psel, t0
 ):
-    parts = sfx.parse_sfx_tags(clean)
-    segs = []
-    rm = []
-
-    max_sfx = int(cfg.get("max_sfx_per_request", 10))
-    sfx_count = 0
-
-    try:
-        for p in parts:
-            if "sfx" in p:
-                if sfx_count >= max_sfx:
-                    continue
-
-                _, ap = sfx._resolve_sfx(p["sfx"], cfg)
-                if not ap:
-                    continue
-
-                wav48 = _to_48k_mono_wav(ap)
-                segs.append(wav48)
-
-                if wav48 != ap:
-                    rm.append(wav48)
-
-                sfx_count += 1
-
-            else:
-                txt = (p.get("text") or "").strip()
-                if not txt:
-                    continue
-
-                wav, tmp = _render_tts_wav(txt, vid, ls, ns, nw, ss, spk, norm)
-                rm += tmp
+    b, m, st = render_plan(d, segs, fmt, norm, br)
 
-                wav48 = _to_48k_mono_wav(wav)
-                segs.append(wav48)
-
-                if wav48 != wav:
-                    rm.append(wav48)
-
-        if not segs:
-            raise RuntimeError("empty audio")
-
-        b, m = _concat_wavs(segs, fmt=fmt, bitrate=br)
+    dur = int((time.time() - t0) * 1000)
+    chars = sum(len(p.get("text", "")) for p in segs)
 
-        dur = int((time.time() - t0) * 1000)
+    h = {
+        "X-Req-Id": rid,
+        "X-Voice": vid,
+        "X-Format": m,
+        "X-Cache": st["cache"],
+        "X-Segments-Cached": f"{st['cached']}/{st['segments']}",
+        "X-Text-Chars": str(chars),
+        "X-Duration-MS": str(dur),
+        "X-Preset": psel or "",
+        "X-SFX-Count": str(st["sfx"]),
+        "Cache-Control": "no-store",
+        "X-Mod-Urls": str(mod_flags["urls"]),
+        "X-Mod-Emojis": str(mod_flags["emojis"]),
+        "X-Mod-Slurs": str(mod_flags["slurs"]),
+    }
 
-        h = {
-            "X-Req-Id": rid,
-            "X-Voice": vid,
-            "X-Format": m,
-            "X-Cache": "miss",
-            "X-Text-Chars": str(len(clean)),
-            "X-Duration-MS": str(dur),
-            "X-Preset": psel or "",
-            "X-SFX-Count": str(sfx_count),
-            "Cache-Control": "no-store",
-            "X-Mod-Urls": str(mod_flags["urls"]),
-            "X-Mod-Emojis": str(mod_flags["emojis"]),
-            "X-Mod-Slurs": str(mod_flags["slurs"]),
-        }
+    h["Content-Disposition"] = f'inline; filename="{vid}-{rid}.{_ext(m)}"'
+    h["X-Voice-Requested"] = req_voice or ""
+    h["X-Voice-Fallback"] = "1" if used_fallback else "0"
+    _address(h, b, m, st["sha"], hit=st["cache"] == "hit")
 
-        ext = "mp3" if m == "audio/mpeg" else "wav"
-        h["Content-Disposition"] = f'inline; filename="{vid}-{rid}.{ext}"'
-        h["X-Voice-Requested"] = req_voice or ""
-        h["X-Voice-Fallback"] = "1" if used_fallback else "0"
+    return b, m, h
 
-        return b, m, h
 
+def _seg_key(d, p, norm):
+    """Return the segment cache key of a plan segment, None for an unknown sound."""
+    if "sfx" in p:
+        _, ap = sfx._resolve_sfx(p["sfx"], cfg)
+        try:
+            st = os.stat(ap) if ap else None
+        except OSError:
+            st = None
+        # a sound replaced under the same name must not hit the old render
+        return ("sfx", ap, st.st_mtime_ns, st.st_size) if st else None
+    if not (p.get("text") or "").strip():
+        return None
+    vid, _, _, _, ls, ns, nw, ss = _params(d, p)
+    return ("tts", vid, p["text"].strip(), ls, ns, nw, ss, d.get("speaker_id"), norm)
+
+
+def _seg_render(k):
+    """Render one segment to 48 kHz mono WAV bytes."""
+    rm = []
+    try:
+        if k[0] == "sfx":
+            w, tmp = sfx_wav(k[1])
+            if tmp:
+                rm.append(w)
+        else:
+            _, vid, txt, ls, ns, nw, ss, spk, norm = k
+            wav, rm = _render_tts_wav(txt, vid, ls, ns, nw, ss, spk, norm)
+            with timing.span("resample"):
+                w = _to_48k_mono_wav(wav)
+            if w != wav:
+                rm.append(w)
+        with open(w, "rb") as f:
+            return f.read()
     finally:
         for pth in rm:
             try:
                 os.remove(pth)
-            except:
+            except OSError:
                 pass
 
 
+def _join_wavs(wbs):
+    """Concatenate WAV bytes of one sample format into a single WAV in memory."""
+    out, fmt = [], None
+    for wb in wbs:
+        with wave.open(io.BytesIO(wb)) as f:
+            p = f.getparams()
+            if fmt is None:
+                fmt = p
+            elif p[:3] != fmt[:3]:
+                raise RuntimeError("concat failed")
+            out.append(f.readframes(p.nframes))
+
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as f:
+        f.setnchannels(fmt.nchannels)
+        f.setsampwidth(fmt.sampwidth)
+        f.setframerate(fmt.framerate)
+        f.writeframes(b"".join(out))
+    return buf.getvalue()
+
+
+def render_plan(d, segs, fmt, norm, br):
+    """
+    Render a plan of speech and sound segments to one clip
+
+    Every segment is looked up in the segment cache, the misses are rendered
+    in parallel (each still under a synthesis permit), and the 48 kHz PCM is
+    joined in memory and encoded once. The whole clip is cached as well.
+
+    :param d: Request, for voice, preset and synthesis defaults
+    :param segs: Segments from plan.parse or tts_batch parts
+    :return: (bytes, mime, {"cache", "cached", "segments", "sfx", "sha"})
+    """
+    max_sfx = int(cfg.get("max_sfx_per_request", 10))
+    ks, n_sfx = [], 0
+    for p in segs:
+        if "sfx" in p:
+            if n_sfx >= max_sfx:
+                continue
+            n_sfx += 1
+        k = _seg_key(d, p, norm)
+        if k:
+            ks.append(k)
+        elif "sfx" in p:
+            n_sfx -= 1
+    if not ks:
+        raise RuntimeError("empty audio")
+
+    st = {"cached": 0, "segments": len(ks), "sfx": n_sfx, "sha": None}
+    key = ("plan", tuple(ks), fmt, br)
+    hit = cache.get(key)
+    CACHE_REQS.inc("hit" if hit else "miss")
+    if hit:
+        st.update(cache="hit", cached=len(ks), sha=hit[2])
+        return hit[0], hit[1], st
+
+    got = {}
+    for k in dict.fromkeys(ks):
+        v = segments.get(k)
+        SEG_REQS.inc("hit" if v else "miss")
+        if v:
+            got[k] = v[0]
+    miss = [k for k in dict.fromkeys(ks) if k not in got]
+
+    if len(miss) > 1:
+        n = min(len(miss), max(1, int(lim.limit)))
+        with ThreadPoolExecutor(n) as ex:
+            fs = [
+                ex.submit(contextvars.copy_context().run, _seg_render, k) for k in miss
+            ]
+            for k, f in zip(miss, fs):
+                got[k] = f.result()
+    elif miss:
+        got[miss[0]] = _seg_render(miss[0])
+    for k in miss:
+        segments[k] = (got[k],)
+
+    with timing.span("concat"):
+        wb = _join_wavs([got[k] for k in ks])
+    b, m = _encode_wav(wb, fmt, br)
+
+    st.update(cache="miss", cached=sum(1 for k in ks if k not in miss))
+    st["sha"] = hashlib.sha256(b).hexdigest()
+    cache[key] = (b, m, st["sha"])
+    return b, m, st
+
+
 def health():
     return {
         "ok": True,
         "piper": _which(cfg.get("piper_bin", "piper")) or None,
         "ffmpeg": _which(cfg.get("ffmpeg_bin", "ffmpeg")) or None,
+        "engine": "inprocess" if engine.get_engine() else "subprocess",
         "voices": len(vc) or len(voices()),
-        "max_concurrency": int(cfg.get("max_concurrency", 2)),
+        "max_concurrency": lim.snapshot()["limit"] if lim else 0,
+        "concurrency": lim.snapshot() if lim else {},
         "cache": (
             {
                 "items": len(cache),
@@ -596,13 +1050,38 @@ def metrics():
             if cache
             else {"items": 0, "capacity": 0, "ttl_sec": 0}
         ),
-        "max_concurrency": int(cfg.get("max_concurrency", 2)),
+        "max_concurrency": lim.snapshot()["limit"] if lim else 0,
         "voices": len(vc),
+        "stages": timing.STAGES.summary(),
+        "phonemes": len(engine.get_engine().cache) if engine.get_engine() else 0,
+        "encoders": encoders.get_pool().idle() if encoders.get_pool() else {},
+        "gains": {"/".join(map(str, k)): v for k, v in gains.snapshot().items()},
+        "models": _model_memory(),
     }
 
 
+def _model_memory():
+    """Report each voice's model size and how much of it this process holds."""
+    ws = {
+        i: models.weights(v["mapped_model"])
+        for i, v in vc.items()
+        if v.get("mapped_model")
+    }
+    res = models.mapped([w for w in ws.values() if w])
+    out = {}
+    for i, v in sorted(vc.items()):
+        try:
+            mb = round(os.path.getsize(v["model_path"]) / 2**20, 1)
+        except OSError:
+            mb = 0
+        w = ws.get(i)
+        out[i] = {"model_mb": mb, "mapped": bool(w)}
+        out[i].update(res[w] if w else {"rss_kb": 0, "pss_kb": 0})
+    return out
+
+
 def get_aliases():
-    return aliases
+    return dict(aliases)
 
 
 def set_alias(n, v):
@@ -613,6 +1092,76 @@ def del_alias(n):
     aliases.pop(n, None)
 
 
+def _note_usage(vids):
+    """Count one request for each voice it is rendered with."""
+    global _usage_t
+    now = time.time()
+    with _usage_lock:
+        for v in vids:
+            _usage[v] = _usage.get(v, 0) + 1
+        if now - _usage_t < USAGE_FLUSH_S:
+            return
+        _usage_t = now
+    flush_usage()
+
+
+def flush_usage():
+    """Write buffered per-voice request counts to the database."""
+    with _usage_lock:
+        n = dict(_usage)
+        _usage.clear()
+    if not n:
+        return
+    try:
+        db.add_voice_usage(n, time.time())
+    except Exception as e:
+        logger.warning(f"[usage] not recorded: {e}")
+
+
+def warmup(k=None):
+    """
+    Load and run the most requested voices once so their first request is fast
+
+    Falls back to the default voice when there is no usage yet. Marks the
+    service ready when done, whether or not every voice warmed up.
+
+    :param k: Number of voices, defaults to warmup_voices
+    :return: Voice ids that were warmed
+    """
+    k = int(cfg.get("warmup_voices", 3)) if k is None else int(k)
+    ids = []
+    if k > 0 and voices():
+        try:
+            ids = [i for i in db.top_voices(k) if i in vc]
+        except Exception as e:
+            logger.warning(f"[warmup] no usage data: {e}")
+        ids = ids or [_default_voice_id()]
+
+    txt = cfg.get("warmup_text", "Hello.")
+    for i in ids:
+        t0 = time.perf_counter()
+        try:
+            os.remove(_piper(_vinfo(i), txt, None, None, None, None, None))
+            logger.info(f"[warmup] {i} in {time.perf_counter() - t0:.2f}s")
+        except Exception as e:
+            logger.warning(f"[warmup] {i} failed: {e}")
+
+    _warm[:] = ids
+    _ready.set()
+    return ids
+
+
+def start_warmup():
+    """Warm up in the background; ready() turns true when done."""
+    _ready.clear()
+    threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+
+def ready():
+    """Return the start-up warm-up state."""
+    return {"ready": _ready.is_set(), "voices": list(_warm)}
+
+
 def _synth_wav_to_path(text, vid, ls, ns, nw, ss, spk):
     info = _vinfo(vid) if vid in vc else _vinfo(_default_voice_id())
 
@@ -629,7 +1178,7 @@ def _synth_wav_to_path(text, vid, ls, ns, nw, ss, spk):
     of.close()
 
     c = _cmd(info, tf.name, of.name, ls, ns, nw, ss, spk)
-    r = subprocess.run(c, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    r = _run("piper", c, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     if r.returncode != 0 or not os.path.exists(of.name):
         raise RuntimeError("piper failed")
@@ -644,7 +1193,8 @@ def _resample_to_uniform(wav_in, sr):
         return wav_in
 
     out = wav_in + f".{sr}.u.wav"
-    r = subprocess.run(
+    r = _run(
+        "ffmpeg",
         [
             f,
             "-y",
@@ -670,38 +1220,83 @@ def _resample_to_uniform(wav_in, sr):
 def _render_tts_wav(txt, vid, ls, ns, nw, ss, spk, norm):
     info = _vinfo(vid) or vc[_default_voice_id()]
 
-    if not _which(cfg.get("piper_bin", "piper")):
+    if not engine.get_engine() and not _which(cfg.get("piper_bin", "piper")):
         raise RuntimeError("piper not found")
 
-    tf = tempfile.NamedTemporaryFile(
-        mode="w", encoding="utf-8", suffix=".txt", delete=False
-    )
-    tf.write(txt + "\n")
-    tf.close()
-
-    of = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-    of.close()
-
-    c = _cmd(info, tf.name, of.name, ls, ns, nw, ss, spk)
+    wav = _piper(info, txt, ls, ns, nw, ss, spk)
 
     try:
-        with sem:
-            r = subprocess.run(c, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        src = _norm(wav, (vid, spk, ls, ns, nw)) if norm else wav
+
+        return src, [wav] + ([] if src == wav else [src])
 
-        if r.returncode != 0 or not os.path.exists(of.name):
-            raise RuntimeError("piper failed")
+    except:
+        try:
+            os.remove(wav)
+        except:
+            pass
+        raise
 
-        src = _norm(of.name) if norm else of.name
 
-        return src, [tf.name, of.name] + ([] if src == of.name else [src])
+def sfx_wav(ap):
+    """
+    Return a 48 kHz mono WAV for a sound file
 
-    except:
-        for p in [tf.name, of.name]:
+    :return: (path, temporary) where temporary paths must be removed by the caller
+    """
+    p = sfx48.get(ap)
+    if p and os.path.exists(p):
+        return p, False
+
+    w = _to_48k_mono_wav(ap)
+    return w, w != ap
+
+
+def _prep_sfx():
+    """Convert (and normalize, when enabled) every sound once at scan time."""
+    global sfx48, _sfx_dir
+    # renders may still hold paths from the live dir, so a reload only
+    # retires it; it is removed by the reload after this one
+    for d in [d for d in _sfx_dirs if d != _sfx_dir]:
+        shutil.rmtree(d, ignore_errors=True)
+        _sfx_dirs.remove(d)
+
+    files = sfx._scan_sounds(cfg)
+    if not files or not _which(cfg.get("ffmpeg_bin", "ffmpeg")):
+        sfx48, _sfx_dir = {}, None
+        return
+
+    d = tempfile.mkdtemp(prefix="tts-sfx-")
+    _sfx_dirs.append(d)
+    out = {}
+    for sid, ap in files.items():
+        w = _to_48k_mono_wav(ap)
+        if w == ap:
+            continue
+        n = _norm(w)
+        dst = os.path.join(d, f"{len(out):04d}.wav")
+        os.replace(n, dst)
+        for p in {w, n} - {dst}:
             try:
                 os.remove(p)
-            except:
+            except OSError:
                 pass
-        raise
+        out[ap] = dst
+
+    sfx48, _sfx_dir = out, d
+    logger.info(f"[sfx] prepared {len(out)}/{len(files)} sounds")
+
+
+def _rm_sfx_dirs():
+    """Remove the prepared sound dirs this process created."""
+    for d in _sfx_dirs:
+        shutil.rmtree(d, ignore_errors=True)
+    _sfx_dirs.clear()
+
+
+atexit.register(_rm_sfx_dirs)
+# a forked worker reads the parent's dir but never removes it
+os.register_at_fork(after_in_child=_sfx_dirs.clear)
 
 
 def _to_48k_mono_wav(inp):
@@ -713,7 +1308,8 @@ def _to_48k_mono_wav(inp):
     out = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
     out.close()
 
-    r = subprocess.run(
+    r = _run(
+        "ffmpeg",
         [
             f,
             "-y",
@@ -734,63 +1330,3 @@ def _to_48k_mono_wav(inp):
     )
 
     return out.name if r.returncode == 0 and os.path.exists(out.name) else inp
-
-
-def _concat_wavs(paths, fmt="mp3", bitrate=None):
-    f = _which(cfg.get("ffmpeg_bin", "ffmpeg"))
-
-    if not f:
-        raise RuntimeError("ffmpeg not found")
-
-    lst = tempfile.NamedTemporaryFile(mode="w", suffix=".txt", delete=False)
-    for p in paths:
-        lst.write(f"file '{p}'\n")
-    lst.close()
-
-    merged_wav = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-    merged_wav.close()
-
-    r = subprocess.run(
-        [
-            f,
-            "-y",
-            "-loglevel",
-            "error",
-            "-f",
-            "concat",
-            "-safe",
-            "0",
-            "-i",
-            lst.name,
-            "-c",
-            "copy",
-            merged_wav.name,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-
-    os.remove(lst.name)
-
-    if r.returncode != 0 or not os.path.exists(merged_wav.name):
-        raise RuntimeError("concat failed")
-
-    if fmt == "wav":
-        b = open(merged_wav.name, "rb").read()
-        os.remove(merged_wav.name)
-        return b, "audio/wav"
-
-    br = bitrate or cfg.get("mp3_bitrate", "128k")
-    mp3 = _mp3(merged_wav.name, br)
-
-    try:
-        os.remove(merged_wav.name)
-    except:
-        pass
-
-    if mp3:
-        return mp3, "audio/mpeg"
-
-    b = open(merged_wav.name, "rb").read() if os.path.exists(merged_wav.name) else b""
-
-    return b, "audio/wav"
@@ -0,0 +1,103 @@
+import sys
+import os
+import asyncio
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath("src"))
+sys.path.insert(0, os.path.abspath("bench"))
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from common import bench_app
+import api
+
+
+@pytest.fixture
+def client(tmp_path):
+    return TestClient(
+        bench_app(work=str(tmp_path), moderation={"enabled": True, "strip_urls": True})
+    )
+
+
+def test_tts_batch_text_is_moderated(client, monkeypatch):
+    seen = []
+
+    def render(j, parts, *a):
+        seen.append(parts)
+        return b"RIFF", "audio/wav", {"cache": "miss", "cached": 0, "segments": 1}
+
+    monkeypatch.setattr(api.eng, "render_plan", render)
+    url = "https://example.com/clip/abc"
+    r = client.post("/api/tts_batch", json={"text": f"watch this {url}"})
+    assert r.status_code == 200
+    assert url not in seen[0][0]["text"]
+
+    r = client.post("/api/tts", json={"text": f"watch this {url}", "format": "wav"})
+    assert r.headers["X-Mod-Urls"] == "1"
+
+
+def test_readyz_waits_for_warmup(tmp_path, monkeypatch):
+    gate, warm = threading.Event(), api.eng.warmup
+    monkeypatch.setattr(api.eng, "warmup", lambda: gate.wait(5) and warm())
+    with TestClient(bench_app(work=str(tmp_path))) as c:
+        r = c.get("/api/readyz")
+        assert r.status_code == 503 and r.json()["ready"] is False
+
+        gate.set()
+        for _ in range(100):
+            r = c.get("/api/readyz")
+            if r.status_code == 200:
+                break
+            time.sleep(0.05)
+        assert r.status_code == 200 and r.json()["voices"]
+
+
+def test_pull_many_jobs(client):
+    assert client.get("/api/pull").status_code == 204
+    assert client.get("/api/pull?n=3").status_code == 204
+
+    for i in range(10):
+        assert (
+            client.post("/api/push", json={"text": f"message {i}"}).status_code == 200
+        )
+
+    r = client.get("/api/pull?n=20")
+    assert r.status_code == 200 and set(r.json()) == {"jobs", "queued"}
+    js = r.json()["jobs"]
+    assert len(js) == api.PULL_MAX == 8 and r.json()["queued"] == 2
+    assert [j["text"] for j in js] == [f"message {i}" for i in range(8)]
+    assert all(j["id"] for j in js)
+
+    # without n the response is still a single job
+    j = client.get("/api/pull").json()
+    assert j["text"] == "message 8" and j["id"] and "jobs" not in j
+    assert client.get("/api/pull?n=1").json()["jobs"][0]["text"] == "message 9"
+    assert client.get("/api/pull?n=5").status_code == 204
+
+
+def test_concurrent_posts_share_a_batch(tmp_path):
+    app = bench_app(work=str(tmp_path), batch_window_ms=300)
+    run, sizes = api.eng.batches.run, []
+    api.eng.batches.run = lambda k, xs: sizes.append(len(xs)) or run(k, xs)
+
+    async def go():
+        t = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=t, base_url="http://t") as c:
+            return await asyncio.gather(
+                *[
+                    c.post("/api/tts", json={"text": f"hi {i}", "format": "wav"})
+                    for i in range(4)
+                ]
+            )
+
+    rs = asyncio.run(go())
+    assert [r.status_code for r in rs] == [200] * 4
+    assert sizes == [4]
+
+
+def test_profile_window_is_validated(client):
+    for p in ("/api/admin/profile", "/api/admin/memprofile"):
+        for s in ("nan", "inf", "0", "3600"):
+            assert client.get(p, params={"seconds": s}).status_code == 400
@@ -0,0 +1,77 @@
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.abspath("src"))
+sys.path.insert(0, os.path.abspath(os.path.join("bench", "stubs")))
+import pytest
+from cachetools import TTLCache
+
+import audiocache
+import respd
+
+KEY = ("en_US-amy-medium", "hello", "mp3", 1.0, None)
+VAL = (b"\x00ID3" * 100, "audio/mpeg", "ab" * 32)
+
+
+@pytest.fixture
+def server():
+    s = respd.serve()
+    yield s
+    s.shutdown()
+    s.server_close()
+
+
+def test_pack_round_trip():
+    for v in (VAL, (b"", "audio/wav"), (b"x", None, "")):
+        assert audiocache._unpack(audiocache._pack(v)) == v
+
+
+def test_disk_ttl_and_size(tmp_path):
+    d = audiocache.DiskCache(str(tmp_path), "renders", 2500, 60)
+    d["a"] = (b"1" * 1000, "audio/wav")
+    d["b"] = (b"2" * 1000, "audio/wav")
+    assert d.get("a") == (b"1" * 1000, "audio/wav")
+    d["c"] = (b"3" * 1000, "audio/wav")
+    assert d.get("b") is None and d.get("a") and d.get("c")
+
+    again = audiocache.DiskCache(str(tmp_path), "renders", 2500, -1)
+    assert len(again) == 2 and again.get("a") is None
+
+
+def test_resp_get_set_expiry_and_outage(server):
+    url = f"redis://127.0.0.1:{server.port}/1"
+    c = audiocache.RespCache(url, "tts:renders", 60)
+    assert c.get(KEY) is None
+    c[KEY] = VAL
+    assert c.get(KEY) == VAL
+
+    c.ttl = 0.05
+    c["short"] = VAL
+    time.sleep(0.1)
+    assert c.get("short") is None
+
+    dead = audiocache.RespCache("redis://127.0.0.1:9", "x", 60, retry_s=60)
+    t0 = time.perf_counter()
+    assert dead.get(KEY) is None and dead.get(KEY) is None
+    assert time.perf_counter() - t0 < 1
+
+
+def test_tiered_promotes_on_hit(tmp_path, server):
+    cfg = {
+        "cache_tiers": ["disk", "resp"],
+        "cache_disk_dir": str(tmp_path),
+        "cache_resp_url": f"redis://127.0.0.1:{server.port}",
+    }
+    a = audiocache.tiered(TTLCache(8, 60), cfg, "renders", 60)
+    a[KEY] = VAL
+
+    # another node: empty memory and disk, same network tier
+    b = audiocache.tiered(
+        TTLCache(8, 60), dict(cfg, cache_disk_dir=str(tmp_path / "b")), "renders", 60
+    )
+    assert b.tiers[0].get(KEY) is None
+    assert b.get(KEY) == VAL
+    assert b.tiers[0].get(KEY) == VAL and b.tiers[1].get(KEY) == VAL
+
+    assert audiocache.tiered(TTLCache(8, 60), {}, "renders", 60).__class__ is TTLCache
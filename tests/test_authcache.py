@@ -0,0 +1,56 @@
+import sys
+import os
+import time
+import sqlite3
+
+sys.path.insert(0, os.path.abspath("src"))
+import jwt
+import pytest
+
+import authcache
+import db
+
+
+def test_lru_evicts_oldest():
+    c = authcache.LRU(2)
+    c.put("a", 1)
+    c.put("b", 2)
+    assert c.get("a") == 1
+    c.put("c", 3)
+    assert c.get("b") is None
+    assert c.get("a") == 1
+    assert c.get("c") == 3
+
+
+def test_verify_caches_and_honors_exp(monkeypatch):
+    authcache.init_authcache({"token_cache_size": 8})
+    now = int(time.time())
+    tok = jwt.encode({"jti": "x", "exp": now + 60}, "s", algorithm="HS256")
+
+    assert authcache.verify(tok, "s")["jti"] == "x"
+    monkeypatch.setattr(jwt, "decode", lambda *a, **k: pytest.fail("not cached"))
+    assert authcache.verify(tok, "s")["jti"] == "x"
+
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    with pytest.raises(jwt.ExpiredSignatureError):
+        authcache.verify(tok, "s")
+
+
+def test_revocations_reach_other_connections(tmp_path):
+    p = str(tmp_path / "t.db")
+    db.init_db(p)
+    authcache.init_authcache({"revocation_sync_s": 0})
+    now = int(time.time())
+    db.insert_token("abc123", ["tts"], now + 60, "admin", now)
+    db.insert_token("def456", ["tts"], now + 60, "admin", now)
+
+    assert db.revoke_token_prefix("abc")
+    assert authcache.is_revoked("abc123")
+    assert not authcache.is_revoked("def456")
+
+    other = sqlite3.connect(p)
+    other.execute("UPDATE tokens SET revoked=1 WHERE jti='def456'")
+    other.commit()
+    other.close()
+
+    assert authcache.is_revoked("def456")
@@ -0,0 +1,52 @@
+import sys
+import os
+import threading
+
+sys.path.insert(0, os.path.abspath("src"))
+import pytest
+
+import batcher
+
+
+def _submit_all(b, keys):
+    out, errs = {}, []
+
+    def one(i, k):
+        try:
+            out[i] = b.submit(k, i)
+        except Exception as e:
+            errs.append(e)
+
+    ts = [threading.Thread(target=one, args=(i, k)) for i, k in enumerate(keys)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return out, errs
+
+
+def test_groups_by_key_and_caps_batch_size():
+    runs = []
+
+    def run(key, xs):
+        runs.append((key, list(xs)))
+        return [x * 10 for x in xs]
+
+    b = batcher.MicroBatcher(run, window_ms=100, max_batch=4)
+    out, errs = _submit_all(b, ["a"] * 6 + ["b"] * 2)
+
+    assert not errs
+    assert out == {i: i * 10 for i in range(8)}
+    assert sorted(len(xs) for k, xs in runs if k == "a") == [2, 4]
+    assert [len(xs) for k, xs in runs if k == "b"] == [2]
+
+
+def test_failure_reaches_every_caller():
+    def run(key, xs):
+        raise RuntimeError("piper failed")
+
+    b = batcher.MicroBatcher(run, window_ms=50, max_batch=8)
+    out, errs = _submit_all(b, ["a"] * 3)
+    assert not out and len(errs) == 3
+    with pytest.raises(RuntimeError):
+        b.submit("a", 1)
@@ -0,0 +1,151 @@
+import sys
+import os
+import time
+import threading
+
+sys.path.insert(0, os.path.abspath("src"))
+import pytest
+
+import db
+
+
+@pytest.fixture
+def fresh_db(tmp_path):
+    db.init_db(str(tmp_path / "t.db"))
+    yield
+    db.close()
+
+
+def test_wal_and_pragmas(fresh_db):
+    c = db._db()
+    assert c.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert c.execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert c.execute("PRAGMA busy_timeout").fetchone()[0] == db.BUSY_TIMEOUT_MS
+
+
+def test_batch_commits_once_and_rolls_back(fresh_db):
+    now = int(time.time())
+    with db.batch():
+        db.insert_token("a", ["tts"], now, "admin", now)
+        db.insert_token("b", ["tts"], now, "admin", now)
+    assert {t["jti"] for t in db.list_tokens()} == {"a", "b"}
+
+    with pytest.raises(ValueError):
+        with db.batch():
+            db.insert_token("c", ["tts"], now, "admin", now)
+            raise ValueError("boom")
+    assert db.get_token("c") is None
+
+    db.insert_tokens([(f"m{i}", ["pull"], now, "admin", now, "") for i in range(50)])
+    assert len(db.list_tokens()) == 52
+
+
+def test_concurrent_read_write_stress(fresh_db):
+    writers, readers, n = 4, 4, 100
+    now = int(time.time())
+    errors = []
+    stop = threading.Event()
+
+    def write(w):
+        try:
+            for i in range(n):
+                jti = f"w{w}-{i}"
+                db.insert_token(jti, ["tts"], now + 60, "admin", now + i)
+                if i % 10 == 0:
+                    db.revoke_token(jti)
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        try:
+            while not stop.is_set():
+                db.list_tokens()
+                db.get_token("w0-0")
+        except Exception as e:
+            errors.append(e)
+
+    rs = [threading.Thread(target=read) for _ in range(readers)]
+    ws = [threading.Thread(target=write, args=(w,)) for w in range(writers)]
+    for t in rs + ws:
+        t.start()
+    for t in ws:
+        t.join()
+    stop.set()
+    for t in rs:
+        t.join()
+
+    assert not errors
+    toks = db.list_tokens()
+    assert len(toks) == writers * n
+    assert sum(t["revoked"] for t in toks) == writers * (n // 10)
+    assert db.is_revoked("w3-90")
+
+
+def test_migrations_add_indexes(fresh_db):
+    c = db._db()
+    assert c.execute("PRAGMA user_version").fetchone()[0] >= 1
+    plan = " ".join(
+        r[3]
+        for r in c.execute("EXPLAIN QUERY PLAN " + db._schema("list_tokens.sql"), (10,))
+    )
+    assert "tokens_created_at" in plan
+    plan = " ".join(
+        r[3]
+        for r in c.execute(
+            "EXPLAIN QUERY PLAN " + db._schema("revoke_token_prefix.sql"), ("ab", "ac")
+        )
+    )
+    assert "PRIMARY KEY" in plan or "autoindex" in plan
+
+
+def test_paginate_and_sweep(fresh_db):
+    now = int(time.time())
+    db.insert_tokens(
+        [
+            (f"t{i:02d}", ["tts"], now - 100 if i < 5 else now + 100, "admin", now, "")
+            for i in range(12)
+        ]
+    )
+    for i in range(12):
+        db.insert_embed(f"e{i:02d}", f"t{i:02d}", now)
+
+    seen, cur = [], None
+    while True:
+        page = db.list_tokens(5, cur)
+        seen += [t["jti"] for t in page]
+        if len(page) < 5:
+            break
+        cur = page[-1]["cursor"]
+    assert sorted(seen) == [f"t{i:02d}" for i in range(12)]
+
+    emb = db.list_embeds(3)
+    assert len(emb) == 3 and all("expires" in e for e in emb)
+
+    db.revoke_token("t00")
+    db.revoke_token("t11")
+    assert db.sweep_expired(now) == (5, 5)
+    assert len(db.list_tokens()) == 7
+    assert len(db.list_embeds()) == 7
+    assert not db.is_revoked("t00")
+    assert db.is_revoked("t11")
+
+
+def test_voice_usage_ranks_voices(fresh_db):
+    db.add_voice_usage({"amy": 3, "ryan": 1}, 100)
+    db.add_voice_usage({"ryan": 5, "bryce": 1}, 200)
+    assert db.top_voices(2) == ["ryan", "amy"]
+    assert db.top_voices(10) == ["ryan", "amy", "bryce"]
+
+
+def test_thread_connections_close_on_exit(fresh_db):
+    db._db()
+
+    def use():
+        db.get_token("x")
+
+    for _ in range(20):
+        t = threading.Thread(target=use)
+        t.start()
+        t.join()
+    assert len(db._conns) == 1
+    assert db.get_token("x") is None
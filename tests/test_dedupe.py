@@ -0,0 +1,46 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath("src"))
+
+import dedupe
+
+RAID = "everyone raid the channel of our friend tonight at nine"
+
+
+def test_canon_folds_raid_variants():
+    a = dedupe.canon(RAID)
+    assert dedupe.canon(RAID.upper() + "!!!!") == a
+    assert dedupe.canon(
+        "everyone   raid the channel of our friend tonight at nineeeee"
+    ) == dedupe.canon(RAID + "e")
+
+
+def test_exact_and_near_repeats_collapse(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(dedupe.time, "monotonic", lambda: now[0])
+    d = dedupe.Deduper(window_s=30, threshold=0.8)
+
+    assert d.check(RAID, "a") is None
+    assert d.check(RAID.upper() + "!!", "b") == "a"
+    assert d.check(RAID + " @bob", "c") == "a"
+    assert d.check("what a great clip that was, thanks for sharing", "d") is None
+
+    now[0] = 31
+    assert d.check(RAID, "e") is None
+    assert d.check(RAID, "f") == "e"
+
+
+def test_short_messages_only_match_exactly():
+    d = dedupe.Deduper()
+    assert d.check("gg", "a") is None
+    assert d.check("gg", "b") == "a"
+    assert d.check("gz", "c") is None
+
+
+def test_window_bounded():
+    d = dedupe.Deduper(window_s=1e9, max_items=4)
+    for i in range(10):
+        d.check(" ".join(str(i * 7919 + j) for j in range(6)), str(i))
+    assert len(d._items) == 4
+    assert sum(len(p) for p in d._post.values()) <= 4 * d.k // dedupe.BAND
@@ -0,0 +1,80 @@
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.abspath("src"))
+import pytest
+
+import encoders
+
+FFMPEG = os.path.abspath("bench/stubs/ffmpeg")
+
+
+def test_pool_reuses_warm_processes():
+    pool = encoders.EncoderPool(FFMPEG, size=1)
+    pcm = b"\x01\x00" * 22050
+    try:
+        pool.warm("opus", "32k", 22050)
+        for _ in range(50):
+            if pool.idle().get("opus"):
+                break
+            time.sleep(0.05)
+        assert pool.idle() == {"opus": 1}
+
+        before = encoders.CHECKOUTS.value("opus", "warm")
+        out = pool.encode(pcm, 22050, 1, "opus", "32k")
+        assert out[:4] == b"opus" and len(out) < len(pcm)
+        assert encoders.CHECKOUTS.value("opus", "warm") == before + 1
+
+        with pytest.raises(RuntimeError):
+            pool.encode(pcm, 22050, 1, "flac", "32k")
+    finally:
+        pool.close()
+    assert pool.idle() == {}
+
+
+def _wait_idle(pool):
+    for _ in range(50):
+        if pool.idle().get("opus"):
+            break
+        time.sleep(0.05)
+    return pool.idle()
+
+
+def test_forked_pool_drops_parent_pipes_and_rewarms():
+    pool = encoders.EncoderPool(FFMPEG, size=1)
+    try:
+        pool.warm("opus", "32k", 22050)
+        assert _wait_idle(pool) == {"opus": 1}
+        (p,) = pool._idle[("opus", "32k", 22050, 1)]
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            pool._after_fork()
+            ok = p.stdin.closed and p.stdout.closed and p.stderr.closed
+            ok = ok and _wait_idle(pool) == {"opus": 1}
+            ok = ok and pool._idle[("opus", "32k", 22050, 1)][0].pid != p.pid
+            pool.close()
+            os.write(w, b"1" if ok else b"0")
+            os._exit(0)
+        os.close(w)
+        assert os.read(r, 1) == b"1"
+        os.waitpid(pid, 0)
+        os.close(r)
+
+        # the parent's warm process is untouched by the child
+        before = encoders.CHECKOUTS.value("opus", "warm")
+        pool.encode(b"\x01\x00" * 100, 22050, 1, "opus", "32k")
+        assert encoders.CHECKOUTS.value("opus", "warm") == before + 1
+    finally:
+        pool.close()
+
+
+def test_closed_pool_stops_warming():
+    pool = encoders.EncoderPool(FFMPEG, size=1)
+    pool.close()
+    pool.warm("opus", "32k", 22050)
+    time.sleep(0.2)
+    assert pool.idle() == {}
+    assert list(pool._keys) == [("opus", "32k", 22050, 1)]
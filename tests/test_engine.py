@@ -0,0 +1,69 @@
+import sys
+import os
+import types
+
+sys.path.insert(0, os.path.abspath("src"))
+
+import engine
+
+
+class FakeVoice:
+    def __init__(self):
+        self.config = types.SimpleNamespace(
+            espeak_voice="en-us", phoneme_id_map={"a": [5]}, sample_rate=22050
+        )
+        self.calls = []
+
+    def phonemize(self, text):
+        self.calls.append(text)
+        return [list(text)]
+
+    def phonemes_to_ids(self, ps):
+        return [ord(p) for p in ps]
+
+
+def test_phoneme_ids_cached_and_persisted(tmp_path):
+    path = str(tmp_path / "ph.json")
+    e = engine.Engine(engine.PhonemeCache(100, path))
+    v = FakeVoice()
+    e._voices["m"] = v
+    info = {"model_path": "m", "language": "en-us"}
+
+    a = e.phoneme_ids(info, "Hi there. Hi there. gg")
+    assert a[0] == a[1] == [ord(c) for c in "Hi there."]
+    assert v.calls == ["Hi there.", "gg"]
+
+    e.cache.save()
+    c = engine.PhonemeCache(100, path)
+    assert c.load() == 2
+    e2 = engine.Engine(c)
+    e2._voices["m"] = v
+    assert e2.phoneme_ids(info, "gg") == [[ord("g")] * 2]
+    assert v.calls == ["Hi there.", "gg"]
+
+
+def test_cache_evicts_oldest():
+    c = engine.PhonemeCache(2)
+    for s in "abc":
+        c.put("en", s, [[1]])
+    assert c.get("en", "a") is None and c.get("en", "c") == [[1]]
+
+
+def test_voice_session_threads(tmp_path, monkeypatch):
+    seen = []
+
+    def session(path, sess_options=None, providers=None):
+        seen.append(sess_options.intra_op_num_threads)
+        return path
+
+    cp = tmp_path / "v.onnx.json"
+    cp.write_text("{}")
+    monkeypatch.setattr(engine.onnxruntime, "InferenceSession", session)
+    monkeypatch.setattr(
+        engine, "PiperConfig", types.SimpleNamespace(from_dict=dict), raising=False
+    )
+    monkeypatch.setattr(engine, "PiperVoice", types.SimpleNamespace)
+
+    e = engine.Engine(engine.PhonemeCache(10), lambda: 3)
+    v = e.voice({"model_path": "m.onnx", "config_path": str(cp)})
+    assert v.session == "m.onnx" and seen == [3]
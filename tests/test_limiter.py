@@ -0,0 +1,61 @@
+import sys
+import os
+import random
+import threading
+
+sys.path.insert(0, os.path.abspath("src"))
+
+import limiter
+
+
+def test_grows_under_contention_and_backs_off_on_slowdown():
+    lim = limiter.AdaptiveLimiter(initial=2, floor=1, ceiling=6)
+
+    for _ in range(60):
+        n = lim.snapshot()["limit"]
+        for _ in range(n):
+            lim.acquire()
+        for _ in range(n):
+            lim.release(0.010, 10)
+    assert lim.snapshot()["limit"] == 6
+
+    lim.acquire()
+    lim.release(0.010, 10)
+    assert lim.snapshot()["limit"] == 6
+
+    for _ in range(60):
+        lim.acquire()
+        lim.release(0.100, 10)
+    assert lim.snapshot()["limit"] == 1
+
+    lim.acquire()
+    lim.release(None)
+    assert lim.snapshot()["inflight"] == 0
+
+
+def test_blocks_at_limit():
+    lim = limiter.AdaptiveLimiter(initial=1, floor=1, ceiling=1)
+    lim.acquire()
+    got = threading.Event()
+    t = threading.Thread(target=lambda: (lim.acquire(), got.set()))
+    t.start()
+    assert not got.wait(0.1)
+    assert lim.snapshot()["waiting"] == 1
+    lim.release()
+    assert got.wait(1)
+    lim.release()
+    t.join()
+
+
+def test_mixed_lengths_do_not_look_like_overload():
+    # a fixed cost per process makes short texts slower per character
+    lim = limiter.AdaptiveLimiter(initial=1, floor=1, ceiling=16)
+    rng = random.Random(3)
+    for _ in range(300):
+        n = lim.snapshot()["limit"]
+        for _ in range(n):
+            lim.acquire()
+        for _ in range(n):
+            chars = rng.choice([5, 12, 40, 120, 400])
+            lim.release(0.020 + 0.0002 * chars, chars)
+    assert lim.snapshot()["limit"] >= 12
@@ -0,0 +1,45 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath("src"))
+import pytest
+
+np = pytest.importorskip("numpy")
+import loudness
+
+
+def _tone(db, sr=22050, sec=2.0):
+    t = np.arange(int(sr * sec)) / sr
+    return (10 ** (db / 20) * np.sqrt(2) * np.sin(2 * np.pi * 220 * t)).astype(
+        np.float32
+    )
+
+
+def test_loudness_and_limit():
+    sr = 22050
+    assert loudness.loudness(_tone(-20.0), sr) == pytest.approx(-20.7, abs=0.2)
+    assert loudness.loudness(np.zeros(sr, np.float32), sr) is None
+
+    x = _tone(-3.0) * 1.6
+    y = loudness.limit(x, 0.8, sr)
+    assert np.abs(y).max() <= 0.8 + 1e-6
+    assert np.abs(y[: sr // 10]).max() > 0.75
+
+
+def test_normalize_learns_gain(tmp_path):
+    sr = 22050
+    tb = loudness.GainTable(warm=2, refresh=100)
+    modes = []
+    for i in range(4):
+        p = str(tmp_path / f"{i}.wav")
+        loudness.write_wav(p, _tone(-30.0 + i * 0.1), sr)
+        out, mode = loudness.normalize(p, p + ".n.wav", "v", tb, peak_db=-1.0)
+        modes.append(mode)
+        x, _ = loudness.read_wav(out)
+        assert loudness.loudness(x, sr) == pytest.approx(-16.0, abs=0.5)
+        assert np.abs(x).max() <= 10 ** (-1.0 / 20) + 1e-4
+    assert modes == ["measured", "measured", "learned", "learned"]
+
+    p = str(tmp_path / "quiet.wav")
+    loudness.write_wav(p, _tone(-15.8 + 0.691), sr)
+    assert loudness.normalize(p, p + ".n.wav")[1] == "skipped"
@@ -0,0 +1,34 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath("src"))
+import metrics
+
+
+def test_histogram_quantiles():
+    h = metrics.Histogram("t", buckets=(0.01, 0.1, 1.0))
+    for _ in range(90):
+        h.observe(0.005, "a")
+    for _ in range(10):
+        h.observe(0.5, "a")
+    s = h.summary()["a"]
+    assert s["count"] == 100
+    assert s["p50_ms"] <= 10
+    assert 100 <= s["p99_ms"] <= 1000
+
+
+def test_render_openmetrics():
+    c = metrics.counter("t_reqs", "Requests", ("route",))
+    c.inc('/a"b')
+    c.inc('/a"b', n=2)
+    h = metrics.histogram("t_lat", "", ("route",), buckets=(0.1, 1.0))
+    h.observe(0.05, "/x")
+    metrics.gauge("t_depth", "Depth", fn=lambda: 4)
+
+    out = metrics.render()
+    assert 't_reqs_total{route="/a\\"b"} 3' in out
+    assert 't_lat_bucket{route="/x",le="0.1"} 1' in out
+    assert 't_lat_bucket{route="/x",le="+Inf"} 1' in out
+    assert 't_lat_count{route="/x"} 1' in out
+    assert "t_depth 4" in out
+    assert out.endswith("# EOF\n")
@@ -0,0 +1,54 @@
+import sys
+import os
+import mmap
+
+sys.path.insert(0, os.path.abspath("src"))
+import pytest
+
+import models
+
+
+def _model(p, n=512):
+    np = pytest.importorskip("numpy")
+    onnx = pytest.importorskip("onnx")
+    from onnx import helper, numpy_helper, TensorProto
+
+    w = np.random.rand(n, n).astype(np.float32)
+    g = helper.make_graph(
+        [helper.make_node("MatMul", ["x", "W"], ["y"])],
+        "g",
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, [1, n])],
+        [helper.make_tensor_value_info("y", TensorProto.FLOAT, [1, n])],
+        [numpy_helper.from_array(w, "W")],
+    )
+    m = helper.make_model(g, opset_imports=[helper.make_opsetid("", 13)])
+    m.ir_version = 8
+    onnx.save(m, p)
+    return w
+
+
+def test_mapped_reports_resident_pages(tmp_path):
+    p = tmp_path / "w.bin"
+    p.write_bytes(b"\1" * (1 << 20))
+    with open(p, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        sum(m[i] for i in range(0, len(m), 4096))
+        r = models.mapped([str(p)])[str(p)]
+    assert r["rss_kb"] >= 1024 and r["pss_kb"] > 0
+
+
+def test_external_weights_are_mapped_by_onnxruntime(tmp_path):
+    src = str(tmp_path / "v.onnx")
+    w = _model(src)
+    ort = pytest.importorskip("onnxruntime")
+
+    out = models.external(src, str(tmp_path / "mapped"))
+    assert out and models.external(src, str(tmp_path / "mapped")) == out
+    wp = models.weights(out)
+    assert os.path.getsize(wp) >= w.nbytes
+
+    o = ort.SessionOptions()
+    o.add_session_config_entry("session.disable_prepacking", "1")
+    s = ort.InferenceSession(out, o, providers=["CPUExecutionProvider"])
+    x = w[:1]
+    assert abs(s.run(None, {"x": x})[0] - x @ w).max() < 1e-2
+    assert models.mapped([wp])[wp]["rss_kb"] >= w.nbytes // 1024
@@ -0,0 +1,54 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath("src"))
+
+import plan
+
+VOICES = {"amy": "en_US-amy-medium", "bob": "en_US-bryce-medium"}
+PRESETS = {"whisper", "fast"}
+
+
+def parse(s):
+    return plan.parse(s, lambda n: VOICES.get(n.lower()), PRESETS)
+
+
+def test_plain_text_is_one_segment():
+    assert parse("hello there chat") == [
+        {"text": "hello there chat", "voice": None, "preset": None, "speed": 1.0}
+    ]
+
+
+def test_voice_switches_and_run_tags():
+    segs = parse("[slow] hi all Amy: ready? [SFX: airhorn] go [whisper] bob:go!")
+    amy, bob = VOICES["amy"], VOICES["bob"]
+    assert [s.get("voice") for s in segs] == [None, amy, None, amy, bob]
+    assert segs[0] == {"text": "hi all", "voice": None, "preset": None, "speed": 2.0}
+    assert segs[2] == {"sfx": "airhorn"}
+    # a tag applies to the whole run, on both sides of the SFX
+    assert segs[1]["preset"] == segs[3]["preset"] == "whisper"
+    assert segs[4] == {
+        "text": "go!",
+        "voice": VOICES["bob"],
+        "preset": None,
+        "speed": 1.0,
+    }
+
+
+def test_unknown_controls_are_text():
+    segs = parse("note: see [thing] at 10:30 https://x.y")
+    assert segs == [
+        {
+            "text": "note: see [thing] at 10:30 https://x.y",
+            "voice": None,
+            "preset": None,
+            "speed": 1.0,
+        }
+    ]
+
+
+def test_presets_shadow_speed_tags_and_empty_runs_drop():
+    assert parse("[fast] hi")[0]["preset"] == "fast"
+    assert parse("[fast] hi")[0]["speed"] == 1.0
+    assert parse("amy: [SFX: boom]") == [{"sfx": "boom"}]
+    assert parse("amy:") == []
@@ -0,0 +1,64 @@
+import sys
+import os
+import time
+import pstats
+import threading
+
+sys.path.insert(0, os.path.abspath("src"))
+import pytest
+
+import profiler
+
+
+def _spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+@pytest.fixture
+def busy():
+    stop = threading.Event()
+    t = threading.Thread(target=_spin, args=(stop,), name="spinner")
+    t.start()
+    yield
+    stop.set()
+    t.join()
+
+
+def test_collapsed_and_pstats(busy, tmp_path):
+    out = profiler.profile(0.3, 200, "collapsed")
+    line = next(ln for ln in out.splitlines() if ln.startswith("spinner;"))
+    assert "_spin (test_profiler.py:" in line
+    assert int(line.rsplit(" ", 1)[1]) > 0
+
+    p = tmp_path / "p.pstats"
+    p.write_bytes(profiler.profile(0.3, 200, "pstats"))
+    st = pstats.Stats(str(p))
+    hits = [k for k in st.stats if k[2] == "_spin"]
+    assert hits and st.stats[hits[0]][3] > 0
+
+
+def test_one_profile_at_a_time(busy):
+    t = threading.Thread(target=profiler.profile, args=(0.5, 10))
+    t.start()
+    time.sleep(0.1)
+    with pytest.raises(RuntimeError):
+        profiler.memory(0.1)
+    t.join()
+
+
+def test_memory_diff():
+    keep = []
+    t = threading.Timer(0.05, lambda: keep.append(bytearray(2_000_000)))
+    t.start()
+    rep = profiler.memory(0.3, top=5)
+    assert rep["top"][0]["size_diff"] >= 2_000_000
+    assert "test_profiler.py" in rep["top"][0]["where"][0]
+
+
+@pytest.mark.parametrize("s", [float("nan"), float("inf"), -1, 0, 61])
+def test_bad_window_is_rejected(s):
+    with pytest.raises(ValueError):
+        profiler.profile(s)
+    with pytest.raises(ValueError):
+        profiler.memory(s)
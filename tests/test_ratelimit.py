@@ -0,0 +1,83 @@
+import sys
+import os
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath("src"))
+
+import shared
+import ratelimit
+import api
+
+
+def test_bucket_burst_then_refill(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+    b = ratelimit.TokenBuckets()
+    cost = [("requests", 2.0, 3.0, 1)]
+
+    assert [b.take("k", cost)[0] for _ in range(3)] == [0, 0, 0]
+    wait, name = b.take("k", cost)
+    assert name == "requests" and abs(wait - 0.5) < 1e-9
+    assert b.take("other", cost)[0] == 0
+
+    now[0] += 0.5
+    assert b.take("k", cost)[0] == 0
+
+
+def test_all_or_nothing_and_char_cap(monkeypatch):
+    monkeypatch.setattr(ratelimit.time, "time", lambda: 0.0)
+    rl = ratelimit.RateLimiter(
+        {"default": {"rps": 10, "burst": 10, "chars_per_s": 100, "chars_burst": 200}},
+        ratelimit.TokenBuckets(),
+    )
+    assert rl.check("ip:a", "anon", 150) == 0
+    assert rl.check("ip:a", "anon", 100) == 0.5
+    # the rejected request did not use a request token
+    assert rl.buckets._d["ip:a|requests"][0] == 9
+    # a text longer than the burst waits for a full bucket instead of forever
+    assert rl.check("ip:b", "anon", 5000) == 0
+
+
+def test_unlimited_roles():
+    rl = ratelimit.RateLimiter(
+        {"default": {"rps": 1}, "admin": {}}, ratelimit.TokenBuckets()
+    )
+    assert rl.costs("admin", 100) == []
+    assert [c[0] for c in rl.costs("tts", 100)] == ["requests"]
+
+
+def test_shared_buckets_across_workers(tmp_path):
+    p = str(tmp_path / "s.db")
+    a = ratelimit.TokenBuckets(shared.Store(p))
+    b = ratelimit.TokenBuckets(shared.Store(p))
+    cost = [("requests", 0.001, 2.0, 1)]
+
+    assert a.take("key:x", cost)[0] == 0
+    assert b.take("key:x", cost)[0] == 0
+    assert a.take("key:x", cost)[0] > 0 and b.take("key:x", cost)[0] > 0
+
+
+def _req(key=None, host="10.0.0.1"):
+    st = SimpleNamespace(jwt_secret="s")
+    return SimpleNamespace(
+        headers={"x-api-key": key} if key else {},
+        session={},
+        client=SimpleNamespace(host=host),
+        app=SimpleNamespace(state=st),
+    )
+
+
+def test_caller_role_from_exact_key(monkeypatch):
+    keys = {"admin": "ka", "tts": "kt", "pull": "kp", "overlay": "ko"}
+    monkeypatch.setattr(api.eng, "_auth", {"enabled": True, "keys": keys})
+
+    assert api._caller(_req("kt"))[1] == "tts"
+    assert api._caller(_req("kp"))[1] == "pull"
+    assert api._caller(_req("ko"))[1] == "overlay"
+    assert api._caller(_req("kt"))[0].startswith("key:")
+    assert api._caller(_req("nope")) == ("ip:10.0.0.1", "anon")
+
+
+def test_caller_auth_disabled_is_not_admin(monkeypatch):
+    monkeypatch.setattr(api.eng, "_auth", {"enabled": False, "keys": {}})
+    assert api._caller(_req("anything")) == ("ip:10.0.0.1", "anon")
@@ -0,0 +1,141 @@
+import sys
+import os
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.abspath("src"))
+import pytest
+
+import router
+
+
+def _node(name):
+    class H(BaseHTTPRequestHandler):
+        ready = True
+        delay = 0
+
+        def do_GET(self):
+            ok = self.path != "/api/readyz" or H.ready
+            self.send_response(200 if ok else 503)
+            self.end_headers()
+            self.wfile.write(name.encode())
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            time.sleep(H.delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.end_headers()
+            self.wfile.write(name.encode())
+
+        def log_message(self, *a):
+            pass
+
+    s = ThreadingHTTPServer(("127.0.0.1", 0), H)
+    threading.Thread(target=s.serve_forever, daemon=True).start()
+    return s, H, f"http://127.0.0.1:{s.server_port}"
+
+
+@pytest.fixture
+def nodes():
+    ns = [_node(f"n{i}") for i in range(3)]
+    yield ns
+    for s, _, _ in ns:
+        s.shutdown()
+        s.server_close()
+
+
+def test_ring_moves_only_keys_of_changed_node():
+    keys = [f"voice-{i}" for i in range(500)]
+    r = router.Ring(["a", "b", "c"])
+    before = {k: r.walk(k)[0] for k in keys}
+    assert {"a", "b", "c"} == set(before.values())
+
+    r.set_nodes(["a", "b", "c", "d"])
+    after = {k: r.walk(k)[0] for k in keys}
+    moved = [k for k in keys if before[k] != after[k]]
+    assert all(after[k] == "d" for k in moved)
+    assert 50 < len(moved) < 250
+
+    r.set_nodes(["a", "c", "d"])
+    gone = {k: r.walk(k)[0] for k in keys}
+    assert all(gone[k] == after[k] for k in keys if after[k] != "b")
+
+
+def test_forward_sticks_to_owner_and_fails_over(nodes):
+    rt = router.Router([u for _, _, u in nodes])
+    n1, r1 = rt.forward("GET", "/api/tts", "en_US-amy-medium")
+    n2, r2 = rt.forward("GET", "/api/tts", "en_US-amy-medium")
+    assert n1 == n2 and r1.text == r2.text
+
+    s, h, u = next(x for x in nodes if x[2] == n1)
+    h.ready = False
+    rt.check()
+    assert rt.snapshot()["nodes"][[x[2] for x in nodes].index(n1)]["up"] is False
+    n3, _ = rt.forward("GET", "/api/tts", "en_US-amy-medium")
+    assert n3 != n1
+
+    h.ready = True
+    rt.check()
+    assert rt.forward("GET", "/api/tts", "en_US-amy-medium")[0] == n1
+
+
+def test_dead_node_is_skipped(nodes):
+    rt = router.Router([u for _, _, u in nodes] + ["http://127.0.0.1:9"], tries=4)
+    seen = {rt.forward("GET", "/x", f"k{i}")[0] for i in range(40)}
+    assert "http://127.0.0.1:9" not in seen
+    assert "http://127.0.0.1:9" in rt.down
+
+
+def test_proxied_requests_do_not_block_each_other(nodes, tmp_path):
+    import httpx
+
+    sys.path.insert(0, os.path.abspath("bench"))
+    from common import bench_app
+
+    _, h, url = nodes[0]
+    h.delay = 0.5
+    app = bench_app(work=str(tmp_path), router={"nodes": [url]})
+
+    async def go():
+        t = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=t, base_url="http://r") as c:
+            return await asyncio.gather(
+                *[c.post("/api/tts", json={"text": f"hi {i}"}) for i in range(4)]
+            )
+
+    t0 = time.perf_counter()
+    rs = asyncio.run(go())
+    router.init_router({})
+    assert [r.status_code for r in rs] == [200] * 4
+    assert time.perf_counter() - t0 < 1.5
+
+
+def test_router_needs_no_voices(nodes, tmp_path):
+    from fastapi.testclient import TestClient
+
+    sys.path.insert(0, os.path.abspath("bench"))
+    from common import bench_app
+
+    empty = tmp_path / "none"
+    empty.mkdir()
+    app = bench_app(
+        work=str(tmp_path),
+        voices_dir=str(empty),
+        aliases={"amy": "en_US-amy-medium"},
+        router={"nodes": [u for _, _, u in nodes]},
+    )
+    c = TestClient(app)
+    try:
+        r = c.post("/api/tts", json={"text": "hi"})
+        assert r.status_code == 200
+        a = c.post("/api/tts", json={"text": "amy: hi", "voice": "x"})
+        b = c.get("/api/tts", params={"text": "hi", "voice": "en_US-amy-medium"})
+        assert a.status_code == b.status_code == 200 and a.text == b.text
+        r = c.post("/api/tts_batch", json={"text": "hi [SFX: boom]"})
+        assert r.status_code == 200
+        assert c.get("/api/healthz").status_code == 200
+    finally:
+        router.init_router({})
@@ -0,0 +1,47 @@
+import sys
+import os
+import threading
+
+sys.path.insert(0, os.path.abspath("src"))
+import yaml
+
+import secrets_util as sec
+
+
+def test_view_is_cached_until_file_changes(tmp_path, monkeypatch):
+    p = str(tmp_path / "s.yaml")
+    sec.save_oauth_mapping("twitch", "Alice", "mod", p)
+
+    calls = []
+    real = yaml.safe_load
+    monkeypatch.setattr(yaml, "safe_load", lambda f: calls.append(1) or real(f))
+
+    assert sec.list_oauth_mappings("twitch", p) == {"alice": "mod"}
+    assert sec.get_oauth_provider("twitch", p) == {}
+    assert not calls
+
+    with open(p, "w", encoding="utf-8") as f:
+        yaml.safe_dump({"oauth": {"mappings": {"twitch": {"bob": "admin"}}}}, f)
+    assert sec.list_oauth_mappings("twitch", p) == {"bob": "admin"}
+    assert len(calls) == 1
+
+
+def test_concurrent_mapping_edits_are_not_lost(tmp_path):
+    p = str(tmp_path / "s.yaml")
+    n = 40
+
+    ts = [
+        threading.Thread(
+            target=sec.save_oauth_mapping, args=("twitch", str(i), "mod", p)
+        )
+        for i in range(n)
+    ]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+
+    assert len(sec.list_oauth_mappings("twitch", p)) == n
+    assert sec.delete_oauth_mapping("twitch", "7", p)
+    assert "7" not in sec.list_oauth_mappings("twitch", p)
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
@@ -0,0 +1,66 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath("src"))
+
+import shared
+
+
+def test_map_changes_seen_by_other_store(tmp_path):
+    p = str(tmp_path / "s.db")
+    a = shared.SharedMap(shared.Store(p), "aliases", {"bob": "en_US-ryan"})
+    b = shared.SharedMap(shared.Store(p), "aliases")
+
+    assert b["bob"] == "en_US-ryan"
+    a["amy"] = "en_US-amy"
+    assert "amy" in b
+    a.pop("bob", None)
+    assert dict(b) == {"amy": "en_US-amy"}
+
+
+def test_queue_fifo_bound_and_drop(tmp_path):
+    p = str(tmp_path / "s.db")
+    a = shared.SharedQueue(shared.Store(p), "push", maxlen=3)
+    b = shared.SharedQueue(shared.Store(p), "push", maxlen=3)
+
+    for i in range(5):
+        a.append({"id": f"j{i}", "text": str(i)})
+
+    assert len(b) == 3
+    assert b.peek()["id"] == "j2"
+    assert b.drop("j3") == 1
+    assert b.take()["id"] == "j2"
+    assert a.take()["id"] == "j4"
+    assert a.take() is None and not b
+
+    for i in range(3):
+        a.append({"id": f"k{i}"})
+    assert [it["id"] for it in b.take_many(2)] == ["k0", "k1"]
+    assert [it["id"] for it in a.take_many(5)] == ["k2"] and a.take_many(1) == []
+
+
+def test_memory_queue_matches():
+    q = shared.MemoryQueue(maxlen=3)
+    for i in range(5):
+        q.append({"id": f"j{i}"})
+
+    assert q.peek()["id"] == "j2"
+    assert q.drop("j3") == 1
+    assert [q.take()["id"], q.take()["id"], q.take()] == ["j2", "j4", None]
+    q.extend([{"id": "k0"}, {"id": "k1"}])
+    assert [it["id"] for it in q.take_many(5)] == ["k0", "k1"]
+
+
+def test_cache_ttl_and_size(tmp_path):
+    s = shared.Store(str(tmp_path / "s.db"))
+    c = shared.SharedCache(s, "renders", maxsize=2, ttl=60)
+
+    c[("v", "hi", 1.0, None)] = (b"abc", "audio/wav", "x")
+    assert c.get(("v", "hi", 1.0, None)) == (b"abc", "audio/wav", "x")
+    c["b"] = 1
+    c["c"] = 2
+    assert len(c) == 2 and c.get(("v", "hi", 1.0, None)) is None
+
+    c.ttl = -1
+    c["d"] = 3
+    assert "d" not in c
@@ -0,0 +1,26 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath("src"))
+import timing
+
+
+def test_trace_collects_spans_into_server_timing():
+    with timing.trace() as tr:
+        with timing.span("piper"):
+            pass
+        with timing.span("encode"):
+            pass
+        with timing.span("piper"):
+            pass
+    hdr = tr.header()
+    assert hdr.startswith("piper;dur=")
+    assert hdr.count("piper") == 1
+    assert "encode;dur=" in hdr and "total;dur=" in hdr
+    assert timing.STAGES.summary()["piper"]["count"] >= 2
+
+
+def test_span_outside_trace_only_feeds_histogram():
+    with timing.span("orphan"):
+        pass
+    assert timing.STAGES.summary()["orphan"]["count"] == 1
@@ -0,0 +1,166 @@
+import sys
+import os
+import shutil
+import threading
+import time
+import wave
+
+sys.path.insert(0, os.path.abspath("src"))
+sys.path.insert(0, os.path.abspath("bench"))
+import pytest
+
+from common import bench_cfg
+import tts
+
+
+@pytest.fixture
+def eng(tmp_path):
+    tts.init(bench_cfg(str(tmp_path), aliases={"amy": "en_US-amy-medium"}))
+    return tts
+
+
+def test_render_plan_caches_segments(eng):
+    segs = eng._plan("hello [SFX: boom] amy: there")
+    assert [s.get("sfx") for s in segs] == [None, "boom", None]
+
+    b, m, st = eng.render_plan({}, segs, "wav", False, None)
+    assert (st["cache"], st["cached"], st["segments"], st["sfx"]) == ("miss", 0, 3, 1)
+
+    again = eng.render_plan({}, segs, "wav", False, None)
+    assert again[0] == b and again[2]["cache"] == "hit"
+
+    # a new message sharing two of the segments renders only the third
+    _, _, st = eng.render_plan(
+        {}, eng._plan("hello [SFX: boom] bye"), "wav", False, None
+    )
+    assert (st["cache"], st["cached"], st["segments"]) == ("miss", 2, 3)
+
+
+def test_render_plan_empty(eng):
+    with pytest.raises(RuntimeError):
+        eng.render_plan({}, [{"sfx": "nope"}], "wav", False, None)
+
+
+def test_batched_callers_survive_newlines(tmp_path):
+    tts.init(bench_cfg(str(tmp_path), batch_window_ms=200))
+    out = {}
+
+    def run(name, fn):
+        try:
+            out[name] = fn()
+        except Exception as e:
+            out[name] = e
+
+    ts = [
+        threading.Thread(
+            target=run,
+            args=(
+                "batch",
+                lambda: tts.render_plan(
+                    {}, [{"text": "first line\nsecond line"}], "wav", False, None
+                ),
+            ),
+        ),
+        threading.Thread(
+            target=run,
+            args=(
+                "tts",
+                lambda: tts.tts({"text": "innocent message", "format": "wav"}),
+            ),
+        ),
+    ]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+
+    assert not isinstance(out["batch"], Exception), out["batch"]
+    assert not isinstance(out["tts"], Exception), out["tts"]
+
+
+def test_replaced_sound_misses_the_cache(tmp_path):
+    sd = tmp_path / "sounds"
+    shutil.copytree("sounds", sd)
+    tts.init(bench_cfg(str(tmp_path), sounds_dir=str(sd)))
+    segs = tts._plan("[SFX: boom]")
+    assert tts.render_plan({}, segs, "wav", False, None)[2]["cache"] == "miss"
+    assert tts.render_plan({}, segs, "wav", False, None)[2]["cache"] == "hit"
+
+    (sd / "boom.mp3").write_bytes(b"new sound")
+    tts.reload()
+    _, _, st = tts.render_plan({}, segs, "wav", False, None)
+    assert (st["cache"], st["cached"]) == ("miss", 0)
+
+
+def test_reload_keeps_sounds_in_use(eng):
+    held = dict(eng.sfx48)
+    assert held
+    eng.reload()
+    # a render that looked up a sound before the reload can still read it
+    assert all(os.path.exists(p) for p in held.values())
+    assert eng.sfx48 and all(os.path.exists(p) for p in eng.sfx48.values())
+    eng.reload()
+    assert not any(os.path.exists(p) for p in held.values())
+
+
+class _Inproc:
+    def synthesize(self, info, text, out, *a):
+        with wave.open(out, "wb") as w:
+            w.setframerate(22050)
+            w.setsampwidth(2)
+            w.setnchannels(1)
+            w.writeframes(bytes(2000))
+
+
+def test_inprocess_engine_skips_the_batcher(tmp_path, monkeypatch):
+    tts.init(bench_cfg(str(tmp_path), batch_window_ms=200))
+    monkeypatch.setattr(tts.engine, "_engine", _Inproc())
+    monkeypatch.setattr(tts.batches, "submit", None)
+    b, m, _ = tts.tts({"text": "hello there", "format": "wav"})
+    assert m == "audio/wav" and len(b) > 44
+
+
+def test_forked_worker_keeps_the_parents_sounds(eng):
+    live, held = eng._sfx_dir, list(eng._sfx_dirs)
+    eng._sfx_dirs.clear()  # what a forked child starts with
+    eng.reload()
+    eng.reload()
+    assert os.path.isdir(live)
+    assert eng.sfx48 and eng._sfx_dir != live
+
+    eng._rm_sfx_dirs()
+    assert not os.path.exists(eng._sfx_dir)
+    for d in held:
+        shutil.rmtree(d)
+
+
+def test_render_cache_hit_does_not_rewrite_audio(tmp_path, monkeypatch):
+    tts.init(
+        bench_cfg(
+            str(tmp_path), cache_tiers=["disk"], cache_disk_dir=str(tmp_path / "c")
+        )
+    )
+    writes = []
+    put = tts.audiocache.DiskCache.__setitem__
+    monkeypatch.setattr(
+        tts.audiocache.DiskCache,
+        "__setitem__",
+        lambda s, k, v: writes.append(s.ns) or put(s, k, v),
+    )
+    for text in ("hello there", "hi [SFX: boom] there"):
+        d = {"text": text, "format": "wav"}
+        _, _, h = tts.tts(d)
+        assert "audio" in writes and h["X-Cache"] == "miss"
+        writes.clear()
+        _, _, h = tts.tts(d)
+        assert h["X-Cache"] == "hit" and writes == []
+        assert tts.get_audio(h["X-Audio-Url"].rsplit("/", 1)[1])
+
+
+def test_usage_counts_each_voice_once_per_request(eng, monkeypatch):
+    monkeypatch.setattr(eng, "_usage", {})
+    monkeypatch.setattr(eng, "_usage_t", time.time())
+    d = {"text": "hi [SFX: boom] amy: there amy: again", "format": "wav"}
+    eng.tts(d)
+    eng.tts(d)
+    assert eng._usage == {eng._default_voice_id(): 2, "en_US-amy-medium": 2}